@@ -0,0 +1,182 @@
+import numpy as np
+
+import mlmc.moments as moments
+
+import mlmc_levels
+
+moments_classes = {"legendre": moments.Legendre, "monomial": moments.Monomial}
+
+
+class LevelSamples:
+    """
+    Samples of the selected quantities on a single MLMC level,
+    fine and coarse arrays (n_samples, n_quantities, n_locations, n_times); components of vector quantities
+    are separate quantities (e.g. displacement_0, displacement_1, displacement_2), coarse values are zero on the first level.
+    """
+
+    def __init__(self, fine, coarse):
+        self.fine = fine
+        self.coarse = coarse
+
+    @property
+    def n_samples(self):
+        return self.fine.shape[0]
+
+
+def load_samples(sample_storage, q_specs, quantities=None):
+    """
+    Read the samples of all levels at once (one read per level) and reshape them
+    from the flat results ordered as (quantity, time, location, component).
+    :param sample_storage: SampleStorageHDF
+    :param q_specs: simulation result format (endorse_2Dtest.quantity_specs), see mlmc_levels.quantity_slice
+    :param quantities: names of quantities with common locations and times, default the quantities
+                       with the locations of the first one
+    :return: list of LevelSamples, quantity labels, locations, times
+    """
+    if quantities is None:
+        quantities = [q.name for q in q_specs if list(q.locations) == list(q_specs[0].locations)]
+    offset = 0
+    selected = []
+    for q_spec in q_specs:
+        size = int(np.prod(q_spec.shape)) * len(q_spec.times) * len(q_spec.locations)
+        if q_spec.name in quantities:
+            selected.append((q_spec, slice(offset, offset + size)))
+        offset += size
+    if len(selected) != len(quantities):
+        raise Exception("Unknown quantities: {}".format(sorted(set(quantities) - {q.name for q, s in selected})))
+    locations = list(selected[0][0].locations)
+    times = np.array(selected[0][0].times, dtype=float)
+    for q_spec, q_slice in selected:
+        if list(q_spec.locations) != locations or not np.array_equal(q_spec.times, times):
+            raise Exception("Quantity '{}' has different locations or times.".format(q_spec.name))
+
+    labels = []
+    for q_spec, q_slice in selected:
+        n_comp = int(np.prod(q_spec.shape))
+        labels += [q_spec.name] if n_comp == 1 else ["{}_{}".format(q_spec.name, i) for i in range(n_comp)]
+
+    pairs = mlmc_levels.collected_pairs(sample_storage)
+    n_collected = [level_pairs.shape[1] if len(level_pairs) else 0 for level_pairs in pairs]
+    if min(n_collected) < 2:
+        raise Exception("Too few collected samples per level {}, at least two samples on each level are needed."
+                        .format(n_collected))
+    levels = []
+    for level_pairs in pairs:
+        n_samples = level_pairs.shape[1]
+        arrays = []
+        for i_pair in range(2):
+            if i_pair >= level_pairs.shape[2]:
+                # the first level has only the fine values
+                arrays.append(np.zeros_like(arrays[0]))
+                continue
+            parts = []
+            for q_spec, q_slice in selected:
+                # (n_values, n_samples) -> (n_samples, n_times, n_locations, n_comp) -> (n_samples, n_comp, n_loc, n_times)
+                values = level_pairs[q_slice, :, i_pair].T.reshape(n_samples, len(times), len(locations), -1)
+                parts.append(values.transpose(0, 3, 2, 1))
+            arrays.append(np.concatenate(parts, axis=1))
+        levels.append(LevelSamples(*arrays))
+    return levels, labels, locations, times
+
+
+def estimate_domains(levels, quantile=0.01):
+    """
+    Domain of every quantity, location and time given by quantiles of the fine samples of the first level.
+    :return: lower, upper; arrays (n_quantities, n_locations, n_times)
+    """
+    lower, upper = np.nanquantile(levels[0].fine, [quantile, 1 - quantile], axis=0)
+    upper = np.where(upper > lower, upper, lower + 1)
+    return lower, upper
+
+
+def level_moments(levels, domains, n_moments, moments_class=moments.Legendre):
+    """
+    Moment functions of the values mapped by their own domains to [0, 1], evaluated for all
+    quantities, locations and times at once.
+    :return: list of arrays (n_samples, n_quantities, n_locations, n_times, n_moments) of the level differences
+    """
+    lower, upper = domains
+    moments_fn = moments_class(n_moments, (0, 1))
+
+    def evaluate(values):
+        return np.asarray(moments_fn(np.clip((values - lower) / (upper - lower), 0, 1)))
+
+    result = []
+    for level_id, level in enumerate(levels):
+        diff = evaluate(level.fine)
+        if level_id > 0:
+            diff = diff - evaluate(level.coarse)
+        result.append(diff)
+    return result
+
+
+def mlmc_estimate(level_values):
+    """
+    MLMC estimate of the mean: sum of the level means of the differences, variance of the estimate sum(V_l / n_l).
+    :param level_values: list of arrays (n_samples, ...) of the level differences
+    :return: mean, variance of the mean; arrays (...)
+    """
+    mean = sum(np.mean(values, axis=0) for values in level_values)
+    variance = sum(np.var(values, axis=0, ddof=1) / len(values) for values in level_values)
+    return mean, variance
+
+
+def bootstrap_interval(level_values, n_bootstrap=100, confidence=0.95, seed=None):
+    """
+    Bootstrap confidence interval of the MLMC mean, the samples of each level are resampled independently.
+    The bootstrap means are computed by a single matrix product of the resampling counts per level.
+    :return: lower, upper; arrays (...)
+    """
+    rng = np.random.default_rng(seed)
+    boot_means = 0
+    for values in level_values:
+        n = len(values)
+        counts = rng.multinomial(n, np.full(n, 1 / n), size=n_bootstrap)
+        boot_means = boot_means + (counts @ values.reshape(n, -1) / n).reshape(n_bootstrap, *values.shape[1:])
+    alpha = (1 - confidence) / 2
+    return np.quantile(boot_means, [alpha, 1 - alpha], axis=0)
+
+
+def legendre_density(moments_mean, lower, upper, n_points=50):
+    """
+    Orthogonal series approximation of the density from the MLMC estimates of the Legendre moments,
+    p(t) = sum_k (2k + 1) / 2 * E[P_k(t)] * P_k(t) on the reference domain [-1, 1].
+    Values outside the domain were clipped to its bounds, so the tails are not represented.
+    :param moments_mean: array (..., n_moments)
+    :param lower, upper: domains, arrays (...)
+    :return: points, density; arrays (..., n_points)
+    """
+    t = np.linspace(-1, 1, n_points)
+    n_moments = moments_mean.shape[-1]
+    basis = np.polynomial.legendre.legvander(t, n_moments - 1) * (2 * np.arange(n_moments) + 1) / 2
+    density = moments_mean @ basis.T
+    lower, upper = np.asarray(lower)[..., None], np.asarray(upper)[..., None]
+    points = lower + (t + 1) / 2 * (upper - lower)
+    return points, density * 2 / (upper - lower)
+
+
+def analyze(sample_storage, q_specs, quantities=None, n_moments=5, moments_name="legendre", quantile=0.01,
+            n_bootstrap=100, confidence=0.95, seed=None):
+    """
+    Moments of the quantities for all locations and times at once.
+    :return: dict of arrays:
+        labels, locations, times, n_samples - per level,
+        lower, upper - domains (n_quantities, n_locations, n_times),
+        mean, mean_variance - MLMC mean of the values and the variance of the estimate,
+        moments_mean, moments_variance, moments_ci_lower, moments_ci_upper - (n_quantities, n_locations, n_times, n_moments),
+        density_points, density - Legendre moments only, (n_quantities, n_locations, n_times, n_points)
+    """
+    levels, labels, locations, times = load_samples(sample_storage, q_specs, quantities)
+    domains = estimate_domains(levels, quantile)
+    level_values = level_moments(levels, domains, n_moments, moments_classes[moments_name])
+    moments_mean, moments_variance = mlmc_estimate(level_values)
+    ci_lower, ci_upper = bootstrap_interval(level_values, n_bootstrap, confidence, seed)
+    mean, mean_variance = mlmc_estimate([level.fine - level.coarse for level in levels])
+    result = dict(labels=np.array(labels), locations=np.array(locations), times=times,
+                  n_samples=np.array([level.n_samples for level in levels]),
+                  lower=domains[0], upper=domains[1], mean=mean, mean_variance=mean_variance,
+                  moments_mean=moments_mean, moments_variance=moments_variance,
+                  moments_ci_lower=ci_lower, moments_ci_upper=ci_upper)
+    if moments_name == "legendre":
+        result["density_points"], result["density"] = legendre_density(moments_mean, *domains)
+    return result
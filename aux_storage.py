@@ -0,0 +1,243 @@
+import os
+import time
+import numpy as np
+import h5py
+
+from mesh_cache import link_file
+from stage_timer import StageTimer
+import ruamel.yaml as yaml
+
+# auxiliary records of the samples, <work_dir>/aux/<sample dir name>/, they survive removal of the sample dirs
+AUX_DIR = "aux"
+# HDF group of the collected records, next to the results of SampleStorageHDF
+AUX_GROUP = "aux"
+
+STAGE_TIMES_FILE = "stage_times.yaml"
+RUN_STATS_FILE = "flow_run_stats.yaml"
+SOLVER_STATS_FILE = "solver_stats.npz"
+
+sample_aux_files = [STAGE_TIMES_FILE, RUN_STATS_FILE, SOLVER_STATS_FILE]
+# files of the coarse simulation (subdirectory 'coarse' of the sample), stored with the prefix 'coarse_'
+COARSE_DIR = "coarse"
+coarse_aux_files = [RUN_STATS_FILE]
+stage_quantities = ["wall", "cpu", "max_rss", "children_max_rss"]
+run_stats_quantities = ["returncode", "wall_time", "user_time", "sys_time", "max_rss", "in_blocks", "out_blocks",
+                        "timeout", "n_elements", "mesh_step"]
+
+
+def save_sample_aux(work_dir, sample_dir=None):
+    """
+    Put the auxiliary files of the sample into the aux directory of the work dir.
+    :param work_dir: work directory
+    :param sample_dir: sample directory, default the current directory
+    :return: None
+    """
+    if sample_dir is None:
+        sample_dir = os.getcwd()
+    aux_dir = os.path.join(work_dir, AUX_DIR, os.path.basename(sample_dir))
+    os.makedirs(aux_dir, mode=0o775, exist_ok=True)
+    files = [(fname, fname) for fname in sample_aux_files]
+    files += [(os.path.join(COARSE_DIR, fname), "coarse_" + fname) for fname in coarse_aux_files]
+    for src_name, dst_name in files:
+        src = os.path.join(sample_dir, src_name)
+        if os.path.isfile(src):
+            dst = os.path.join(aux_dir, dst_name)
+            if os.path.exists(dst):
+                os.remove(dst)
+            link_file(src, dst)
+
+
+def _stage_table(samples, aux_dir):
+    """
+    :return: stage names, dict quantity -> array (n_samples, n_stages), NaN for stages not run
+    """
+    stages = []
+    sample_records = []
+    for sample in samples:
+        fname = os.path.join(aux_dir, sample, STAGE_TIMES_FILE)
+        records = StageTimer.load(fname) if os.path.isfile(fname) else []
+        for rec in records:
+            if rec["stage"] not in stages:
+                stages.append(rec["stage"])
+        sample_records.append(records)
+
+    table = {q: np.full((len(samples), len(stages)), np.nan) for q in stage_quantities}
+    for i, records in enumerate(sample_records):
+        for rec in records:
+            j = stages.index(rec["stage"])
+            for q in stage_quantities:
+                value = rec.get(q, np.nan)
+                if np.isnan(table[q][i, j]):
+                    table[q][i, j] = value
+                elif q in ["wall", "cpu"]:
+                    # repeated stage
+                    table[q][i, j] += value
+                else:
+                    table[q][i, j] = max(table[q][i, j], value)
+    return stages, table
+
+
+def _run_stats_table(samples, aux_dir):
+    table = np.full((len(samples), len(run_stats_quantities)), np.nan)
+    abort_reasons = []
+    for i, sample in enumerate(samples):
+        fname = os.path.join(aux_dir, sample, RUN_STATS_FILE)
+        stats = {}
+        if os.path.isfile(fname):
+            with open(fname, "r") as f:
+                stats = yaml.safe_load(f) or {}
+        for j, q in enumerate(run_stats_quantities):
+            if stats.get(q, None) is not None:
+                table[i, j] = stats[q]
+        abort_reasons.append(stats.get("abort_reason", None) or "")
+    return table, abort_reasons
+
+
+def _modified_since(sample_aux_dir, since):
+    """
+    True if some auxiliary file of the sample was modified after the time 'since'.
+    """
+    for fname in sample_aux_files:
+        path = os.path.join(sample_aux_dir, fname)
+        if os.path.isfile(path) and os.stat(path).st_mtime > since:
+            return True
+    return False
+
+
+def _merge_stages(stages, table, new_stages, new_table):
+    """
+    Append rows of new samples to the stage table, the stage columns are united.
+    """
+    all_stages = list(stages) + [name for name in new_stages if name not in stages]
+    merged = {}
+    for q in stage_quantities:
+        old_values = table[q] if q in table else np.full((0, len(stages)), np.nan)
+        values = np.full((len(old_values) + len(new_table[q]), len(all_stages)), np.nan)
+        values[:len(old_values), :len(stages)] = old_values
+        for j, name in enumerate(new_stages):
+            values[len(old_values):, all_stages.index(name)] = new_table[q][:, j]
+        merged[q] = values
+    return all_stages, merged
+
+
+def collect_aux(work_dir, hdf_file):
+    """
+    Store the auxiliary records of all samples into the group 'aux' of the HDF sample storage:
+        aux/samples - sample dir names
+        aux/stage_times/<quantity> - (n_samples, n_stages), attribute 'stages'
+        aux/run_stats/values - (n_samples, n_quantities), attribute 'quantities'; aux/run_stats/abort_reason
+        aux/solver_stats/<sample>/<array>
+    Only samples not yet in the group are read, the records of the others are kept.
+    :return: number of samples
+    """
+    aux_dir = os.path.join(work_dir, AUX_DIR)
+    if not os.path.isdir(aux_dir):
+        return 0
+    samples = sorted(e.name for e in os.scandir(aux_dir) if e.is_dir())
+
+    old_samples, stages, stage_table = [], [], {}
+    run_stats = np.zeros((0, len(run_stats_quantities)))
+    abort_reasons = []
+    collect_time = time.time()
+    with h5py.File(hdf_file, "a") as f:
+        if AUX_GROUP in f:
+            group = f[AUX_GROUP]
+            quantities = [s.decode() for s in group["run_stats"].attrs["quantities"]]
+            if quantities != run_stats_quantities:
+                # records of an older version, collected again
+                del f[AUX_GROUP]
+        if AUX_GROUP in f:
+            group = f[AUX_GROUP]
+            old_samples = [s.decode() for s in group["samples"][()]]
+            stages = [s.decode() for s in group["stage_times"].attrs["stages"]]
+            stage_table = {q: group["stage_times"][q][()] for q in stage_quantities}
+            run_stats = group["run_stats"]["values"][()]
+            abort_reasons = [s.decode() for s in group["run_stats"]["abort_reason"][()]]
+            # samples computed again (renew, resume) since the last collection are read again
+            last_time = group.attrs.get("collect_time", 0)
+            keep = [not _modified_since(os.path.join(aux_dir, sample), last_time) for sample in old_samples]
+            old_samples = [sample for sample, k in zip(old_samples, keep) if k]
+            stage_table = {q: values[keep] for q, values in stage_table.items()}
+            run_stats = run_stats[keep]
+            abort_reasons = [reason for reason, k in zip(abort_reasons, keep) if k]
+            for sample, k in zip(group["samples"][()], keep):
+                if not k and sample.decode() in group["solver_stats"]:
+                    del group["solver_stats"][sample.decode()]
+
+        known = set(old_samples)
+        new_samples = [sample for sample in samples if sample not in known]
+        new_stages, new_stage_table = _stage_table(new_samples, aux_dir)
+        stages, stage_table = _merge_stages(stages, stage_table, new_stages, new_stage_table)
+        new_run_stats, new_abort_reasons = _run_stats_table(new_samples, aux_dir)
+        run_stats = np.concatenate([run_stats, new_run_stats])
+        abort_reasons = abort_reasons + new_abort_reasons
+        samples = old_samples + new_samples
+
+        solver_group = f.require_group(AUX_GROUP).require_group("solver_stats")
+        group = f[AUX_GROUP]
+        group.attrs["collect_time"] = collect_time
+        for name in ["samples", "stage_times", "run_stats"]:
+            if name in group:
+                del group[name]
+        group.create_dataset("samples", data=np.array(samples, dtype="S"))
+
+        stage_group = group.create_group("stage_times")
+        stage_group.attrs["stages"] = np.array(stages, dtype="S")
+        for q, values in stage_table.items():
+            stage_group.create_dataset(q, data=values)
+
+        run_group = group.create_group("run_stats")
+        run_group.attrs["quantities"] = np.array(run_stats_quantities, dtype="S")
+        run_group.create_dataset("values", data=run_stats)
+        run_group.create_dataset("abort_reason", data=np.array(abort_reasons, dtype="S"))
+
+        for sample in new_samples:
+            fname = os.path.join(aux_dir, sample, SOLVER_STATS_FILE)
+            if not os.path.isfile(fname) or sample in solver_group:
+                continue
+            sample_group = solver_group.create_group(sample)
+            with np.load(fname) as stats:
+                for name in stats.files:
+                    sample_group.create_dataset(name, data=stats[name])
+    return len(samples)
+
+
+def load_stage_times(hdf_file):
+    """
+    :return: sample names, stage names, dict quantity -> array (n_samples, n_stages)
+    """
+    with h5py.File(hdf_file, "r") as f:
+        if AUX_GROUP not in f:
+            return [], [], {}
+        group = f[AUX_GROUP]
+        samples = [s.decode() for s in group["samples"][()]]
+        stage_group = group["stage_times"]
+        stages = [s.decode() for s in stage_group.attrs["stages"]]
+        table = {q: stage_group[q][()] for q in stage_quantities}
+    return samples, stages, table
+
+
+def stage_report(hdf_file, percentiles=(10, 50, 90)):
+    """
+    Percentiles of the stage quantities across the samples.
+    :return: list of report lines
+    """
+    samples, stages, table = load_stage_times(hdf_file)
+    columns = ["p{}".format(p) for p in percentiles] + ["max", "mean", "total"]
+    lines = ["{} samples".format(len(samples))]
+    units = dict(wall="s", cpu="s", max_rss="kB", children_max_rss="kB")
+    for q in stage_quantities:
+        lines.append("")
+        lines.append("{} [{}]".format(q, units[q]))
+        lines.append("{:<12} {:>6} ".format("stage", "n") + " ".join("{:>12}".format(c) for c in columns))
+        for j, name in enumerate(stages):
+            values = table[q][:, j]
+            values = values[~np.isnan(values)]
+            if len(values) == 0:
+                continue
+            row = list(np.percentile(values, percentiles)) + [np.max(values), np.mean(values)]
+            cells = ["{:>12.4g}".format(v) for v in row]
+            # sum of memory peaks has no meaning
+            cells.append("{:>12.4g}".format(np.sum(values)) if units[q] == "s" else "{:>12}".format("-"))
+            lines.append("{:<12} {:>6} ".format(name, len(values)) + " ".join(cells))
+    return lines
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the sampling pipeline with the Flow123d stand-in (fake_flow123d.py).
+
+Measures throughput (samples/second), per-sample overhead outside the solver
+and scheduler latency of:
+    calculate - endorse_2Dtest.calculate called directly in sample directories
+    one_process - Sampler with OneProcessPool
+    process_pool - Sampler with ProcessPool
+    notifying_pool - Sampler with NotifyingProcessPool, results collected on completion notification
+    many_samples - ProcessPool with many short samples
+    process_run - 'process.py run' of WGC2020_Process in a subprocess
+Meshes are taken from a small mesh repository, so gmsh is not run.
+
+Usage:
+    python benchmarks/bench_pipeline.py [-o bench_results.json] [-n 10] [--sleep 0.1] [--cpu 0] [--np 4]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import platform
+import subprocess
+import numpy as np
+import ruamel.yaml as yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from flow_mc_new import endorse_2Dtest
+from mesh_repository import MeshRepository
+import aux_storage
+import mlmc_levels
+import completion
+from stage_timer import StageTimer
+
+from mlmc.sampler import Sampler
+from mlmc.sample_storage_hdf import SampleStorageHDF
+from mlmc.sampling_pool import OneProcessPool, ProcessPool
+
+FAKE_FLOW = os.path.join(BENCH_DIR, "fake_flow123d.py")
+
+
+def write_fake_mesh(fname, n=8):
+    """
+    Structured triangle mesh of the unit square in GMSH 2 ASCII format.
+    """
+    xy = np.stack(np.meshgrid(np.arange(n + 1), np.arange(n + 1), indexing="ij"), axis=-1).reshape(-1, 2) / n
+    idx = np.arange((n + 1) ** 2).reshape(n + 1, n + 1) + 1
+    triangles = np.concatenate([np.stack([idx[:-1, :-1], idx[1:, :-1], idx[1:, 1:]], axis=-1).reshape(-1, 3),
+                                np.stack([idx[:-1, :-1], idx[1:, 1:], idx[:-1, 1:]], axis=-1).reshape(-1, 3)])
+    with open(fname, "w") as f:
+        f.write('$MeshFormat\n2.2 0 8\n$EndMeshFormat\n$PhysicalNames\n1\n2 1 "box"\n$EndPhysicalNames\n')
+        f.write("$Nodes\n{}\n".format(len(xy)))
+        for i, (x, y) in enumerate(xy):
+            f.write("{} {} {} 0\n".format(i + 1, x, y))
+        f.write("$EndNodes\n$Elements\n{}\n".format(len(triangles)))
+        for i, t in enumerate(triangles):
+            f.write("{} 2 2 1 1 {} {} {}\n".format(i + 1, *t))
+        f.write("$EndElements\n")
+
+
+def bench_config(work_dir, repo_dir, n_samples):
+    with open(os.path.join(REPO_DIR, "config.yaml"), "r") as f:
+        config = yaml.safe_load(f)
+    config["work_dir"] = work_dir
+    config["script_dir"] = REPO_DIR
+    config["n_samples"] = n_samples
+    config["debug"] = False
+    config["run_on_metacentrum"] = False
+    config["_aux_flow_path"] = [sys.executable, FAKE_FLOW]
+    config["_aux_gmsh_path"] = []
+    config["mesh_repository"] = repo_dir
+    config["mesh_cache"] = dict(enabled=False)
+    config["mesh_pregeneration"] = dict(enabled=False)
+    config["plot_in_sample"] = False
+    return config
+
+
+def sample_times(work_dir):
+    """
+    Sample wall time (sum of stages) and solver wall time of the samples recorded in the aux dir.
+    :return: arrays (n_samples,), (n_samples,)
+    """
+    aux_dir = os.path.join(work_dir, aux_storage.AUX_DIR)
+    sample_wall = []
+    solver_wall = []
+    for sample in sorted(os.listdir(aux_dir)):
+        records = StageTimer.load(os.path.join(aux_dir, sample, aux_storage.STAGE_TIMES_FILE))
+        sample_wall.append(sum(rec["wall"] for rec in records))
+        solver_wall.append(sum(rec["wall"] for rec in records if rec["stage"] == "flow123d"))
+    return np.array(sample_wall), np.array(solver_wall)
+
+
+def summary(wall, n_samples, n_workers, sample_wall, solver_wall):
+    overhead = sample_wall - solver_wall
+    return dict(n_samples=n_samples,
+                n_workers=n_workers,
+                wall_time=wall,
+                samples_per_second=n_samples / wall,
+                solver_time_mean=float(np.mean(solver_wall)),
+                overhead_mean=float(np.mean(overhead)),
+                overhead_p50=float(np.percentile(overhead, 50)),
+                overhead_p90=float(np.percentile(overhead, 90)),
+                # campaign time not spent in the samples, per sample
+                scheduler_latency=float((wall * n_workers - np.sum(sample_wall)) / n_samples))
+
+
+def bench_calculate(config, n_samples):
+    work_dir = config["work_dir"]
+    level_sim = endorse_2Dtest(config=config, clean=True).level_instance([1], [0])
+    orig_dir = os.getcwd()
+    start = time.monotonic()
+    for i in range(n_samples):
+        sample_dir = os.path.join(work_dir, "output", "L00_S{:07d}".format(i))
+        os.makedirs(sample_dir)
+        os.chdir(sample_dir)
+        endorse_2Dtest.calculate(level_sim.config_dict, seed=i)
+    wall = time.monotonic() - start
+    os.chdir(orig_dir)
+    return summary(wall, n_samples, 1, *sample_times(work_dir))
+
+
+def bench_sampler(config, sampling_pool, n_samples, n_workers):
+    work_dir = config["work_dir"]
+    storage = SampleStorageHDF(file_path=os.path.join(work_dir, "bench.hdf5"))
+    sampler = Sampler(sample_storage=storage, sampling_pool=sampling_pool,
+                      sim_factory=endorse_2Dtest(config=config, clean=True),
+                      level_parameters=mlmc_levels.level_parameters(config))
+    start = time.monotonic()
+    sampler.set_initial_n_samples([n_samples])
+    sampler.schedule_samples()
+    if hasattr(sampling_pool, "wait_finished"):
+        completion.wait_for_samples(sampler, sampling_pool, timeout=None, max_wait=1)
+    else:
+        sampler.ask_sampling_pool_for_samples(sleep=0.01, timeout=None)
+    wall = time.monotonic() - start
+    n_finished = int(np.sum(storage.n_finished()))
+    if n_finished != n_samples:
+        raise Exception("Finished {} of {} samples.".format(n_finished, n_samples))
+    return summary(wall, n_samples, n_workers, *sample_times(work_dir))
+
+
+def bench_process_run(config, n_samples, n_workers):
+    """
+    Whole 'process.py run' in a script dir with the benchmark config.
+    """
+    work_dir = config["work_dir"]
+    script_dir = os.path.join(work_dir, "script")
+    os.makedirs(script_dir)
+    for f in os.listdir(REPO_DIR):
+        if f.endswith(".py") or f.endswith("_tmpl.yaml"):
+            shutil.copyfile(os.path.join(REPO_DIR, f), os.path.join(script_dir, f))
+    run_config = {k: v for k, v in config.items() if not k.startswith("_") and k not in ["work_dir", "script_dir"]}
+    run_config["local"] = dict(flow_executable=config["_aux_flow_path"], np=n_workers, gmsh_executable=[])
+    with open(os.path.join(script_dir, "config.yaml"), "w") as f:
+        yaml.safe_dump(run_config, f)
+    start = time.monotonic()
+    subprocess.run([sys.executable, os.path.join(script_dir, "process.py"), "run", os.path.join(work_dir, "run")],
+                   cwd=script_dir, check=True, stdout=subprocess.DEVNULL)
+    wall = time.monotonic() - start
+    return summary(wall, n_samples, n_workers, *sample_times(os.path.join(work_dir, "run")))
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default="bench_results.json", help="JSON file with results")
+    parser.add_argument("-n", "--n_samples", type=int, default=10, help="Number of samples of a case")
+    parser.add_argument("--n_many", type=int, default=200, help="Number of samples of the many_samples case")
+    parser.add_argument("--sleep", type=float, default=0.1, help="Sleep time of the solver [s]")
+    parser.add_argument("--cpu", type=float, default=0.0, help="CPU time of the solver [s]")
+    parser.add_argument("--np", type=int, default=4, help="Number of processes of ProcessPool")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directories")
+    args = parser.parse_args(arguments)
+
+    os.environ["FAKE_FLOW_SLEEP"] = str(args.sleep)
+    os.environ["FAKE_FLOW_CPU"] = str(args.cpu)
+
+    base_dir = tempfile.mkdtemp(prefix="bench_pipeline_")
+    repo_dir = os.path.join(base_dir, "mesh_repository")
+    os.makedirs(repo_dir)
+    write_fake_mesh(os.path.join(repo_dir, "fake_mesh.msh"))
+    MeshRepository(repo_dir).update_index()
+
+    cases = [
+        ("calculate", lambda c: bench_calculate(c, args.n_samples)),
+        ("one_process", lambda c: bench_sampler(c, OneProcessPool(work_dir=c["work_dir"]), args.n_samples, 1)),
+        ("process_pool", lambda c: bench_sampler(c, ProcessPool(n_processes=args.np, work_dir=c["work_dir"]),
+                                                 args.n_samples, args.np)),
+        ("notifying_pool", lambda c: bench_sampler(c, completion.NotifyingProcessPool(n_processes=args.np,
+                                                                                     work_dir=c["work_dir"]),
+                                                   args.n_samples, args.np)),
+        ("many_samples", lambda c: bench_sampler(c, ProcessPool(n_processes=args.np, work_dir=c["work_dir"]),
+                                                 args.n_many, args.np)),
+        ("process_run", lambda c: bench_process_run(c, args.n_samples, 1)),
+    ]
+    results = dict(host=socket.gethostname(),
+                   python=platform.python_version(),
+                   time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   parameters=vars(args),
+                   cases={})
+    try:
+        for name, bench in cases:
+            work_dir = os.path.join(base_dir, name)
+            os.makedirs(work_dir)
+            n = args.n_many if name == "many_samples" else args.n_samples
+            print("Benchmark {}...".format(name))
+            results["cases"][name] = bench(bench_config(work_dir, repo_dir, n))
+            print(json.dumps(results["cases"][name], indent=2))
+    finally:
+        if not args.keep:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results saved to ", args.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Stand-in of the Flow123d executable for benchmarks of the sampling pipeline.
+
+Accepts the command line used by endorse_2Dtest.call_flow:
+    fake_flow123d.py [--no_profiler] --output_dir <dir> <input.yaml>
+and writes the outputs the pipeline reads: flow_observe.yaml, mechanics_observe.yaml,
+flow123.0.log (with solver records) and VTK outputs (flow.pvd, mechanics.pvd) on a triangle mesh
+in the variant of the input (ascii, binary, binary_zlib).
+Observe points and output times are taken from the input file.
+
+Cost of the run is set by the environment:
+    FAKE_FLOW_SLEEP - sleep time [s], default 0
+    FAKE_FLOW_CPU - busy CPU time [s], default 0
+    FAKE_FLOW_RSS - allocated memory [MB], default 0
+    FAKE_FLOW_FAIL - return code, default 0
+"""
+import os
+import sys
+import time
+import zlib
+import argparse
+import numpy as np
+import yaml
+
+
+class _TagIgnoringLoader(yaml.SafeLoader):
+    """
+    Flow123d input uses tags of abstract records (!Coupling_Sequential, !Petsc, ...), they are ignored.
+    """
+
+
+def _construct_tagged(loader, tag_suffix, node):
+    if isinstance(node, yaml.MappingNode):
+        return loader.construct_mapping(node, deep=True)
+    if isinstance(node, yaml.SequenceNode):
+        return loader.construct_sequence(node, deep=True)
+    return loader.construct_scalar(node)
+
+
+_TagIgnoringLoader.add_multi_constructor("!", _construct_tagged)
+
+
+def output_times(times_input, end_time):
+    times = []
+    for rec in times_input:
+        times.extend(np.arange(rec["begin"], rec["end"], rec["step"]).tolist())
+    times.append(end_time)
+    return sorted(set(times))
+
+
+def burn_cpu(seconds):
+    end = time.process_time() + seconds
+    x = 0.0
+    while time.process_time() < end:
+        for i in range(10000):
+            x += i * 1e-9
+    return x
+
+
+def write_observe(fname, points, times, field, n_comp, scale, rng):
+    """
+    Observe output in the Flow123d format, one record per time.
+    """
+    with open(fname, "w") as f:
+        f.write("points:\n")
+        for p in points:
+            f.write("  - name: {}\n    observe_point: [{}, {}, {}]\n    region: box\n    element: 0\n"
+                    .format(p["name"], *p["point"]))
+        f.write("data:\n")
+        base = rng.uniform(-scale, scale, size=(len(points), n_comp))
+        for i, t in enumerate(times):
+            values = base * np.exp(-t / (times[-1] + 1)) + rng.normal(0, 1e-3 * scale, size=base.shape)
+            f.write("  - time: {}\n".format(t))
+            if n_comp == 1:
+                f.write("    {}: [{}]\n".format(field, ", ".join("{:.10g}".format(v) for v in values[:, 0])))
+            else:
+                f.write("    {}:\n".format(field))
+                for v in values:
+                    f.write("      - [{}]\n".format(", ".join("{:.10g}".format(c) for c in v)))
+
+
+def write_log(fname, times, rng):
+    with open(fname, "w") as f:
+        f.write("[0] sys_info.cc(1): Fake Flow123d\n")
+        for step, t in enumerate(times):
+            f.write("[0] time_governor.cc(1): TIME STEP {} time: {}\n".format(step, t))
+            n_hm = rng.integers(2, 6)
+            for it in range(1, n_hm + 1):
+                for eq in ["flow", "mechanics"]:
+                    f.write("[0] linsys_petsc.cc(1): {} convergence reason 2, number of iterations is {}\n"
+                            .format(eq, rng.integers(10, 200)))
+                f.write("[0] hm_iterative.cc(1): HM Iteration {} abs. difference: {:.3e}  rel. difference: {:.3e}\n"
+                        .format(it, 10.0 ** -it, 10.0 ** -it))
+            f.write("[0] assembly time: {:.4g}\n[0] solve time: {:.4g}\n".format(rng.uniform(0, 0.1), rng.uniform(0, 1)))
+
+
+def _vtu_header(variant):
+    attrs = 'type="UnstructuredGrid" version="1.0" byte_order="LittleEndian" header_type="UInt64"'
+    if variant == "binary_zlib":
+        attrs += ' compressor="vtkZLibDataCompressor"'
+    return '<?xml version="1.0"?>\n<VTKFile {}>\n<UnstructuredGrid>\n'.format(attrs)
+
+
+def _appended_block(values, variant):
+    """
+    Raw appended data of an array: UInt64 byte count and data, or the zlib block header and a single compressed block.
+    """
+    raw = np.ascontiguousarray(values).tobytes()
+    if variant != "binary_zlib":
+        return np.array([len(raw)], dtype="<u8").tobytes() + raw
+    compressed = zlib.compress(raw)
+    return np.array([1, len(raw), len(raw), len(compressed)], dtype="<u8").tobytes() + compressed
+
+
+def write_vtu(fname, points, cells, cell_type, cell_data=None, point_data=None, variant="ascii"):
+    """
+    Single piece VTU file in the Flow123d variants: ascii, binary (raw appended data)
+    and binary_zlib (zlib compressed appended data).
+    :param points: array (n_points, 3)
+    :param cells: array (n_cells, n_vertices), all cells of the same VTK type (5 - triangle, 9 - quad)
+    :param cell_data, point_data: dict name -> array (n_entities,) or (n_entities, n_comp)
+    """
+    vtk_types = {"f8": "Float64", "f4": "Float32", "i8": "Int64", "i4": "Int32", "u1": "UInt8"}
+    arrays = {"Points": [("Points", np.asarray(points, dtype="<f8"))],
+              "Cells": [("connectivity", np.asarray(cells, dtype="<i8").ravel()),
+                        ("offsets", cells.shape[1] * np.arange(1, len(cells) + 1, dtype="<i8")),
+                        ("types", np.full(len(cells), cell_type, dtype="u1"))],
+              "PointData": list((point_data or {}).items()),
+              "CellData": list((cell_data or {}).items())}
+    appended = []
+    offset = 0
+    with open(fname, "wb") as f:
+        f.write(_vtu_header(variant).encode())
+        f.write('<Piece NumberOfPoints="{}" NumberOfCells="{}">\n'.format(len(points), len(cells)).encode())
+        for section, section_arrays in arrays.items():
+            if not section_arrays:
+                continue
+            f.write("<{}>\n".format(section).encode())
+            for name, values in section_arrays:
+                values = np.asarray(values)
+                n_comp = values.shape[1] if values.ndim > 1 else 1
+                tag = '<DataArray type="{}" Name="{}" NumberOfComponents="{}"'.format(
+                    vtk_types[values.dtype.str.lstrip("<|")], name, n_comp)
+                if variant == "ascii":
+                    f.write('{} format="ascii">\n{}\n</DataArray>\n'.format(
+                        tag, " ".join("{:.10g}".format(v) for v in values.ravel())).encode())
+                else:
+                    f.write('{} format="appended" offset="{}"/>\n'.format(tag, offset).encode())
+                    appended.append(_appended_block(values, variant))
+                    offset += len(appended[-1])
+            f.write("</{}>\n".format(section).encode())
+        f.write(b"</Piece>\n</UnstructuredGrid>\n")
+        if appended:
+            f.write(b'<AppendedData encoding="raw">\n_')
+            for block in appended:
+                f.write(block)
+            f.write(b"\n</AppendedData>\n")
+        f.write(b"</VTKFile>\n")
+
+
+def square_mesh(n_side):
+    """
+    Unit square cells of the square [0, n_side]^2 in the plane z = 0.
+    :return: points (n_points, 3), quads (n_side ** 2, 4), triangles (2 * n_side ** 2, 3), two per quad
+    """
+    xy = np.stack(np.meshgrid(np.arange(n_side + 1), np.arange(n_side + 1), indexing="ij"), axis=-1).reshape(-1, 2)
+    points = np.hstack([xy, np.zeros((len(xy), 1))]).astype(float)
+    idx = np.arange((n_side + 1) ** 2).reshape(n_side + 1, n_side + 1)
+    quads = np.stack([idx[:-1, :-1], idx[1:, :-1], idx[1:, 1:], idx[:-1, 1:]], axis=-1).reshape(-1, 4)
+    return points, quads, np.concatenate([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]])
+
+
+def write_vtk(output_dir, name, times, fields, rng, n_cells=64, variant="ascii"):
+    """
+    VTU of a small triangle mesh per output time and the PVD collection.
+    :param fields: dict name -> number of components of the cell data
+    """
+    os.makedirs(os.path.join(output_dir, name), exist_ok=True)
+    points, quads, cells = square_mesh(int(np.sqrt(n_cells / 2)))
+    records = []
+    for i, t in enumerate(times):
+        vtu = "{}/{}-{:06d}.vtu".format(name, name, i)
+        cell_data = {field: rng.normal(size=(len(cells), n_comp)) for field, n_comp in fields.items()}
+        cell_data = {field: values if values.shape[1] > 1 else values[:, 0] for field, values in cell_data.items()}
+        write_vtu(os.path.join(output_dir, vtu), points, cells, 5, cell_data=cell_data, variant=variant)
+        records.append('<DataSet timestep="{}" group="" part="0" file="{}"/>'.format(t, vtu))
+    with open(os.path.join(output_dir, name + ".pvd"), "w") as f:
+        f.write('<?xml version="1.0"?>\n<VTKFile type="Collection" version="0.1" byte_order="LittleEndian">\n'
+                '<Collection>\n{}\n</Collection>\n</VTKFile>\n'.format("\n".join(records)))
+
+
+def main(arguments):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--no_profiler", action="store_true")
+    parser.add_argument("--output_dir", default="output")
+    parser.add_argument("input_file")
+    args = parser.parse_args(arguments)
+
+    with open(args.input_file, "r") as f:
+        problem = yaml.load(f, Loader=_TagIgnoringLoader)["problem"]
+    hm = problem["flow_equation"]
+    flow_output = hm["flow_equation"]["output"]
+    points = hm["flow_equation"]["output_stream"]["observe_points"]
+    times = output_times(flow_output["times"], hm["time"]["end_time"])
+
+    rss = bytearray(int(float(os.environ.get("FAKE_FLOW_RSS", 0)) * 2 ** 20))
+    burn_cpu(float(os.environ.get("FAKE_FLOW_CPU", 0)))
+    time.sleep(float(os.environ.get("FAKE_FLOW_SLEEP", 0)))
+
+    rng = np.random.default_rng(zlib.crc32(os.getcwd().encode()))
+    os.makedirs(args.output_dir, exist_ok=True)
+    write_log(os.path.join(args.output_dir, "flow123.0.log"), times, rng)
+    variant = (hm["flow_equation"]["output_stream"].get("format", None) or {}).get("variant", "ascii")
+    write_vtk(args.output_dir, "flow", times, {"pressure_p0": 1}, rng, variant=variant)
+    write_vtk(args.output_dir, "mechanics", times, {"displacement": 3, "stress": 9}, rng, variant=variant)
+    write_observe(os.path.join(args.output_dir, "flow_observe.yaml"), points, times, "pressure_p0", 1, 300, rng)
+    write_observe(os.path.join(args.output_dir, "mechanics_observe.yaml"), points, times, "displacement", 3, 1e-3, rng)
+    del rss
+    return int(os.environ.get("FAKE_FLOW_FAIL", 0))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
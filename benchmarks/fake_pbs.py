@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Stand-in of the PBS commands for local tests of the packed PBS pool (packed_pool.py).
+
+    fake_pbs.py qsub <job_script>       - start the script in background, print '<id>.fake-pbs'
+    fake_pbs.py qstat [-x] <id> ...     - PBS like table of the jobs, state R or F
+The walltime of the '#PBS -l walltime=' line is enforced: SIGTERM to the job, SIGKILL 10 s later.
+Output of the job goes to the file of the '#PBS -o' line.
+State of the jobs is kept in FAKE_PBS_DIR, default /tmp/fake_pbs_<uid>.
+
+Usage in config.yaml:
+    packed_pbs:
+      qsub: [python3, /path/to/benchmarks/fake_pbs.py, qsub]
+      qstat: [python3, /path/to/benchmarks/fake_pbs.py, qstat, -x]
+"""
+import os
+import re
+import sys
+import signal
+import subprocess
+
+STATE_DIR = os.environ.get("FAKE_PBS_DIR", "/tmp/fake_pbs_{}".format(os.getuid()))
+
+
+def parse_walltime(walltime):
+    seconds = 0
+    for part in walltime.split(":"):
+        seconds = 60 * seconds + float(part)
+    return seconds
+
+
+def state_file(job_id):
+    return os.path.join(STATE_DIR, "{}.state".format(job_id))
+
+
+def write_state(job_id, state):
+    with open(state_file(job_id) + ".tmp", "w") as f:
+        f.write(state)
+    os.replace(state_file(job_id) + ".tmp", state_file(job_id))
+
+
+def qsub(job_script):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    # new job id, O_EXCL makes concurrent qsub calls safe
+    job_id = len(os.listdir(STATE_DIR)) + 1
+    while True:
+        try:
+            os.close(os.open(state_file(job_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            job_id += 1
+    write_state(job_id, "Q")
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "supervise", str(job_id), os.path.abspath(job_script)],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+    print("{}.fake-pbs".format(job_id))
+    return 0
+
+
+def supervise(job_id, job_script):
+    with open(job_script, "r") as f:
+        script = f.read()
+    match = re.search(r"^#PBS -l walltime=(\S+)", script, re.MULTILINE)
+    walltime = parse_walltime(match.group(1)) if match else None
+    match = re.search(r"^#PBS -o (\S+)", script, re.MULTILINE)
+    output = match.group(1) if match else os.path.join(STATE_DIR, "{}.OU".format(job_id))
+
+    write_state(job_id, "R")
+    with open(output, "w") as out:
+        process = subprocess.Popen(["bash", job_script], stdout=out, stderr=subprocess.STDOUT,
+                                   cwd=os.path.dirname(job_script), start_new_session=True)
+        try:
+            process.wait(timeout=walltime)
+        except subprocess.TimeoutExpired:
+            out.write("=>> PBS: job killed: walltime exceeded limit\n")
+            out.flush()
+            os.killpg(process.pid, signal.SIGTERM)
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+    write_state(job_id, "F")
+    return 0
+
+
+def qstat(arguments):
+    job_ids = [a.split(".")[0] for a in arguments if not a.startswith("-")]
+    print("Job id            Name             User              Time Use S Queue")
+    print("----------------  ---------------- ----------------  -------- - -----")
+    status = 0
+    for job_id in job_ids:
+        try:
+            with open(state_file(job_id), "r") as f:
+                state = f.read().strip() or "Q"
+        except FileNotFoundError:
+            print("qstat: Unknown Job Id {}.fake-pbs".format(job_id), file=sys.stderr)
+            status = 153
+            continue
+        print("{:<17} {:<16} {:<17} {:>8} {} {}".format(job_id + ".fake-pbs", "packed", "user", "00:00:00",
+                                                       state, "fake"))
+    return status
+
+
+if __name__ == "__main__":
+    command = sys.argv[1]
+    if command == "qsub":
+        sys.exit(qsub(sys.argv[2]))
+    elif command == "supervise":
+        sys.exit(supervise(sys.argv[2], sys.argv[3]))
+    elif command == "qstat":
+        sys.exit(qstat(sys.argv[2:]))
+    else:
+        print(__doc__)
+        sys.exit(1)
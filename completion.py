@@ -0,0 +1,116 @@
+import os
+import time
+import threading
+
+from mlmc.sampling_pool import ProcessPool
+
+
+class CompletionJournal:
+    """
+    Append-only journal of finished samples, one line 'sample_id' per sample.
+    Writers (workers of any node) append whole lines by a single write in O_APPEND mode,
+    the reader keeps its offset and reads only the new lines, waiting for new records costs one stat of the file.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        # end of the last complete line read
+        self.offset = 0
+
+    def append(self, sample_ids):
+        """
+        :param sample_ids: list of finished sample ids
+        """
+        data = "".join(sample_id + "\n" for sample_id in sample_ids).encode()
+        fd = os.open(self.fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def size(self):
+        try:
+            return os.stat(self.fname).st_size
+        except FileNotFoundError:
+            return 0
+
+    def read_new(self):
+        """
+        :return: sample ids appended since the last call
+        """
+        if self.size() <= self.offset:
+            return []
+        with open(self.fname, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        # a line being written is left for the next call
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        return data[:end].decode().split()
+
+    def wait(self, timeout, poll_interval=0.5):
+        """
+        Wait until there are new records or timeout.
+        :return: True if there are new records
+        """
+        end_time = time.monotonic() + timeout
+        while self.size() <= self.offset:
+            remaining = end_time - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(poll_interval, remaining))
+        return True
+
+
+class NotifyingProcessPool(ProcessPool):
+    """
+    ProcessPool which wakes up the waiting main process when a sample is finished (see wait_finished).
+    """
+
+    def __init__(self, n_processes, work_dir=None, debug=False):
+        self._finished_event = threading.Event()
+        super().__init__(n_processes, work_dir=work_dir, debug=debug)
+
+    def res_callback(self, result, level_sim):
+        super().res_callback(result, level_sim)
+        self._finished_event.set()
+
+    def wait_finished(self, timeout):
+        """
+        Wait until a sample is finished or timeout.
+        :return: True if some sample finished
+        """
+        finished = self._finished_event.wait(timeout)
+        self._finished_event.clear()
+        return finished
+
+
+def wait_for_samples(sampler, sampling_pool, timeout=None, max_wait=60, stop=None):
+    """
+    Store finished samples as soon as the sampling pool reports them. Pools with 'wait_finished'
+    (NotifyingProcessPool, SamplingPoolPackedPBS) are asked only after a completion notification
+    or after 'max_wait', the other pools are polled every 'max_wait' seconds.
+    :param sampler: mlmc.Sampler
+    :param sampling_pool: sampling pool of the sampler
+    :param timeout: maximal waiting time [s], None - until all samples are finished
+    :param max_wait: maximal time between two queries of the pool [s]
+    :param stop: function called after each query, waiting ends if it returns True
+    :return: number of running samples
+    """
+    start = time.monotonic()
+    while True:
+        # a single query of the pool
+        n_running = sampler.ask_sampling_pool_for_samples(sleep=0, timeout=1e-9)
+        if n_running == 0 or (stop is not None and stop()):
+            return n_running
+        wait = max_wait
+        if timeout:
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                return n_running
+            wait = min(wait, remaining)
+        if hasattr(sampling_pool, "wait_finished"):
+            sampling_pool.wait_finished(wait)
+        else:
+            time.sleep(wait)
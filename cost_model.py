@@ -0,0 +1,128 @@
+import os
+import numpy as np
+import ruamel.yaml as yaml
+
+import aux_storage
+from stage_timer import StageTimer
+
+# fitted model in the work dir, it is kept between runs
+COST_MODEL_FILE = "cost_model.yaml"
+
+
+def measured_runs(work_dir):
+    """
+    Flow123d runs and samples recorded in the aux dir of the work dir (see aux_storage).
+    :return: runs - list of (mesh_step, n_elements, wall_time) of the fine and coarse runs,
+             overheads - list of sample wall times not spent in Flow123d
+    """
+    aux_dir = os.path.join(work_dir, aux_storage.AUX_DIR)
+    runs = []
+    overheads = []
+    if not os.path.isdir(aux_dir):
+        return runs, overheads
+    for sample in sorted(e.name for e in os.scandir(aux_dir) if e.is_dir()):
+        for fname in [aux_storage.RUN_STATS_FILE, "coarse_" + aux_storage.RUN_STATS_FILE]:
+            path = os.path.join(aux_dir, sample, fname)
+            if not os.path.isfile(path):
+                continue
+            with open(path, "r") as f:
+                stats = yaml.safe_load(f) or {}
+            if stats.get("returncode", None) != 0 or not stats.get("n_elements", None) or not stats.get("mesh_step", None):
+                continue
+            runs.append((float(stats["mesh_step"]), float(stats["n_elements"]), float(stats["wall_time"])))
+
+        path = os.path.join(aux_dir, sample, aux_storage.STAGE_TIMES_FILE)
+        if os.path.isfile(path):
+            records = StageTimer.load(path)
+            if any(rec["stage"] == "flow123d" for rec in records):
+                overheads.append(sum(rec["wall"] for rec in records if rec["stage"] != "flow123d"))
+    return runs, overheads
+
+
+class CostModel:
+    """
+    Wall time of a sample predicted from the mesh:
+        Flow123d run: a * n_elements ** b
+        number of elements of a mesh step: mean of the measured meshes, power law fit for other steps
+        sample: overhead + fine run + coarse run
+    """
+
+    def __init__(self, a, b, overhead=0.0, mesh_steps=None, n_elements=None, n_runs=0):
+        self.a = a
+        self.b = b
+        # mean sample time out of Flow123d (meshing, extraction, ...)
+        self.overhead = overhead
+        # measured mesh steps and mean numbers of elements of their meshes
+        self.mesh_steps = list(mesh_steps or [])
+        self.n_elements = list(n_elements or [])
+        # number of runs the model is fitted to
+        self.n_runs = n_runs
+
+    @staticmethod
+    def fit(work_dir, exponent=1.0):
+        """
+        Fit the model to the samples finished so far.
+        :param work_dir: work directory with the aux dir
+        :param exponent: exponent b used if the runs do not span different mesh sizes
+        :return: CostModel, None if there is no finished run
+        """
+        runs, overheads = measured_runs(work_dir)
+        if len(runs) == 0:
+            return None
+        steps, n_el, times = np.array(runs).T
+        times = np.maximum(times, 1e-3)
+        if n_el.max() > 1.1 * n_el.min():
+            b, log_a = np.polyfit(np.log(n_el), np.log(times), 1)
+            a = np.exp(log_a)
+        else:
+            b = exponent
+            a = np.mean(times / n_el ** b)
+        mesh_steps = np.unique(steps)
+        n_elements = [float(np.mean(n_el[steps == h])) for h in mesh_steps]
+        overhead = float(np.mean(overheads)) if overheads else 0.0
+        return CostModel(float(a), float(b), overhead, mesh_steps.tolist(), n_elements, len(runs))
+
+    def mesh_n_elements(self, mesh_step):
+        """
+        Predicted number of elements of the mesh with given tunnel_mesh_step,
+        n ~ mesh_step ** -2 if there is a single measured step.
+        """
+        steps = np.array(self.mesh_steps)
+        n_el = np.array(self.n_elements)
+        match = np.isclose(steps, mesh_step)
+        if np.any(match):
+            return float(n_el[match][0])
+        if len(steps) > 1:
+            slope, intercept = np.polyfit(np.log(steps), np.log(n_el), 1)
+        else:
+            slope, intercept = -2.0, np.log(n_el[0]) + 2.0 * np.log(steps[0])
+        return float(np.exp(intercept + slope * np.log(mesh_step)))
+
+    def flow_time(self, n_elements):
+        return self.a * n_elements ** self.b
+
+    def sample_cost(self, fine_step, coarse_step=None):
+        """
+        Predicted wall time of a sample [s].
+        :param fine_step: tunnel_mesh_step of the fine simulation
+        :param coarse_step: tunnel_mesh_step of the coarse simulation, None - no coarse simulation
+        """
+        cost = self.overhead + self.flow_time(self.mesh_n_elements(fine_step))
+        if coarse_step is not None:
+            cost += self.flow_time(self.mesh_n_elements(coarse_step))
+        return cost
+
+    def save(self, fname):
+        with open(fname, "w") as f:
+            yaml.safe_dump(dict(a=self.a, b=self.b, overhead=self.overhead, mesh_steps=self.mesh_steps,
+                                n_elements=self.n_elements, n_runs=self.n_runs), f)
+
+    @staticmethod
+    def load(fname):
+        """
+        :return: CostModel, None if the file does not exist
+        """
+        if not os.path.isfile(fname):
+            return None
+        with open(fname, "r") as f:
+            return CostModel(**yaml.safe_load(f))
@@ -0,0 +1,92 @@
+import os
+import time
+import contextlib
+
+from mesh_cache import file_lock
+
+
+def available_cpus():
+    """
+    CPUs the process may run on (respects cgroup/taskset restrictions).
+    :return: sorted list of CPU ids
+    """
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count()))
+
+
+def available_memory():
+    """
+    Memory available for new processes [MB], None if unknown.
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def cpu_sets(cpus, flow_np):
+    """
+    Split CPUs into disjoint sets of 'flow_np' CPUs, one set per concurrent sample.
+    """
+    if len(cpus) < flow_np:
+        raise Exception("Flow123d needs {} CPUs (local: flow_np), only {} available: {}".format(
+            flow_np, len(cpus), list(cpus)))
+    n_slots = len(cpus) // flow_np
+    return [cpus[i * flow_np:(i + 1) * flow_np] for i in range(n_slots)]
+
+
+def local_concurrency(local_config, cpus=None):
+    """
+    Number of concurrent samples of a local run according to the 'local' section of config.yaml:
+        np - number of concurrent samples, 'auto' - as many as CPUs and memory allow, otherwise the upper limit
+        flow_np - number of MPI processes of a single Flow123d run
+        sample_memory - memory of a single sample [MB]
+    :return: number of concurrent samples, at least 1; raises if there are fewer CPUs than flow_np
+    """
+    if cpus is None:
+        cpus = available_cpus()
+    flow_np = local_config.get("flow_np", 1)
+    n = len(cpu_sets(cpus, flow_np))
+    sample_memory = local_config.get("sample_memory", None)
+    memory = available_memory()
+    if sample_memory and memory is not None:
+        n = min(n, max(int(memory // sample_memory), 1))
+    np_limit = local_config.get("np", 1)
+    if np_limit != "auto":
+        n = min(n, int(np_limit))
+    return n
+
+
+@contextlib.contextmanager
+def cpu_slot(slot_dir, cpus, flow_np, wait=1):
+    """
+    Acquire a free CPU set, free slots are found by non-blocking locks <slot_dir>/slot_<i>.lock,
+    so concurrent samples (even of different runs sharing the slot_dir) never get the same CPUs.
+    The calling process is pinned to the CPU set while the slot is held, child processes (Flow123d) inherit it.
+    :param slot_dir: directory of the lock files
+    :param cpus: all CPUs to use
+    :param flow_np: size of the CPU set
+    :param wait: time between attempts if all slots are taken [s]
+    :return: yields the CPU set
+    """
+    os.makedirs(slot_dir, mode=0o775, exist_ok=True)
+    sets = cpu_sets(cpus, flow_np)
+    while True:
+        for i, cpu_set in enumerate(sets):
+            with file_lock(os.path.join(slot_dir, "slot_{:03d}.lock".format(i)), blocking=False) as acquired:
+                if not acquired:
+                    continue
+                orig_affinity = os.sched_getaffinity(0)
+                os.sched_setaffinity(0, cpu_set)
+                try:
+                    yield cpu_set
+                finally:
+                    os.sched_setaffinity(0, orig_affinity)
+                return
+        time.sleep(wait)
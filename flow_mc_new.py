@@ -1,8 +1,8 @@
 import os
-import subprocess
 import numpy as np
 import itertools
 import collections
+import contextlib
 import shutil
 import csv
 import ruamel.yaml as yaml
@@ -17,7 +17,19 @@ from mlmc.level_simulation import LevelSimulation
 from mlmc.sim.simulation import Simulation
 from mlmc.sim.simulation import QuantitySpec
 
-import matplotlib.pyplot as plt
+from mesh_cache import MeshCache
+from mesh_repository import MeshRepository, read_msh_info
+from observe import load_observe, align_times
+import template
+import flow_runner
+import solver_log
+import aux_storage
+import cpu_slots
+import cost_model
+import retention
+import scratch
+import vtk_fields
+from stage_timer import StageTimer, stage
 
 
 def force_mkdir(path, force=False):
@@ -34,31 +46,34 @@ def force_mkdir(path, force=False):
     os.makedirs(path, mode=0o775, exist_ok=True)
 
 
-def substitute_placeholders(file_in, file_out, params):
-    """
-    Substitute for placeholders of format '<name>' from the dict 'params'.
-    :param file_in: Template file.
-    :param file_out: Values substituted.
-    :param params: { 'name': value, ...}
-    """
-    used_params = []
-    with open(file_in, 'r') as src:
-        text = src.read()
-    for name, value in params.items():
-        placeholder = '<%s>' % name
-        n_repl = text.count(placeholder)
-        if n_repl > 0:
-            used_params.append(name)
-            text = text.replace(placeholder, str(value))
-    with open(file_out, 'w') as dst:
-        dst.write(text)
-    return used_params
-
-
 class endorse_2Dtest(Simulation):
 
     zero_temperature_offset = 273.15
 
+    # meshing and healing options, can be overridden by 'mesh_options' in config.yaml
+    # all of them are part of the mesh cache key
+    default_mesh_options = dict(
+        geometry_tolerance=0.0001,
+        geometry_tolerance_boolean=0.001,
+        tolerance_initial_delaunay=0.01,
+        min_circle_points=6,
+        min_curve_points=2,
+        heal_node_tol=1e-4,
+        heal_gamma_tol=0.01
+    )
+
+    # collected quantities: (name, unit, number of components, observe file, observed field)
+    observe_quantities = [
+        ("pressure", "m", 1, "flow_observe.yaml", "pressure_p0"),
+        ("displacement", "m", 3, "mechanics_observe.yaml", "displacement")
+    ]
+    # QoIs of the full VTK output (see vtk_fields.tunnel_qois): name, unit, value per ring
+    field_quantities = [
+        ("pressure_drawdown", "m", True),
+        ("ring_stress", "Pa", True),
+        ("max_displacement", "m", False)
+    ]
+
     def __init__(self, config, clean):
         super(endorse_2Dtest, self).__init__()
 
@@ -81,6 +96,10 @@ class endorse_2Dtest(Simulation):
 
         config = self._config.copy()
 
+        # MLMC level given by tunnel_mesh_step, there is no coarse simulation on the first level (zero parameter)
+        config["fine"] = dict(tunnel_mesh_step=fine_level_params[0])
+        config["coarse"] = dict(tunnel_mesh_step=coarse_level_params[0]) if coarse_level_params[0] > 0 else None
+
         # Set fine simulation common files directory
         # Files in the directory are used by each simulation at that level
         common_files_dir = os.path.join(self.work_dir, "common_files")
@@ -91,25 +110,88 @@ class endorse_2Dtest(Simulation):
         for f in config["copy_files"]:
             shutil.copyfile(os.path.join(config["script_dir"], f), os.path.join(common_files_dir, f))
 
+        # VTK output of the campaign profile, audit samples switch to the full profile (see calculate_levels)
+        config["hm_params"] = dict(config["hm_params"], **endorse_2Dtest.output_params(config))
+
+        # templates are compiled once and shipped to the samples
+        config["templates"] = {}
+        for param_key in ["hm_params"]:
+            config["templates"][param_key] = endorse_2Dtest.compile_template(config, param_key)
+
+        # index of the mesh repository, loaded once and shipped to the samples
+        mesh_repo = config.get('mesh_repository', None)
+        if mesh_repo:
+            repository = MeshRepository(mesh_repo, config.get('mesh_repository_index', None))
+            config["mesh_repository_entries"] = repository.load_index()
+            if len(config["mesh_repository_entries"]) == 0:
+                raise Exception("No meshes in mesh repository: {}".format(mesh_repo))
+            if config["coarse"] is not None:
+                raise Exception("Mesh repository can not be used with more MLMC levels.")
+
         return LevelSimulation(config_dict=config,
                                # task_size=len(fine_mesh_data['points']),
-                               task_size=config["task_size"],
+                               task_size=endorse_2Dtest.task_size(config),
                                calculate=endorse_2Dtest.calculate,
                                # method which carries out the calculation, will be called from PBS processs
                                need_sample_workspace=True  # If True, a sample directory is created
                                )
 
-    def result_format(self) -> List[QuantitySpec]:
+    @staticmethod
+    def task_size(config):
         """
-        Overrides Simulation.result_format
-        :return:
+        Predicted cost of a sample of the level as a fraction of a PBS job (cost_model.job_time).
+        The model fitted to the finished samples of the work dir is used, before the first fit the model
+        of a previous campaign (cost_model.file); the constant 'task_size' is used if there is none (see cost_model).
+        :param config: level configuration (see level_instance)
+        :return: float
         """
-        # create simple instance of QuantitySpec for each quantity we want to collect
-        # the time vector of the data must be specified here!
+        cost_config = config.get("cost_model", None) or {}
+        if not cost_config.get("enabled", False):
+            return config["task_size"]
+        model = cost_model.CostModel.load(os.path.join(config["work_dir"], cost_model.COST_MODEL_FILE))
+        if model is None and cost_config.get("file", None):
+            model = cost_model.CostModel.load(os.path.join(config["script_dir"], cost_config["file"]))
+        if model is None:
+            return config["task_size"]
+        coarse_step = config["coarse"]["tunnel_mesh_step"] if config["coarse"] is not None else None
+        cost = model.sample_cost(config["fine"]["tunnel_mesh_step"], coarse_step)
+        return cost / cost_config["job_time"]
+
+    @staticmethod
+    def output_params(config_dict, audit=False):
+        """
+        Template parameters of the VTK output given by the output profile ('output' in config.yaml),
+        a field subset with its own times is written as records {field, times}.
+        :param audit: audit sample, the 'full' profile is used
+        :return: dict(flow_output_fields=[...], mechanics_output_fields=[...])
+        """
+        output = config_dict.get("output", None) or {}
+        profile_name = "full" if audit else output.get("profile", "full")
+        profile = output["profiles"][profile_name]
+        times = profile.get("times", None)
+        params = {}
+        for equation in ["flow", "mechanics"]:
+            fields = profile[equation + "_fields"]
+            if times is not None:
+                fields = [dict(field=field, times=times) for field in fields]
+            params[equation + "_output_fields"] = fields
+
+        if (config_dict.get("field_qois", None) or {}).get("enabled", False):
+            missing = {"pressure_p0"} - set(profile["flow_fields"])
+            missing |= {"displacement", "stress"} - set(profile["mechanics_fields"])
+            if missing:
+                raise Exception("Fields {} of field_qois are not in output profile '{}'.".format(
+                    sorted(missing), profile_name))
+        return params
 
-        # read output times
+    @staticmethod
+    def output_times(config_dict):
+        """
+        Time axis of the results given by 'output_times' in config.yaml.
+        :return: list of times [d]
+        """
         times = []
-        output_times = self._config["output_times"]
+        output_times = config_dict["output_times"]
         for rec in output_times:
             start = rec["begin"]
             step = rec["step"]
@@ -117,21 +199,32 @@ class endorse_2Dtest(Simulation):
             for t in np.arange(start, end, step):
                 times.append(int(t))
         times.append(output_times[-1]["end"])
+        return times
 
-        # create quantity spec
+    @staticmethod
+    def quantity_specs(config_dict) -> List[QuantitySpec]:
+        times = endorse_2Dtest.output_times(config_dict)
+        points = config_dict["extract"]["observe_points"]
         spec = []
-        spec.append(QuantitySpec(name="none", unit="", shape=(1, 1), times=times, locations=['none']))
-        # spec.append(QuantitySpec(name="tunnel_flux", unit="m.s-2", shape=(1, 1), times=times, locations=['.tunnel']))
-        # spec.append(QuantitySpec(name="avg_temp_02", unit="C", shape=(1, 1), times=times, locations=['.well']))
-        # spec.append(QuantitySpec(name="power_02", unit="J", shape=(1, 1), times=times, locations=['.well']))
-        # spec.append(QuantitySpec(name="avg_temp_03", unit="C", shape=(1, 1), times=times, locations=['.well']))
-        # spec.append(QuantitySpec(name="power_03", unit="J", shape=(1, 1), times=times, locations=['.well']))
-        # spec.append(QuantitySpec(name="avg_temp_04", unit="C", shape=(1, 1), times=times, locations=['.well']))
-        # spec.append(QuantitySpec(name="power_04", unit="J", shape=(1, 1), times=times, locations=['.well']))
-        # spec.append(QuantitySpec(name="n_fracture_elements", unit="-", shape=(1, 1), times=[0], locations=['-']))
-        # spec.append(QuantitySpec(name="n_contact_elements", unit="-", shape=(1, 1), times=[0], locations=['-']))
+        for name, unit, n_comp, observe_file, field in endorse_2Dtest.observe_quantities:
+            spec.append(QuantitySpec(name=name, unit=unit, shape=(n_comp, 1), times=times, locations=points))
+        field_qois = config_dict.get("field_qois", None) or {}
+        if field_qois.get("enabled", False):
+            n_rings = len(field_qois["rings"]) - 1
+            for name, unit, ring_values in endorse_2Dtest.field_quantities:
+                shape = (n_rings, 1) if ring_values else (1, 1)
+                spec.append(QuantitySpec(name=name, unit=unit, shape=shape, times=times, locations=["tunnel"]))
         return spec
 
+    def result_format(self) -> List[QuantitySpec]:
+        """
+        Overrides Simulation.result_format
+        :return:
+        """
+        # create simple instance of QuantitySpec for each quantity we want to collect
+        # the time vector of the data must be specified here!
+        return endorse_2Dtest.quantity_specs(self._config)
+
     @staticmethod
     def calculate(config_dict, seed):
         """
@@ -155,128 +248,294 @@ class endorse_2Dtest(Simulation):
         if config_dict["collect_only"]:
             return endorse_2Dtest.collect_results(config_dict)
 
+        # stages of the sample are timed, records are kept in the aux dir of work_dir (see aux_storage)
+        StageTimer.current = StageTimer()
+        try:
+            # optionally in node local scratch, only the result files are synchronized back (see scratch)
+            with endorse_2Dtest.cpu_slot(config_dict), scratch.sample_scratch(config_dict):
+                result = endorse_2Dtest.calculate_levels(config_dict, seed)
+                # results are extracted, the sample directory is compacted (see retention)
+                if (config_dict.get("retention", None) or {}).get("enabled", False):
+                    retention.compact_sample(config_dict, seed)
+        finally:
+            StageTimer.current.save(endorse_2Dtest.stage_times_file)
+            StageTimer.current = None
+            if config_dict.get("work_dir", None) is not None:
+                aux_storage.save_sample_aux(config_dict["work_dir"])
+        return result
+
+    @staticmethod
+    def cpu_slot(config_dict):
+        """
+        Pin the sample (and Flow123d) to its own set of CPUs in a local parallel run, see cpu_slots.cpu_slot.
+        :return: context manager
+        """
+        local = config_dict["local"]
+        cpus = config_dict.get("_local_cpus", None)
+        if cpus is None or not local.get("pin_cpus", False):
+            return contextlib.nullcontext()
+        slot_dir = local.get("cpu_slot_dir", None) or os.path.join(config_dict["work_dir"], "cpu_slots")
+        return cpu_slots.cpu_slot(slot_dir, cpus, local.get("flow_np", 1))
+
+    # subdirectory of the sample directory with the coarse simulation
+    coarse_dir = aux_storage.COARSE_DIR
+
+    @staticmethod
+    def calculate_levels(config_dict, seed):
+        """
+        Fine and coarse simulation of a sample, the coarse one runs in the subdirectory 'coarse'.
+        Both simulations draw the same random inputs, the random generator is reset by the seed before each of them.
+        Audit samples (see retention.is_audit_sample) write the full VTK output.
+        :return: List[fine result, coarse result], zero coarse result on the first level
+        """
+        if retention.is_audit_sample(seed, config_dict.get("audit_fraction", 0)):
+            print("Audit sample, full output")
+            config_dict = dict(config_dict, hm_params=dict(config_dict["hm_params"],
+                                                           **endorse_2Dtest.output_params(config_dict, audit=True)))
+        np.random.seed(seed)
+        fine = endorse_2Dtest.calculate_stages(endorse_2Dtest.level_config(config_dict, config_dict["fine"]))
+        if config_dict["coarse"] is None:
+            return [fine, np.zeros_like(fine)]
+
+        print("Coarse simulation...")
+        force_mkdir(endorse_2Dtest.coarse_dir, force=True)
+        os.chdir(endorse_2Dtest.coarse_dir)
+        try:
+            np.random.seed(seed)
+            coarse = endorse_2Dtest.calculate_stages(endorse_2Dtest.level_config(config_dict, config_dict["coarse"]))
+        finally:
+            os.chdir("..")
+        return [fine, coarse]
+
+    @staticmethod
+    def level_config(config_dict, level_geometry):
+        """
+        Configuration of the fine or the coarse simulation of a sample, the random parameters are drawn here.
+        :param level_geometry: geometry parameters of the level, e.g. dict(tunnel_mesh_step=...)
+        :return: shallow copy of config_dict
+        """
+        config = config_dict.copy()
+        config["geometry"] = dict(config_dict["geometry"], **(level_geometry or {}))
+        config["hm_params"] = dict(config_dict["hm_params"], **endorse_2Dtest.sample_random_params(config_dict))
+        return config
+
+    @staticmethod
+    def sample_random_params(config_dict):
+        """
+        Draw the random parameters of the model given by 'random_params' in config.yaml.
+        :return: dict parameter name -> value
+        """
+        params = {}
+        for name, spec in (config_dict.get("random_params", None) or {}).items():
+            distr = spec["distr"]
+            if distr == "normal":
+                value = np.random.normal(spec["mean"], spec["std"])
+            elif distr == "lognormal":
+                value = np.exp(np.random.normal(spec["mean"], spec["std"]))
+            elif distr == "uniform":
+                value = np.random.uniform(spec["a"], spec["b"])
+            else:
+                raise Exception("Unknown distribution '{}' of random parameter '{}'.".format(distr, name))
+            params[name] = float(value)
+        return params
+
+    @staticmethod
+    def calculate_stages(config_dict):
+        """
+        Mesh, Flow123d run and extraction of the results of a single simulation.
+        :return: result, flat array
+        """
         mesh_repo = config_dict.get('mesh_repository', None)
 
         print("Creating mesh...")
         if mesh_repo:
-            comp_mesh = endorse_2Dtest.sample_mesh_repository(mesh_repo)
+            with stage("mesh"):
+                comp_mesh = endorse_2Dtest.sample_mesh_repository(config_dict)
         else:
             # comp_mesh = endorse_2Dtest.prepare_mesh(config_dict, cut_tunnel=False)
             comp_mesh = endorse_2Dtest.prepare_mesh(config_dict, cut_tunnel=True)
 
-            mesh_bn = os.path.basename(comp_mesh)
-            config_dict["hm_params"]["mesh"] = mesh_bn
+        mesh_bn = os.path.basename(comp_mesh)
+        config_dict["hm_params"]["mesh"] = mesh_bn
 
         # endorse_2Dtest.read_physical_names(config_dict, comp_mesh)
         print("Creating mesh...finished")
 
         if config_dict["mesh_only"]:
-            return endorse_2Dtest.empty_result()
+            return endorse_2Dtest.empty_result(config_dict)[0]
+
+        # size of the mesh scales the time limit of the run
+        if "mesh_n_elements" not in config_dict:
+            config_dict["mesh_n_elements"] = read_msh_info(comp_mesh)["n_elements"]
 
         # endorse_2Dtest.prepare_hm_input(config_dict)
         print("Running Flow123d - HM...")
-        hm_succeed = endorse_2Dtest.call_flow(config_dict, 'hm_params', result_files=["flow_observe.yaml"])
+        hm_succeed = endorse_2Dtest.call_flow(config_dict, 'hm_params', result_files=endorse_2Dtest.hm_result_files)
         if not hm_succeed:
             raise Exception("HM model failed.")
         print("Running Flow123d - HM...finished")
 
-        endorse_2Dtest.observe_time_plot(config_dict)
+        # plots are made in batch after the campaign (process.py plot), in the sample only on request
+        if config_dict.get("plot_in_sample", False):
+            with stage("plot"):
+                endorse_2Dtest.observe_time_plot(config_dict)
 
         print("Finished computation")
 
-        return endorse_2Dtest.collect_results(config_dict)
+        with stage("extract"):
+            return endorse_2Dtest.extract_results(config_dict)
 
     @staticmethod
-    def check_data(data, minimum, maximum):
-        n_times = len(endorse_2Dtest.result_format()[0].times)
-        if len(data) != n_times:
-            raise Exception("Data not corresponding with time axis.")
-
+    def check_data(data, minimum=None, maximum=None):
+        """
+        Fail the sample on NaN values or values out of the given range, None - the bound is not checked.
+        """
         if np.isnan(np.sum(data)):
             raise Exception("NaN present in extracted data.")
 
         min = np.amin(data)
-        if min < minimum:
+        if minimum is not None and min < minimum:
             raise Exception("Data out of given range [min].")
         max = np.amax(data)
-        if max > maximum:
+        if maximum is not None and max > maximum:
             raise Exception("Data out of given range [max].")
 
     @staticmethod
     def collect_results(config_dict):
-        # filenames = ["energy_balance.yaml",
-        #              "water_balance.yaml",
-        #              "Heat_AdvectionDiffusion_region_stat.yaml"]
-        #
-        # print("Extracting results...")
-        # # read regions of interest
-        # # bc_regions = ['.fr_left_well', '.left_well', '.fr_right_well', '.right_well']
-        # # out_regions = bc_regions[2:]
-        # with open("regions.yaml", 'r') as f:
-        #     regions_dict = yaml.load(f, yaml.CSafeLoader)
-        #     bc_regions = [*regions_dict["left_well_fracture_regions"], *regions_dict["right_well_fracture_regions"]]
-        #     out_regions = regions_dict["right_well_fracture_regions"]
-        #
-        # n_times = 0
-        # result = []
-        # for variant in config_dict["variants"]:
-        #     print("collecting TH - variant '{}'...".format(variant))
-        #     config_dict[variant]["output_dir"] = "output_" + config_dict[variant]["in_file"]
-        #
-        #     result_files = list()
-        #     result_files.extend([os.path.join(config_dict[variant]["output_dir"], f) for f in filenames])
-        #     files_present = all([os.path.isfile(f) for f in result_files])
-        #     if not files_present:
-        #         raise Exception("Not all result files present.")
-        #     avg_temp, power = endorse_2Dtest.extract_th_results(config_dict[variant]["output_dir"],
-        #                                                           out_regions, bc_regions)
-        #     n_times=len(power)
-        #     endorse_2Dtest.check_data(avg_temp, config_dict["extract"]["temp_min"],
-        #                                 config_dict["extract"]["temp_max"])
-        #     endorse_2Dtest.check_data(power, config_dict["extract"]["power_min"],
-        #                                 config_dict["extract"]["power_max"])
-        #
-        #     result.extend(avg_temp)
-        #     result.extend(power)
-        #
-        # fr_file = "fr_param_stats.yaml"
-        # if os.path.isfile(fr_file):
-        #     with open(fr_file, 'r') as f:
-        #         fr_param_dict = yaml.load(f, yaml.CSafeLoader)
-        #         result.extend([fr_param_dict["n_fracture_elements"]]*n_times)
-        #         result.extend([fr_param_dict["n_contact_elements"]]*n_times)
-        # else:
-        #     raise Exception("Fracture stats file '{}' not present.".format(fr_file))
-        #
-        # print("Extracting results...finished")
-        return endorse_2Dtest.empty_result()
-        # return [result, result]
+        """
+        Extract results of already computed fine and coarse simulations of the sample.
+        :return: [fine result, coarse result]
+        """
+        fine = endorse_2Dtest.extract_results(config_dict)
+        if config_dict.get("coarse", None) is None:
+            return [fine, np.zeros_like(fine)]
+        os.chdir(endorse_2Dtest.coarse_dir)
+        try:
+            coarse = endorse_2Dtest.extract_results(config_dict)
+        finally:
+            os.chdir("..")
+        return [fine, coarse]
 
     @staticmethod
-    def empty_result():
-        return [[np.random.normal()], [np.random.normal()]]
+    def extract_results(config_dict):
+        """
+        Extract observed quantities of the HM model, aligned to the time axis of result_format.
+        The program is in the directory of the simulation.
+        :return: flat array ordered as (quantity, time, location, component)
+        """
+        print("Extracting results...")
+        output_dir = "output_" + config_dict["hm_params"]["in_file"]
+        extract = config_dict["extract"]
+        times = np.array(endorse_2Dtest.output_times(config_dict), dtype=float)
+        points = extract["observe_points"]
+
+        result = []
+        for name, unit, n_comp, observe_file, field in endorse_2Dtest.observe_quantities:
+            observe = load_observe(os.path.join(output_dir, observe_file), [field], n_times_hint=len(times))
+            point_idx = [observe["point_names"].index(p) for p in points]
+            values = observe[field][point_idx]
+            observe_times = observe["times"] / extract.get("time_scale", 1)
+            # (n_points, n_times, n_comp) -> (n_times, n_points, n_comp)
+            values = align_times(observe_times, values, times).transpose(1, 0, 2)
+            endorse_2Dtest.check_data(values, extract.get(name + "_min", None), extract.get(name + "_max", None))
+            result.append(values.ravel())
+
+        field_qois = config_dict.get("field_qois", None) or {}
+        if field_qois.get("enabled", False):
+            qois = vtk_fields.tunnel_qois(output_dir, config_dict["geometry"], field_qois["rings"])
+            for name, unit, ring_values in endorse_2Dtest.field_quantities:
+                qoi_times, values = qois[name]
+                qoi_times = qoi_times / extract.get("time_scale", 1)
+                # (n_times, n_values) -> (n_times, 1 location, n_values)
+                values = align_times(qoi_times, values[None, :, :], times).transpose(1, 0, 2)
+                endorse_2Dtest.check_data(values, field_qois.get(name + "_min", None),
+                                           field_qois.get(name + "_max", None))
+                result.append(values.ravel())
+        result = np.concatenate(result)
+
+        print("Extracting results...finished")
+        return result
 
     @staticmethod
-    def check_conv_reasons(log_fname):
-        with open(log_fname, "r") as f:
-            for line in f:
-                tokens = line.split(" ")
-                try:
-                    i = tokens.index('convergence')
-                    if tokens[i + 1] == 'reason':
-                        value = tokens[i + 2].rstrip(",")
-                        conv_reason = int(value)
-                        if conv_reason < 0:
-                            print("Failed to converge: ", conv_reason)
-                            return False
-                except ValueError:
-                    continue
+    def outputs_complete(config_dict, sim_dir="."):
+        """
+        Check that the simulation in 'sim_dir' has finished: all result files exist
+        and the Flow123d run, if its stats are recorded, ended with zero exit code.
+        :return: bool
+        """
+        output_dir = os.path.join(sim_dir, "output_" + config_dict["hm_params"]["in_file"])
+        if not all([os.path.isfile(os.path.join(output_dir, f)) for f in endorse_2Dtest.hm_result_files]):
+            return False
+        run_stats_file = os.path.join(sim_dir, endorse_2Dtest.run_stats_file)
+        if os.path.isfile(run_stats_file):
+            with open(run_stats_file, "r") as f:
+                run_stats = yaml.safe_load(f) or {}
+            return run_stats.get("returncode", None) == 0
         return True
 
+    @staticmethod
+    def collect_finished(config_dict, sample_dir):
+        """
+        Results of a sample computed in a previous run (see WGC2020_Process.resume_samples).
+        :param config_dict: level configuration
+        :param sample_dir: sample directory
+        :return: [fine result, coarse result], None if the outputs are not complete
+        """
+        sim_dirs = [sample_dir]
+        if config_dict["coarse"] is not None:
+            sim_dirs.append(os.path.join(sample_dir, endorse_2Dtest.coarse_dir))
+        if not all([endorse_2Dtest.outputs_complete(config_dict, d) for d in sim_dirs]):
+            return None
+        orig_dir = os.getcwd()
+        try:
+            os.chdir(sample_dir)
+            return endorse_2Dtest.collect_results(config_dict)
+        except Exception as e:
+            print("Results of '{}' not extracted: {}".format(sample_dir, e))
+            return None
+        finally:
+            os.chdir(orig_dir)
+
+    @staticmethod
+    def empty_result(config_dict):
+        n_values = sum([np.prod(q.shape) * len(q.times) * len(q.locations)
+                        for q in endorse_2Dtest.quantity_specs(config_dict)])
+        return [np.zeros(n_values), np.zeros(n_values)]
+
+    # resources used by Flow123d, written into the sample directory
+    run_stats_file = aux_storage.RUN_STATS_FILE
+    # solver statistics extracted from the Flow123d log, see solver_log.analyze
+    solver_stats_file = aux_storage.SOLVER_STATS_FILE
+    # wall time, CPU time and peak RSS of the sample stages
+    stage_times_file = aux_storage.STAGE_TIMES_FILE
+
+    # outputs of the HM model, the run is skipped if they exist
+    hm_result_files = ["flow_observe.yaml", "mechanics_observe.yaml"]
+
+    # parameters of the model not substituted into the template
+    non_template_params = ["in_file", "output_dir"]
+
+    @staticmethod
+    def compile_template(config, param_key):
+        """
+        Compile the template of the model given by 'param_key' and check it against its parameters.
+        :return: compiled template, see template.compile_template
+        """
+        params = config[param_key]
+        tmpl_file = os.path.join(config["common_files_dir"], params["in_file"] + '_tmpl.yaml')
+        tmpl = template.compile_template_file(tmpl_file)
+        missing, unused = template.check_template(tmpl, params, ignore=endorse_2Dtest.non_template_params)
+        if missing:
+            raise Exception("Placeholders {} of template '{}' are not set in '{}'.".format(missing, tmpl_file, param_key))
+        if unused:
+            print("Warning: parameters {} of '{}' are not used in template '{}'.".format(unused, param_key, tmpl_file))
+        return tmpl
+
     @staticmethod
     def call_flow(config_dict, param_key, result_files):
         """
         Redirect sstdout and sterr, return true on succesfull run.
+        Raise exception with the reason if the run is aborted (time limit, solver divergence).
         :param result_files: Files to be computed - skip computation if already exist.
         :param param_key: config dict parameters key
         :param config_dict:
@@ -291,18 +550,35 @@ class endorse_2Dtest(Simulation):
         if all([os.path.isfile(os.path.join(output_dir, f)) for f in result_files]):
             status = True
         else:
-            substitute_placeholders(os.path.join(config_dict["common_files_dir"], fname + '_tmpl.yaml'),
-                                    fname + '.yaml',
-                                    params)
+            with stage("template"), open(fname + '.yaml', 'w') as f:
+                f.write(template.render_template(config_dict["templates"][param_key], params))
             arguments.extend(['--no_profiler', '--output_dir', output_dir, fname + ".yaml"])
+            timeout = flow_runner.flow_timeout(config_dict, config_dict.get("mesh_n_elements", None))
+            monitor = flow_runner.divergence_monitor(config_dict, output_dir, fname + "_stdout")
             print("Running: ", " ".join(arguments))
-            with open(fname + "_stdout", "w") as stdout:
+            with stage("flow123d"), open(fname + "_stdout", "w") as stdout:
                 with open(fname + "_stderr", "w") as stderr:
-                    completed = subprocess.run(arguments, stdout=stdout, stderr=stderr)
-            print("Exit status: ", completed.returncode)
-            status = completed.returncode == 0
-        conv_check = endorse_2Dtest.check_conv_reasons(os.path.join(output_dir, "flow123.0.log"))
+                    run_stats = flow_runner.run_supervised(
+                        arguments, stdout, stderr, timeout=timeout,
+                        term_timeout=(config_dict.get("flow_timeout", None) or {}).get("term_timeout", 30),
+                        poll_interval=(config_dict.get("divergence", None) or {}).get("poll_interval", 0.5),
+                        monitor=monitor)
+            run_stats["timeout"] = timeout
+            run_stats["n_elements"] = config_dict.get("mesh_n_elements", None)
+            run_stats["mesh_step"] = config_dict["geometry"]["tunnel_mesh_step"]
+            with open(endorse_2Dtest.run_stats_file, "w") as f:
+                yaml.safe_dump(run_stats, f)
+            print("Exit status: ", run_stats["returncode"])
+            if run_stats["abort_reason"] is not None:
+                raise Exception("Flow123d aborted, {}".format(run_stats["abort_reason"]))
+            status = run_stats["returncode"] == 0
+        stats = solver_log.analyze(os.path.join(output_dir, "flow123.0.log"), fname + "_stdout",
+                                   patterns=(config_dict.get("solver_log", None) or {}).get("patterns", None))
+        solver_log.save_stats(stats, endorse_2Dtest.solver_stats_file)
+        conv_check = solver_log.converged(stats)
         print("converged: ", conv_check)
+        print("linear solves: {}, linear iterations: {}, HM iterations: {}".format(
+            len(stats["linear_iterations"]), np.sum(stats["linear_iterations"]), np.sum(stats["step_hm_iterations"])))
         return status and conv_check
 
 
@@ -315,13 +591,18 @@ class endorse_2Dtest(Simulation):
 
 
     @staticmethod
-    def sample_mesh_repository(mesh_repository):
+    def sample_mesh_repository(config_dict):
         """
-        Select random mesh from the given mesh repository.
+        Select random mesh from the mesh repository index (see level_instance).
+        The mesh is linked into the sample directory, it is copied only if no link is possible.
         """
-        mesh_file = np.random.choice(os.listdir(mesh_repository))
+        index = config_dict["mesh_repository_entries"]
+        entry = index[np.random.randint(len(index))]
         comp_mesh = "random_fractures_healed.msh"
-        shutil.copyfile(os.path.join(mesh_repository, mesh_file), comp_mesh)
+        methods = config_dict.get("mesh_repository_link", ["hardlink", "reflink", "copy"])
+        method = MeshRepository.fetch(config_dict["mesh_repository"], entry, comp_mesh, methods)
+        print("Mesh '{}' ({} elements) taken from repository by {}".format(entry["file"], entry["n_elements"], method))
+        config_dict["mesh_n_elements"] = entry["n_elements"]
         # heal_ref_report = {'flow_stats': {'bad_el_tol': 0.01, 'bad_elements': [], 'bins': [], 'hist': []},
         #                    'gamma_stats': {'bad_el_tol': 0.01, 'bad_elements': [], 'bins': [], 'hist': []}}
         # with open("random_fractures_heal_stats.yaml", "w") as f:
@@ -362,19 +643,72 @@ class endorse_2Dtest(Simulation):
     #     with open('regions.yaml', 'w') as outfile:
     #         yaml.dump(regions_dict, outfile, default_flow_style=False, Dumper=yaml.CDumper)
 
+    @staticmethod
+    def mesh_options(config_dict):
+        options = endorse_2Dtest.default_mesh_options.copy()
+        options.update(config_dict.get("mesh_options", None) or {})
+        return options
+
+    @staticmethod
+    def mesh_cache(config_dict):
+        """
+        Create shared mesh cache according to 'mesh_cache' in config.yaml.
+        :return: MeshCache or None if the cache is disabled
+        """
+        cache_config = config_dict.get("mesh_cache", None)
+        if cache_config is None or not cache_config.get("enabled", False):
+            return None
+        cache_dir = cache_config.get("dir", None)
+        if cache_dir is None:
+            cache_dir = os.path.join(config_dict["common_files_dir"], "mesh_cache")
+        max_size = cache_config.get("max_size", None)
+        if max_size is not None:
+            max_size = int(max_size * 1024 ** 2)  # [MB]
+        return MeshCache(cache_dir, max_size=max_size)
+
     @staticmethod
     def prepare_mesh(config_dict, cut_tunnel):
         mesh_name = config_dict["mesh_name"]
         if cut_tunnel:
             mesh_name = mesh_name + "_cut"
+        mesh_healed = mesh_name + "_healed.msh"
+
+        mesh_cache = endorse_2Dtest.mesh_cache(config_dict)
+        if mesh_cache is None or os.path.isfile(mesh_healed):
+            endorse_2Dtest.make_healed_mesh(config_dict, mesh_name, cut_tunnel)
+        else:
+            key_params = dict(geometry=config_dict["geometry"],
+                              mesh_options=endorse_2Dtest.mesh_options(config_dict),
+                              mesh_name=mesh_name,
+                              cut_tunnel=cut_tunnel)
+            key = MeshCache.mesh_key(**key_params)
+            print("Mesh cache key: ", key)
+            mesh_cache.fetch(key,
+                             build=lambda build_dir: endorse_2Dtest.make_healed_mesh(config_dict, mesh_name, cut_tunnel),
+                             files=[mesh_healed, mesh_name + "_heal_stats.yaml"],
+                             params=key_params)
+        return mesh_healed
+
+    @staticmethod
+    def make_healed_mesh(config_dict, mesh_name, cut_tunnel):
+        """
+        Make mesh and heal it in the current directory, skip the steps with already existing results.
+        :return: healed mesh file name
+        """
+        mesh_healed = mesh_name + "_healed.msh"
+        if os.path.isfile(mesh_healed):
+            # e.g. linked from the mesh cache, the raw mesh is not needed
+            return mesh_healed
+
         mesh_file = mesh_name + ".msh"
         if not os.path.isfile(mesh_file):
-            endorse_2Dtest.make_mesh(config_dict, mesh_name, mesh_file, cut_tunnel=cut_tunnel)
+            with stage("mesh"):
+                endorse_2Dtest.make_mesh(config_dict, mesh_name, mesh_file, cut_tunnel=cut_tunnel)
 
-        mesh_healed = mesh_name + "_healed.msh"
-        if not os.path.isfile(mesh_healed):
-            hm = heal_mesh.HealMesh.read_mesh(mesh_file, node_tol=1e-4)
-            hm.heal_mesh(gamma_tol=0.01)
+        with stage("heal"):
+            options = endorse_2Dtest.mesh_options(config_dict)
+            hm = heal_mesh.HealMesh.read_mesh(mesh_file, node_tol=options["heal_node_tol"])
+            hm.heal_mesh(gamma_tol=options["heal_gamma_tol"])
             hm.stats_to_yaml(mesh_name + "_heal_stats.yaml")
             hm.write()
             assert hm.healed_mesh_name == mesh_healed
@@ -387,14 +721,15 @@ class endorse_2Dtest(Simulation):
         dimensions = geom["box_dimensions"]
         tunnel_dims = np.array([geom["tunnel_dimX"], geom["tunnel_dimY"]])/2
         tunnel_center = geom["tunnel_center"]
+        options = endorse_2Dtest.mesh_options(config_dict)
 
         print("load gmsh api")
         factory = gmsh.GeometryOCC(mesh_name, verbose=True)
         gmsh_logger = factory.get_logger()
         gmsh_logger.start()
         gopt = gmsh_options.Geometry()
-        gopt.Tolerance = 0.0001
-        gopt.ToleranceBoolean = 0.001
+        gopt.Tolerance = options["geometry_tolerance"]
+        gopt.ToleranceBoolean = options["geometry_tolerance_boolean"]
         # gopt.MatchMeshTolerance = 1e-1
         gopt.OCCFixSmallEdges = True
         gopt.OCCFixSmallFaces = True
@@ -481,15 +816,15 @@ class endorse_2Dtest(Simulation):
         # mesh.Algorithm = gmsh_options.Algorithm2d.FrontalDelaunay
         mesh.Algorithm3D = gmsh_options.Algorithm3d.HXT
 
-        mesh.ToleranceInitialDelaunay = 0.01
+        mesh.ToleranceInitialDelaunay = options["tolerance_initial_delaunay"]
         # mesh.ToleranceEdgeLength = fracture_mesh_step / 5
         mesh.CharacteristicLengthFromPoints = True
         mesh.CharacteristicLengthFromCurvature = True
         mesh.CharacteristicLengthExtendFromBoundary = 2
         mesh.CharacteristicLengthMin = min_el_size
         mesh.CharacteristicLengthMax = max_el_size
-        mesh.MinimumCirclePoints = 6
-        mesh.MinimumCurvePoints = 2
+        mesh.MinimumCirclePoints = options["min_circle_points"]
+        mesh.MinimumCurvePoints = options["min_curve_points"]
 
         # factory.make_mesh(mesh_groups, dim=2)
         factory.make_mesh(mesh_groups)
@@ -630,29 +965,10 @@ class endorse_2Dtest(Simulation):
 
     @staticmethod
     def observe_time_plot(config_dict):
+        import plots
 
         output_dir = config_dict["hm_params"]["output_dir"]
 
-        with open(os.path.join(output_dir, "flow_observe.yaml"), "r") as f:
-            loaded_yaml = yaml.load(f, yaml.CSafeLoader)
-            points = loaded_yaml['points']
-            point_names = [p["name"] for p in points]
-            data = loaded_yaml['data']
-            values = np.array([d["pressure_p0"] for d in data]).transpose()
-            times = np.array([d["time"] for d in data]).transpose()
-
-            v = values[0, 0:]
-
-            fig, ax1 = plt.subplots()
-            temp_color = ['red', 'green', 'violet', 'blue']
-            ax1.set_xlabel('time [d]')
-            ax1.set_ylabel('pressure [m]')
-            for i in range(0, len(point_names)):
-                ax1.plot(times, values[i, 0:], color=temp_color[i], label=point_names[i])
-
-            ax1.tick_params(axis='y')
-            ax1.legend()
-
-            fig.tight_layout()  # otherwise the right y-label is slightly clipped
-            # plt.show()
-            plt.savefig("observe_pressure.pdf")
+        observe = load_observe(os.path.join(output_dir, "flow_observe.yaml"), ["pressure_p0"])
+        plots.observe_pressure_figure(observe["times"], observe["pressure_p0"][:, :, 0],
+                                      observe["point_names"], "observe_pressure.pdf")
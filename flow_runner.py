@@ -0,0 +1,175 @@
+import os
+import re
+import time
+import signal
+import subprocess
+
+
+def _exit_code(status):
+    """
+    Return code of the process in the subprocess convention (-signal if killed by a signal).
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _signal_group(pid, sig):
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+class LogMonitor:
+    """
+    Follows growing log files of a running process and looks for divergence patterns.
+    Only the newly written complete lines are read on every check.
+    """
+
+    def __init__(self, files, patterns):
+        """
+        :param files: paths to the followed files, need not exist yet
+        :param patterns: list of dicts:
+            name - reported name of the divergence
+            regex - regular expression searched in each line
+            group - (optional) regex group with a value compared with min/max, default 1
+            min, max - (optional) bounds of the value, the pattern matches only for values out of bounds (or NaN);
+                       without bounds any match is a divergence
+        """
+        self.files = list(files)
+        self._pos = {f: 0 for f in self.files}
+        self._rest = {f: b"" for f in self.files}
+        self.patterns = [(p["name"], re.compile(p["regex"].encode()), p.get("group", 1), p.get("min", None), p.get("max", None))
+                         for p in patterns]
+
+    def _match(self, line):
+        for name, regex, group, minimum, maximum in self.patterns:
+            match = regex.search(line)
+            if match is None:
+                continue
+            if minimum is not None or maximum is not None:
+                try:
+                    value = float(match.group(group))
+                except ValueError:
+                    value = float("nan")
+                if (minimum is None or value >= minimum) and (maximum is None or value <= maximum):
+                    continue
+            return "{}: {}".format(name, line.strip().decode(errors="replace"))
+        return None
+
+    def check(self):
+        """
+        Read new lines of the followed files.
+        :return: divergence description or None
+        """
+        for fname in self.files:
+            try:
+                with open(fname, "rb") as f:
+                    f.seek(self._pos[fname])
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            if not data:
+                continue
+            self._pos[fname] += len(data)
+            lines = (self._rest[fname] + data).split(b"\n")
+            # incomplete last line
+            self._rest[fname] = lines.pop()
+            for line in lines:
+                reason = self._match(line)
+                if reason is not None:
+                    return reason
+        return None
+
+
+def run_supervised(arguments, stdout, stderr, timeout=None, term_timeout=30, poll_interval=0.5, monitor=None):
+    """
+    Run the process in its own process group (MPI launcher together with its ranks)
+    and wait for it by wait4 to get its resource usage.
+    After 'timeout' seconds the group is terminated by SIGTERM, after further 'term_timeout' seconds by SIGKILL.
+    The same happens as soon as the 'monitor' reports a divergence.
+    :param arguments: command line
+    :param stdout: file for standard output
+    :param stderr: file for standard error
+    :param timeout: wall clock limit [s], None - no limit
+    :param term_timeout: time given to the process to terminate [s]
+    :param poll_interval: time between checks of the process [s]
+    :param monitor: LogMonitor or None
+    :return: dict of run statistics: returncode, wall_time [s], user_time [s], sys_time [s],
+             max_rss [kB], in_blocks, out_blocks, timed_out, killed, abort_reason (None if not aborted)
+    """
+    start = time.monotonic()
+    proc = subprocess.Popen(arguments, stdout=stdout, stderr=stderr, start_new_session=True)
+    timed_out = False
+    killed = False
+    abort_reason = None
+    term_time = None
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        now = time.monotonic()
+        if term_time is None:
+            if timeout is not None and now - start > timeout:
+                timed_out = True
+                abort_reason = "time limit {} s exceeded".format(timeout)
+            elif monitor is not None:
+                abort_reason = monitor.check()
+            if abort_reason is not None:
+                print("Terminating {}: {}".format(proc.pid, abort_reason))
+                term_time = now
+                _signal_group(proc.pid, signal.SIGTERM)
+        elif not killed and now - term_time > term_timeout:
+            print("Process not terminated, killing: {}".format(proc.pid))
+            killed = True
+            _signal_group(proc.pid, signal.SIGKILL)
+        time.sleep(poll_interval)
+    wall_time = time.monotonic() - start
+    # process is reaped, prevent Popen from waiting for it
+    proc.returncode = _exit_code(status)
+    if term_time is not None:
+        # do not leave orphaned ranks behind
+        _signal_group(proc.pid, signal.SIGKILL)
+    elif monitor is not None:
+        # lines written at the end of the run
+        abort_reason = monitor.check()
+
+    return dict(returncode=proc.returncode,
+                wall_time=wall_time,
+                user_time=rusage.ru_utime,
+                sys_time=rusage.ru_stime,
+                max_rss=rusage.ru_maxrss,
+                in_blocks=rusage.ru_inblock,
+                out_blocks=rusage.ru_oublock,
+                timed_out=timed_out,
+                killed=killed,
+                abort_reason=abort_reason)
+
+
+def flow_timeout(config_dict, n_elements):
+    """
+    Wall clock limit of a Flow123d run according to 'flow_timeout' in config.yaml:
+    base + per_element * n_elements.
+    :param config_dict: configuration
+    :param n_elements: number of mesh elements, None if unknown
+    :return: time limit [s] or None for no limit
+    """
+    timeout_config = config_dict.get("flow_timeout", None)
+    if not timeout_config:
+        return None
+    timeout = timeout_config.get("base", 0)
+    if n_elements is not None:
+        timeout += timeout_config.get("per_element", 0) * n_elements
+    return timeout
+
+
+def divergence_monitor(config_dict, output_dir, stdout_file):
+    """
+    Monitor of the Flow123d log and standard output (PETSc -ksp_monitor) according to 'divergence' in config.yaml.
+    :return: LogMonitor or None if no patterns are configured
+    """
+    patterns = (config_dict.get("divergence", None) or {}).get("patterns", None)
+    if not patterns:
+        return None
+    return LogMonitor([os.path.join(output_dir, "flow123.0.log"), stdout_file], patterns)
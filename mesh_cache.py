@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import contextlib
+
+
+# ioctl request cloning the whole file (reflink) on btrfs, xfs, ...
+FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    with open(src, "rb") as f_src:
+        with open(dst, "wb") as f_dst:
+            try:
+                fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+            except OSError:
+                f_dst.close()
+                os.remove(dst)
+                raise
+
+
+def link_file(src, dst, methods=("hardlink", "copy")):
+    """
+    Make file 'src' available as 'dst' without copying the data if possible.
+    Methods are tried in the given order, the next one is used when the previous fails
+    (e.g. hardlink and reflink across different filesystems). Existing 'dst' is replaced.
+    :param src: source file path
+    :param dst: destination file path
+    :param methods: sequence of 'hardlink', 'reflink', 'symlink', 'copy'
+    :return: name of the used method
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    for method in methods:
+        try:
+            if method == "hardlink":
+                os.link(src, dst)
+            elif method == "reflink":
+                _reflink(src, dst)
+            elif method == "symlink":
+                os.symlink(os.path.abspath(src), dst)
+            elif method == "copy":
+                shutil.copyfile(src, dst)
+            else:
+                raise ValueError("Unknown link method: {}".format(method))
+            return method
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EINVAL, errno.ENOTTY):
+                raise
+    raise OSError(errno.EXDEV, "Can not link {} to {} by any of: {}".format(src, dst, methods))
+
+
+@contextlib.contextmanager
+def file_lock(lock_path, blocking=True):
+    """
+    Exclusive POSIX lock on the file 'lock_path' (works also on NFS with lockd).
+    Yields True if the lock was acquired, False in non-blocking mode if it is held by someone else.
+    """
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.lockf(fd, flags)
+        except OSError as e:
+            if e.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+class MeshCache:
+    """
+    Content addressed cache of generated and healed meshes shared by all samples (and PBS jobs).
+
+    Every entry is a directory <cache_dir>/<key> where the key is a hash of all the parameters
+    the mesh depends on. An entry is built in a temporary directory and renamed to its final
+    place only when complete, builds of the same key are serialized by a lock file,
+    so concurrent requests wait for the first one instead of meshing again.
+    Total size of the cache is kept under 'max_size' by evicting the least recently used entries.
+    """
+
+    COMPLETE_MARK = "complete.json"
+
+    def __init__(self, cache_dir, max_size=None):
+        """
+        :param cache_dir: cache root directory
+        :param max_size: maximal total size of cached files in bytes, None - unlimited
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, mode=0o775, exist_ok=True)
+
+    @staticmethod
+    def mesh_key(**params):
+        """
+        Hash of the mesh parameters, independent of the dict ordering.
+        :param params: JSON serializable parameters the mesh depends on
+        :return: hex string
+        """
+        text = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _lock_path(self, key):
+        return os.path.join(self.cache_dir, key + ".lock")
+
+    def _is_complete(self, key):
+        return os.path.isfile(os.path.join(self.entry_dir(key), MeshCache.COMPLETE_MARK))
+
+    def _touch(self, key):
+        """
+        Mark the entry as recently used, the mark mtime is used for LRU eviction.
+        """
+        try:
+            os.utime(os.path.join(self.entry_dir(key), MeshCache.COMPLETE_MARK))
+        except OSError:
+            pass
+
+    def get(self, key, build, params=None):
+        """
+        Return directory of the cache entry 'key', build it if necessary.
+        :param key: entry key, see mesh_key
+        :param build: function build(build_dir) creating the mesh files in the given (empty, current) directory
+        :param params: parameters stored along the entry for inspection
+        :return: path to the entry directory
+        """
+        if self._is_complete(key):
+            self._touch(key)
+            return self.entry_dir(key)
+
+        with file_lock(self._lock_path(key)):
+            # someone else could finish the build while we were waiting for the lock
+            if not self._is_complete(key):
+                self._build(key, build, params)
+        self._touch(key)
+        self.evict(keep=key)
+        return self.entry_dir(key)
+
+    def fetch(self, key, build, files, dest_dir=".", params=None):
+        """
+        Get the entry 'key' (build it if necessary) and link given files into 'dest_dir'.
+        :param files: names of the entry files to link
+        :return: list of linked file paths
+        """
+        for attempt in range(2):
+            entry_dir = self.get(key, build, params)
+            try:
+                linked = []
+                for f in files:
+                    dst = os.path.join(dest_dir, f)
+                    link_file(os.path.join(entry_dir, f), dst)
+                    linked.append(dst)
+                return linked
+            except FileNotFoundError:
+                # entry evicted by another process in the meantime
+                if attempt > 0:
+                    raise
+
+    def _build(self, key, build, params):
+        entry_dir = self.entry_dir(key)
+        build_dir = "{}.tmp_{}_{}".format(entry_dir, os.uname().nodename, os.getpid())
+        if os.path.isdir(build_dir):
+            shutil.rmtree(build_dir)
+        os.makedirs(build_dir, mode=0o775)
+
+        orig_dir = os.getcwd()
+        os.chdir(build_dir)
+        try:
+            build(build_dir)
+            with open(MeshCache.COMPLETE_MARK, "w") as f:
+                json.dump(dict(key=key, params=params, created=time.time()), f, default=str)
+        except:
+            os.chdir(orig_dir)
+            shutil.rmtree(build_dir, ignore_errors=True)
+            raise
+        os.chdir(orig_dir)
+
+        # incomplete entry left by a killed build
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir)
+        os.rename(build_dir, entry_dir)
+
+    @staticmethod
+    def _dir_size(path):
+        size = 0
+        for f in os.scandir(path):
+            if f.is_file(follow_symlinks=False):
+                size += f.stat().st_size
+        return size
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache size is under the limit.
+        Entries locked by a running build are skipped.
+        :param keep: key of an entry that must not be removed
+        :return: None
+        """
+        if self.max_size is None:
+            return
+        entries = []
+        for f in os.scandir(self.cache_dir):
+            if not f.is_dir() or not os.path.isfile(os.path.join(f.path, MeshCache.COMPLETE_MARK)):
+                continue
+            last_use = os.path.getmtime(os.path.join(f.path, MeshCache.COMPLETE_MARK))
+            entries.append((last_use, f.name, self._dir_size(f.path)))
+
+        total_size = sum(size for _, _, size in entries)
+        for last_use, key, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            with file_lock(self._lock_path(key), blocking=False) as locked:
+                if not locked:
+                    continue
+                print("Mesh cache: evicting ", key)
+                shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+                total_size -= size
@@ -0,0 +1,86 @@
+import os
+import copy
+import itertools
+import multiprocessing
+
+from flow_mc_new import endorse_2Dtest, force_mkdir
+from mesh_cache import MeshCache, link_file
+from mesh_repository import MeshRepository
+
+
+def geometry_variants(config_dict):
+    """
+    All combinations of the 'geometry' parameters listed in mesh_pregeneration.sweep,
+    the other parameters are taken from the 'geometry' block.
+    :return: list of geometry dicts
+    """
+    sweep = config_dict["mesh_pregeneration"].get("sweep", None) or {}
+    names = list(sweep.keys())
+    variants = []
+    for values in itertools.product(*[sweep[name] for name in names]):
+        geometry = copy.deepcopy(config_dict["geometry"])
+        geometry.update(zip(names, values))
+        variants.append(geometry)
+    return variants
+
+
+def _build_mesh(args):
+    """
+    Make and heal the mesh of a single geometry variant in its own build directory.
+    :return: (variant id, path to the healed mesh)
+    """
+    config_dict, variant_id = args
+    build_dir = os.path.join(config_dict["work_dir"], "mesh_pregen", "variant_{:04d}".format(variant_id))
+    force_mkdir(build_dir)
+    os.chdir(build_dir)
+    mesh_healed = endorse_2Dtest.prepare_mesh(config_dict, cut_tunnel=True)
+    return variant_id, os.path.join(build_dir, mesh_healed)
+
+
+def pregenerate_meshes(config_dict):
+    """
+    Build meshes of all geometry variants in a local process pool and register them
+    in a mesh repository. Already cached meshes are not built again.
+    The repository may hold other meshes, the samples draw only from the meshes of this sweep
+    listed in the index <work_dir>/mesh_pregen/mesh_index.yaml.
+    :param config_dict: configuration, 'work_dir' must be set
+    :return: mesh repository directory, index file
+    """
+    pregen_config = config_dict["mesh_pregeneration"]
+    work_dir = config_dict["work_dir"]
+    repo_dir = pregen_config.get("repository", None) or os.path.join(work_dir, "mesh_repository")
+    n_workers = pregen_config.get("n_workers", None) or os.cpu_count()
+
+    # meshes go through the mesh cache, which must be outside of common_files (removed by clean run)
+    cache_config = copy.deepcopy(config_dict.get("mesh_cache", None) or {})
+    cache_config["enabled"] = True
+    if cache_config.get("dir", None) is None:
+        cache_config["dir"] = os.path.join(work_dir, "mesh_pregen", "cache")
+
+    tasks = []
+    for variant_id, geometry in enumerate(geometry_variants(config_dict)):
+        variant_config = copy.deepcopy(config_dict)
+        variant_config["geometry"] = geometry
+        variant_config["mesh_cache"] = cache_config
+        tasks.append((variant_config, variant_id))
+
+    print("Pre-generating {} meshes, {} workers...".format(len(tasks), n_workers))
+    orig_dir = os.getcwd()
+    index_file = os.path.join(work_dir, "mesh_pregen", MeshRepository.INDEX_FILE)
+    os.makedirs(os.path.dirname(index_file), mode=0o775, exist_ok=True)
+    repository = MeshRepository(repo_dir, index_file)
+    os.makedirs(repo_dir, mode=0o775, exist_ok=True)
+    mesh_names = set()
+    with multiprocessing.Pool(min(n_workers, len(tasks))) as pool:
+        for variant_id, mesh_file in pool.imap_unordered(_build_mesh, tasks):
+            geometry = tasks[variant_id][0]["geometry"]
+            name = "{}_{}.msh".format(config_dict["mesh_name"], MeshCache.mesh_key(**geometry)[:12])
+            link_file(mesh_file, os.path.join(repo_dir, name))
+            mesh_names.add(name)
+            print("Mesh variant {} finished: {}".format(variant_id, name))
+    os.chdir(orig_dir)
+
+    # meshes of previous sweeps or of other users of the repository must not be sampled
+    entries = repository.update_index(files=mesh_names)
+    print("Pre-generating meshes...finished, {} meshes in repository {}".format(len(entries), repo_dir))
+    return repo_dir, index_file
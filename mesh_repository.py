@@ -0,0 +1,134 @@
+import os
+import hashlib
+import ruamel.yaml as yaml
+
+from mesh_cache import link_file, file_lock
+
+
+def read_msh_info(mesh_file):
+    """
+    Single pass over an ASCII GMSH 2 mesh file.
+    Computes its SHA1 hash, number of elements and physical names without building the mesh in memory.
+    :param mesh_file: path to .msh file
+    :return: dict(sha1, n_elements, n_nodes, physical_names=[[dim, id, name], ...])
+    """
+    sha1 = hashlib.sha1()
+    section = None
+    header_next = False
+    n_nodes = n_elements = None
+    physical_names = []
+    with open(mesh_file, "rb") as f:
+        for line in f:
+            sha1.update(line)
+            if line.startswith(b"$"):
+                tag = line.strip()
+                if tag.startswith(b"$End"):
+                    section = None
+                else:
+                    section = tag
+                    header_next = True
+                continue
+            if header_next:
+                # first line of a section is the number of items
+                header_next = False
+                if section == b"$Nodes":
+                    n_nodes = int(line)
+                elif section == b"$Elements":
+                    n_elements = int(line)
+                continue
+            if section == b"$PhysicalNames":
+                dim, reg_id, name = line.decode().split(maxsplit=2)
+                physical_names.append([int(dim), int(reg_id), name.strip().strip('"')])
+    return dict(sha1=sha1.hexdigest(), n_nodes=n_nodes, n_elements=n_elements, physical_names=physical_names)
+
+
+class MeshRepository:
+    """
+    Directory of healed meshes with an index file.
+
+    The index is built once (and updated incrementally for new or modified files),
+    samples then draw from the index and never list the repository directory.
+    """
+
+    INDEX_FILE = "mesh_index.yaml"
+    MESH_EXT = ".msh"
+
+    def __init__(self, repo_dir, index_file=None):
+        """
+        :param repo_dir: repository directory
+        :param index_file: path to the index file, default <repo_dir>/mesh_index.yaml
+        """
+        self.repo_dir = os.path.abspath(repo_dir)
+        if index_file is None:
+            index_file = os.path.join(self.repo_dir, MeshRepository.INDEX_FILE)
+        self.index_file = index_file
+
+    def load_index(self):
+        """
+        Load the index, build it if it does not exist yet.
+        :return: list of index entries
+        """
+        if not os.path.isfile(self.index_file):
+            return self.update_index()
+        with open(self.index_file, "r") as f:
+            index = yaml.safe_load(f)
+        return index["meshes"]
+
+    def update_index(self, files=None):
+        """
+        Scan the repository and (re)write the index.
+        Entries of files with unchanged size and mtime are reused.
+        :param files: names of the indexed meshes, default all meshes in the repository
+        :return: list of index entries
+        """
+        with file_lock(self.index_file + ".lock"):
+            old_entries = {}
+            if os.path.isfile(self.index_file):
+                with open(self.index_file, "r") as f:
+                    old_entries = {e["file"]: e for e in yaml.safe_load(f)["meshes"]}
+
+            entries = []
+            for f in sorted(os.scandir(self.repo_dir), key=lambda e: e.name):
+                if not f.is_file() or not f.name.endswith(MeshRepository.MESH_EXT):
+                    continue
+                if files is not None and f.name not in files:
+                    continue
+                stat = f.stat()
+                entry = old_entries.get(f.name, None)
+                if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                    print("Indexing mesh: ", f.name)
+                    entry = dict(file=f.name, size=stat.st_size, mtime=stat.st_mtime)
+                    entry.update(read_msh_info(f.path))
+                entries.append(entry)
+
+            tmp_file = self.index_file + ".tmp"
+            with open(tmp_file, "w") as f:
+                yaml.safe_dump(dict(repository=self.repo_dir, meshes=entries), f)
+            os.replace(tmp_file, self.index_file)
+        return entries
+
+    def add_mesh(self, mesh_file, name=None):
+        """
+        Put a mesh into the repository (hardlink if possible) and update the index.
+        :param mesh_file: path to a healed mesh
+        :param name: file name in the repository, default basename of mesh_file
+        :return: index entry of the mesh
+        """
+        if name is None:
+            name = os.path.basename(mesh_file)
+        os.makedirs(self.repo_dir, mode=0o775, exist_ok=True)
+        link_file(mesh_file, os.path.join(self.repo_dir, name))
+        entries = self.update_index()
+        return next(e for e in entries if e["file"] == name)
+
+    @staticmethod
+    def fetch(repo_dir, entry, dest_file, methods=("hardlink", "reflink", "copy")):
+        """
+        Make the indexed mesh available in the sample directory.
+        :param repo_dir: repository directory
+        :param entry: index entry
+        :param dest_file: destination path
+        :param methods: link methods, see mesh_cache.link_file
+        :return: used link method
+        """
+        return link_file(os.path.join(repo_dir, entry["file"]), dest_file, methods)
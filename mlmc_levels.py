@@ -0,0 +1,134 @@
+import numpy as np
+
+import mlmc.moments as moments
+from mlmc.estimator import estimate_n_samples_for_target_variance
+
+
+def level_parameters(config_dict):
+    """
+    MLMC level parameters given by 'mlmc: mesh_steps' in config.yaml, the coarsest mesh is the level 0.
+    Without mesh_steps there is a single level with geometry.tunnel_mesh_step.
+    :return: [[tunnel_mesh_step], ...]
+    """
+    mesh_steps = (config_dict.get("mlmc", None) or {}).get("mesh_steps", None)
+    if not mesh_steps:
+        mesh_steps = [config_dict["geometry"]["tunnel_mesh_step"]]
+    return [[float(step)] for step in sorted(mesh_steps, reverse=True)]
+
+
+def initial_n_samples(config_dict, n_levels):
+    """
+    Initial number of samples per level, 'n_samples' in config.yaml is either a single number or a list per level.
+    """
+    n_samples = config_dict["n_samples"]
+    if isinstance(n_samples, list):
+        if len(n_samples) != n_levels:
+            raise Exception("n_samples {} does not match the number of levels {}.".format(n_samples, n_levels))
+        return n_samples
+    return [n_samples] * n_levels
+
+
+def quantity_slice(q_specs, quantity):
+    """
+    Slice of the quantity in the flat sample result.
+    :param q_specs: list of QuantitySpec, the simulation result format (endorse_2Dtest.quantity_specs);
+                    not the stored one, the HDF storage keeps the locations of the first quantity for all quantities
+    :param quantity: quantity name
+    """
+    offset = 0
+    for q_spec in q_specs:
+        size = int(np.prod(q_spec.shape)) * len(q_spec.times) * len(q_spec.locations)
+        if q_spec.name == quantity:
+            return slice(offset, offset + size)
+        offset += size
+    raise Exception("Unknown quantity: {}".format(quantity))
+
+
+def n_collected(sample_storage):
+    """
+    Number of collected samples per level, SampleStorageHDF.get_n_collected raises for a level
+    with nothing collected yet.
+    :return: list of int
+    """
+    n = [0] * len(sample_storage._level_groups)
+    for level in sample_storage._level_groups:
+        try:
+            n[int(level.level_id)] = level.collected_n_items()
+        except AttributeError:
+            pass
+    return n
+
+
+def collected_pairs(sample_storage):
+    """
+    Collected samples of the levels as SampleStorageHDF.sample_pairs, also for levels with nothing collected yet.
+    :return: list of arrays (n_values, n_samples, 2), (n_values, n_samples, 1) on the level 0, [] for a level without samples
+    """
+    pairs = [[] for _ in sample_storage._level_groups]
+    for level in sample_storage._level_groups:
+        chunk = level.collected(slice(None))
+        if chunk is None or len(chunk) == 0:
+            continue
+        level_id = int(level.level_id)
+        if level_id == 0:
+            # the coarse values of the level 0 are auxiliary zeros
+            chunk = chunk[:, :1, :]
+        pairs[level_id] = chunk.transpose((2, 0, 1))
+    return pairs
+
+
+def level_moment_variances(sample_storage, q_specs, quantity, n_moments, quantile=0.01):
+    """
+    Variances of the differences of fine and coarse moments on each level.
+    Every value of the quantity (time, location, component) is mapped to [0, 1] by its own domain
+    given by quantiles of the level 0 samples; Legendre moments on [0, 1] are used.
+    :param sample_storage: SampleStorageHDF
+    :param q_specs: simulation result format, see quantity_slice
+    :param quantity: quantity name
+    :param n_moments: number of moments
+    :param quantile: values out of [quantile, 1 - quantile] are clipped
+    :return: array (n_levels, n_moments), maximum over the quantity values, inf for levels with less than 2 samples
+    """
+    pairs = collected_pairs(sample_storage)
+    if len(pairs[0]) == 0:
+        raise Exception("No collected samples on the level 0, the level variances can not be estimated.")
+    q_slice = quantity_slice(q_specs, quantity)
+    lower, upper = np.quantile(pairs[0][q_slice, :, 0], [quantile, 1 - quantile], axis=1)
+    width = np.maximum(upper - lower, np.finfo(float).tiny)
+    moments_fn = moments.Legendre(n_moments, (0, 1))
+
+    def level_moments(values):
+        # (n_values, n_samples) -> (n_values, n_samples, n_moments)
+        return moments_fn(np.clip((values - lower[:, None]) / width[:, None], 0, 1))
+
+    variances = []
+    for level_id, level_pairs in enumerate(pairs):
+        if len(level_pairs) == 0 or level_pairs.shape[1] < 2:
+            variances.append(np.full(n_moments, np.inf))
+            continue
+        diff = level_moments(level_pairs[q_slice, :, 0])
+        if level_id > 0:
+            diff = diff - level_moments(level_pairs[q_slice, :, 1])
+        variances.append(np.max(np.var(diff, axis=1, ddof=1), axis=0))
+    return np.array(variances)
+
+
+def optimal_n_samples(sample_storage, q_specs, target_rmse, quantity, n_moments, max_n_samples=None):
+    """
+    Cost-optimal number of samples per level to reach the target RMSE of the moments of the quantity,
+    level costs are the measured sample times.
+    :return: array (n_levels,)
+    """
+    variances = level_moment_variances(sample_storage, q_specs, quantity, n_moments)
+    n_ops = np.maximum(np.array(sample_storage.get_n_ops(), dtype=float), 1e-6)
+    n_levels = len(variances)
+    if np.any(np.isinf(variances)):
+        # too few samples for a variance estimate
+        n_estimated = np.where(np.isinf(variances[:, 0]), 2, 0)
+    else:
+        n_estimated = estimate_n_samples_for_target_variance(target_rmse ** 2, variances, n_ops, n_levels)
+    if max_n_samples is not None:
+        n_estimated = np.minimum(n_estimated, max_n_samples)
+    print("Level variances: ", variances[:, 1:].max(axis=1))
+    print("Level costs: ", n_ops)
+    return np.array(n_estimated, dtype=int)
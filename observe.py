@@ -0,0 +1,209 @@
+import os
+import numpy as np
+import yaml
+
+# Flow123d writes observe output in plain block/flow YAML, parse it by the (C) event parser
+# instead of building the object tree of the whole file.
+try:
+    _Loader = yaml.CSafeLoader
+except AttributeError:
+    _Loader = yaml.SafeLoader
+
+_special_floats = {".nan": np.nan, ".NaN": np.nan, ".inf": np.inf, "-.inf": -np.inf, ".Inf": np.inf, "-.Inf": -np.inf}
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return _special_floats[value]
+
+
+def _skip_value(events, event):
+    """
+    Consume the node starting by 'event'.
+    """
+    depth = 0
+    while True:
+        if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            depth -= 1
+        if depth == 0:
+            return
+        event = next(events)
+
+
+def _read_numbers(events, event, out):
+    """
+    Read (nested) sequence of numbers starting by 'event' into the flat array 'out',
+    the array is grown (doubled) when it is full.
+    :return: (number of values read, number of nested sequences - i.e. points of a vector field, array 'out')
+    """
+    if isinstance(event, yaml.ScalarEvent):
+        out[0] = _to_float(event.value)
+        return 1, 0, out
+    i = 0
+    n_nested = 0
+    depth = 0
+    while True:
+        if isinstance(event, yaml.SequenceStartEvent):
+            depth += 1
+            if depth == 2:
+                n_nested += 1
+        elif isinstance(event, yaml.SequenceEndEvent):
+            depth -= 1
+            if depth == 0:
+                return i, n_nested, out
+        elif isinstance(event, yaml.ScalarEvent):
+            if i == len(out):
+                out = np.resize(out, 2 * len(out))
+            out[i] = _to_float(event.value)
+            i += 1
+        event = next(events)
+
+
+def _mapping_items(events):
+    """
+    Iterate over (key, first value event) of a mapping, the MappingStartEvent is already consumed.
+    The value must be consumed by the caller before the next item is requested.
+    """
+    while True:
+        event = next(events)
+        if isinstance(event, yaml.MappingEndEvent):
+            return
+        key = event.value
+        yield key, next(events)
+
+
+def parse_observe(yaml_file, fields, n_times_hint=None):
+    """
+    Streaming reader of Flow123d observe output (e.g. flow_observe.yaml).
+    Values are written directly into preallocated arrays (grown geometrically if n_times_hint is exceeded).
+    :param yaml_file: observe file
+    :param fields: names of observed fields to read, e.g. ['pressure_p0'], ['displacement']
+    :param n_times_hint: expected number of times
+    :return: dict(point_names=[...], times=array (n_times,), <field>=array (n_points, n_times, n_components))
+    """
+    capacity = n_times_hint or 64
+    point_names = []
+    times = np.empty(capacity)
+    buffers = {}
+    n_times = 0
+
+    with open(yaml_file, "r") as f:
+        events = yaml.parse(f, Loader=_Loader)
+        for event in events:
+            if isinstance(event, yaml.MappingStartEvent):
+                break
+        for key, event in _mapping_items(events):
+            if key == "points":
+                # sequence of mappings
+                for event in events:
+                    if isinstance(event, yaml.SequenceEndEvent):
+                        break
+                    for p_key, p_event in _mapping_items(events):
+                        if p_key == "name":
+                            point_names.append(p_event.value)
+                        else:
+                            _skip_value(events, p_event)
+            elif key == "data":
+                # single record buffer, grown by _read_numbers if needed
+                row = np.empty(4096)
+                for event in events:
+                    if isinstance(event, yaml.SequenceEndEvent):
+                        break
+                    if n_times == capacity:
+                        capacity *= 2
+                        times = np.resize(times, capacity)
+                        for name, buf in buffers.items():
+                            buffers[name] = np.resize(buf, (capacity, *buf.shape[1:]))
+                    record_keys = set()
+                    for d_key, d_event in _mapping_items(events):
+                        if d_key == "time":
+                            times[n_times] = _to_float(d_event.value)
+                            record_keys.add(d_key)
+                        elif d_key in fields:
+                            n_values, n_points, row = _read_numbers(events, d_event, row)
+                            if d_key not in buffers:
+                                # scalar field: flat list of point values
+                                n_points = n_points or n_values
+                                buffers[d_key] = np.empty((capacity, n_points, n_values // n_points))
+                            if n_values != np.prod(buffers[d_key].shape[1:]):
+                                raise Exception("Field '{}' has {} values at record {} of observe file '{}', "
+                                                "expected {}.".format(d_key, n_values, n_times, yaml_file,
+                                                                      np.prod(buffers[d_key].shape[1:])))
+                            buffers[d_key][n_times] = row[:n_values].reshape(buffers[d_key].shape[1:])
+                            record_keys.add(d_key)
+                        else:
+                            _skip_value(events, d_event)
+                    missing = ({"time"} | set(fields)) - record_keys
+                    if missing:
+                        raise Exception("Record {} of observe file '{}' misses {}.".format(
+                            n_times, yaml_file, sorted(missing)))
+                    n_times += 1
+            else:
+                _skip_value(events, event)
+
+    missing = set(fields) - set(buffers.keys())
+    if missing:
+        raise Exception("Fields {} not present in observe file '{}'.".format(missing, yaml_file))
+
+    result = dict(point_names=point_names, times=times[:n_times].copy())
+    for name, buf in buffers.items():
+        result[name] = np.ascontiguousarray(buf[:n_times].transpose(1, 0, 2))
+    return result
+
+
+def observe_cache_file(yaml_file):
+    return os.path.splitext(yaml_file)[0] + ".npz"
+
+
+def load_observe(yaml_file, fields, n_times_hint=None):
+    """
+    Observe data of given fields, cached in a binary .npz file next to the YAML output,
+    so repeated collection does not parse the YAML again.
+    The cache is used when it is newer than the YAML file or when the YAML file is gone.
+    :return: see parse_observe
+    """
+    cache_file = observe_cache_file(yaml_file)
+    cached_fields = []
+    if os.path.isfile(cache_file) and (not os.path.isfile(yaml_file)
+                                       or os.path.getmtime(cache_file) >= os.path.getmtime(yaml_file)):
+        with np.load(cache_file) as cache:
+            if all(name in cache for name in fields):
+                result = {name: cache[name] for name in cache.files}
+                result["point_names"] = [str(name) for name in result["point_names"]]
+                return result
+            cached_fields = [name for name in cache.files if name not in ("point_names", "times")]
+
+    # keep the previously cached fields in the new cache
+    fields = list(set(fields) | set(cached_fields))
+    result = parse_observe(yaml_file, fields, n_times_hint)
+    tmp_file = cache_file + ".tmp.npz"
+    np.savez(tmp_file, **result)
+    os.replace(tmp_file, cache_file)
+    return result
+
+
+def align_times(observe_times, values, times, tol=1e-6):
+    """
+    Values at given times, linear interpolation between the observed times (exact hits are taken as they are).
+    Vectorized over all points and components.
+    :param observe_times: increasing array (n_obs_times,)
+    :param values: array (n_points, n_obs_times, n_comp)
+    :param times: array (n_times,) within the observed time range
+    :return: array (n_points, n_times, n_comp)
+    """
+    times = np.asarray(times, dtype=float)
+    scale = max(1.0, np.abs(observe_times[-1]))
+    if times[0] < observe_times[0] - tol * scale or times[-1] > observe_times[-1] + tol * scale:
+        raise Exception("Times [{}, {}] out of observed range [{}, {}].".format(
+            times[0], times[-1], observe_times[0], observe_times[-1]))
+    if len(observe_times) == 1:
+        return np.repeat(values, len(times), axis=1)
+    i1 = np.clip(np.searchsorted(observe_times, times), 1, len(observe_times) - 1)
+    i0 = i1 - 1
+    w = np.clip((times - observe_times[i0]) / (observe_times[i1] - observe_times[i0]), 0, 1)
+    w = w[None, :, None]
+    return values[:, i0, :] * (1 - w) + values[:, i1, :] * w
@@ -0,0 +1,280 @@
+import numpy as np
+import h5py
+
+from mlmc.sample_storage_hdf import SampleStorageHDF
+
+import mlmc_levels
+
+# HDF group of the estimator state, next to the results of SampleStorageHDF
+STATS_GROUP = "online_stats"
+
+
+class RunningMoments:
+    """
+    Count, mean and central moment sums (M2, M3, M4) of each value of the flat sample result.
+    Batches are merged by the pairwise formulas of Chan and Pebay, so partial states of different
+    workers can be merged as well. NaN values are not counted.
+    """
+
+    def __init__(self, n_values):
+        self.n = np.zeros(n_values)
+        self.mean = np.zeros(n_values)
+        self.m2 = np.zeros(n_values)
+        self.m3 = np.zeros(n_values)
+        self.m4 = np.zeros(n_values)
+
+    @staticmethod
+    def from_batch(values):
+        """
+        :param values: array (n_samples, n_values)
+        """
+        stats = RunningMoments(values.shape[1])
+        valid = ~np.isnan(values)
+        stats.n = valid.sum(axis=0).astype(float)
+        stats.mean = np.where(valid, values, 0).sum(axis=0) / np.maximum(stats.n, 1)
+        dev = np.where(valid, values - stats.mean, 0)
+        stats.m2 = np.sum(dev ** 2, axis=0)
+        stats.m3 = np.sum(dev ** 3, axis=0)
+        stats.m4 = np.sum(dev ** 4, axis=0)
+        return stats
+
+    def merge(self, other):
+        """
+        Add the samples of 'other' (RunningMoments of the same values).
+        """
+        na, nb = self.n, other.n
+        n = na + nb
+        n_safe = np.maximum(n, 1)
+        delta = other.mean - self.mean
+        mean = self.mean + delta * nb / n_safe
+        m2 = self.m2 + other.m2 + delta ** 2 * na * nb / n_safe
+        m3 = (self.m3 + other.m3 + delta ** 3 * na * nb * (na - nb) / n_safe ** 2
+              + 3 * delta * (na * other.m2 - nb * self.m2) / n_safe)
+        m4 = (self.m4 + other.m4 + delta ** 4 * na * nb * (na ** 2 - na * nb + nb ** 2) / n_safe ** 3
+              + 6 * delta ** 2 * (na ** 2 * other.m2 + nb ** 2 * self.m2) / n_safe ** 2
+              + 4 * delta * (na * other.m3 - nb * self.m3) / n_safe)
+        self.n, self.mean, self.m2, self.m3, self.m4 = n, mean, m2, m3, m4
+
+    def update(self, values):
+        self.merge(RunningMoments.from_batch(values))
+
+    @property
+    def variance(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(self.n > 1, self.m2 / (self.n - 1), np.nan)
+
+    @property
+    def skewness(self):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.sqrt(self.n) * self.m3 / self.m2 ** 1.5
+
+    @property
+    def kurtosis(self):
+        """
+        Excess kurtosis.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.n * self.m4 / self.m2 ** 2 - 3
+
+    def state(self):
+        return dict(n=self.n, mean=self.mean, m2=self.m2, m3=self.m3, m4=self.m4)
+
+    @staticmethod
+    def from_state(state):
+        stats = RunningMoments(len(state["n"]))
+        for name in ["n", "mean", "m2", "m3", "m4"]:
+            setattr(stats, name, np.array(state[name], dtype=float))
+        return stats
+
+
+class HistogramSketch:
+    """
+    Histogram of each value on fixed bins between the valid range of its quantity (see 'extract' in config.yaml),
+    with an underflow and an overflow bin. Sketches with the same bins are merged by adding the counts.
+    """
+
+    def __init__(self, lower, upper, n_bins=100):
+        self.lower = np.asarray(lower, dtype=float)
+        self.upper = np.asarray(upper, dtype=float)
+        self.n_bins = n_bins
+        self.counts = np.zeros((len(self.lower), n_bins + 2), dtype=np.int64)
+
+    def update(self, values):
+        """
+        :param values: array (n_samples, n_values)
+        """
+        width = np.maximum(self.upper - self.lower, np.finfo(float).tiny)
+        valid = ~np.isnan(values)
+        bins = np.floor((np.where(valid, values, 0) - self.lower) / width * self.n_bins).astype(np.int64) + 1
+        bins = np.clip(bins, 0, self.n_bins + 1)
+        value_idx = np.broadcast_to(np.arange(values.shape[1]), values.shape)
+        np.add.at(self.counts, (value_idx[valid], bins[valid]), 1)
+
+    def merge(self, other):
+        if not (np.array_equal(self.lower, other.lower) and np.array_equal(self.upper, other.upper)
+                and self.n_bins == other.n_bins):
+            raise Exception("Histogram sketches with different bins can not be merged.")
+        self.counts += other.counts
+
+    def quantiles(self, q):
+        """
+        Quantiles of each value, linear interpolation within the bins;
+        values in the underflow/overflow bins are taken as the range bounds.
+        :param q: array of probabilities
+        :return: array (len(q), n_values)
+        """
+        q = np.atleast_1d(q)
+        cdf = np.cumsum(self.counts, axis=1)
+        total = np.maximum(cdf[:, -1:], 1)
+        edges = np.concatenate([[0], np.arange(self.n_bins + 1)])
+        result = np.empty((len(q), len(self.lower)))
+        for i, p in enumerate(q):
+            target = p * total
+            j = np.minimum(np.argmax(cdf >= target, axis=1), self.n_bins + 1)
+            prev = np.where(j > 0, np.take_along_axis(cdf, np.maximum(j - 1, 0)[:, None], axis=1)[:, 0], 0)
+            count = np.maximum(self.counts[np.arange(len(j)), j], 1)
+            frac = np.clip((target[:, 0] - prev) / count, 0, 1)
+            # bin j covers [edges[j], edges[j] + 1) in bin units, outer bins are collapsed to the bounds
+            pos = np.where((j == 0) | (j == self.n_bins + 1), edges[j], edges[j] + frac)
+            result[i] = self.lower + (self.upper - self.lower) * np.clip(pos, 0, self.n_bins) / self.n_bins
+        return result
+
+    def state(self):
+        return dict(lower=self.lower, upper=self.upper, counts=self.counts)
+
+    @staticmethod
+    def from_state(state):
+        sketch = HistogramSketch(state["lower"], state["upper"], np.shape(state["counts"])[1] - 2)
+        sketch.counts = np.array(state["counts"], dtype=np.int64)
+        return sketch
+
+
+class LevelStats:
+    """
+    Online statistics of an MLMC level: moments of the fine values and of the fine - coarse differences,
+    histogram sketch of the fine values.
+    """
+
+    def __init__(self, lower, upper, n_bins=100):
+        self.fine = RunningMoments(len(lower))
+        self.diff = RunningMoments(len(lower))
+        self.histogram = HistogramSketch(lower, upper, n_bins)
+
+    def update(self, fine, coarse):
+        """
+        :param fine: array (n_samples, n_values)
+        :param coarse: array (n_samples, n_values), zeros on the first level
+        """
+        self.fine.update(fine)
+        self.diff.update(fine - coarse)
+        self.histogram.update(fine)
+
+    def merge(self, other):
+        self.fine.merge(other.fine)
+        self.diff.merge(other.diff)
+        self.histogram.merge(other.histogram)
+
+
+def mlmc_estimate(levels, value_slice=slice(None)):
+    """
+    MLMC estimate of the mean: sum of the level means of the differences, variance of the estimate sum(V_l / n_l).
+    :param levels: list of LevelStats
+    :return: mean, variance of the mean; arrays (n_values,)
+    """
+    mean = sum(level.diff.mean[value_slice] for level in levels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = sum(level.diff.variance[value_slice] / level.diff.n[value_slice] for level in levels)
+    return mean, variance
+
+
+class OnlineStatsStorage(SampleStorageHDF):
+    """
+    SampleStorageHDF which updates the online statistics (LevelStats of every level) by each batch
+    of the collected samples and keeps their state in the group 'online_stats' of the same HDF file.
+    """
+
+    def __init__(self, file_path, value_ranges, n_bins=100):
+        """
+        :param file_path: HDF file
+        :param value_ranges: function q_specs -> (lower, upper) arrays of the flat result, ranges of the histograms
+        :param n_bins: number of histogram bins
+        """
+        super().__init__(file_path)
+        self.file_path = file_path
+        self.value_ranges = value_ranges
+        self.n_bins = n_bins
+        self.levels = self.load_stats()
+        if not self.levels and any(n > 0 for n in mlmc_levels.n_collected(self)):
+            # samples collected without the online statistics (e.g. resumed campaign)
+            self.rebuild_stats()
+
+    def load_stats(self):
+        """
+        :return: list of LevelStats, empty if there is no state in the file
+        """
+        levels = []
+        with h5py.File(self.file_path, "a") as f:
+            if STATS_GROUP not in f:
+                return levels
+            group = f[STATS_GROUP]
+            for level_id in range(len(group)):
+                level_group = group[str(level_id)]
+                histogram = HistogramSketch.from_state({k: v[()] for k, v in level_group["histogram"].items()})
+                stats = LevelStats(histogram.lower, histogram.upper, histogram.n_bins)
+                stats.histogram = histogram
+                stats.fine = RunningMoments.from_state({k: v[()] for k, v in level_group["fine"].items()})
+                stats.diff = RunningMoments.from_state({k: v[()] for k, v in level_group["diff"].items()})
+                levels.append(stats)
+        return levels
+
+    def rebuild_stats(self):
+        """
+        Compute the statistics from all collected samples.
+        """
+        lower, upper = self.value_ranges(self.load_result_format())
+        self.levels = []
+        for level_pairs in mlmc_levels.collected_pairs(self):
+            stats = LevelStats(lower, upper, self.n_bins)
+            if len(level_pairs) > 0:
+                # (n_values, n_samples, 2) -> (n_samples, n_values), the first level has only the fine values
+                fine = level_pairs[:, :, 0].T
+                coarse = level_pairs[:, :, 1].T if level_pairs.shape[2] > 1 else np.zeros_like(fine)
+                stats.update(fine, coarse)
+            self.levels.append(stats)
+        self.save_stats()
+
+    def save_stats(self):
+        with h5py.File(self.file_path, "a") as f:
+            if STATS_GROUP in f:
+                del f[STATS_GROUP]
+            group = f.create_group(STATS_GROUP)
+            for level_id, stats in enumerate(self.levels):
+                level_group = group.create_group(str(level_id))
+                for name, state in [("fine", stats.fine.state()), ("diff", stats.diff.state()),
+                                    ("histogram", stats.histogram.state())]:
+                    state_group = level_group.create_group(name)
+                    for key, values in state.items():
+                        state_group.create_dataset(key, data=values)
+
+    def save_samples(self, successful, failed):
+        super().save_samples(successful, failed)
+        if not any(len(samples) > 0 for samples in successful.values()):
+            return
+        n_levels = len(self.get_level_ids())
+        if len(self.levels) < n_levels:
+            lower, upper = self.value_ranges(self.load_result_format())
+            self.levels += [LevelStats(lower, upper, self.n_bins) for _ in range(n_levels - len(self.levels))]
+        for level_id, samples in successful.items():
+            if len(samples) == 0:
+                continue
+            fine = np.array([np.asarray(result[0], dtype=float).ravel() for sample_id, result in samples])
+            coarse = np.array([np.asarray(result[1], dtype=float).ravel() for sample_id, result in samples])
+            self.levels[level_id].update(fine, coarse)
+        self.save_stats()
+
+    def estimate(self, value_slice=slice(None)):
+        """
+        :return: MLMC mean, its RMSE; arrays over the values of the slice
+        """
+        mean, variance = mlmc_estimate(self.levels, value_slice)
+        return mean, np.sqrt(variance)
@@ -0,0 +1,431 @@
+import os
+import re
+import sys
+import time
+import glob
+import pickle
+import signal
+import argparse
+import subprocess
+import multiprocessing
+import numpy as np
+
+from mlmc.sampling_pool import SamplingPool
+from mesh_cache import file_lock
+from completion import CompletionJournal
+
+# directory of the queue in the output dir of the work dir
+PACKED_DIR = "packed"
+# samples to compute, lines 'level_id sample_id seed', appended by the main process
+QUEUE_FILE = "queue.txt"
+# claims of the samples, lines 'sample_id job_name', the last line of a sample holds, RELEASED returns it to the queue
+CLAIMS_FILE = "claims.txt"
+RELEASED = "-"
+LOCK_FILE = "queue.lock"
+# <sample_id>.pkl: (level_id, result, err_msg, running_time), written as soon as the sample is finished
+RESULTS_DIR = "results"
+# ids of the finished samples in order of completion, see completion.CompletionJournal
+JOURNAL_FILE = "completed.journal"
+JOBS_DIR = "jobs"
+LEVEL_SIM_CONFIG = "level_{}_simulation_config"
+# states of qstat meaning the job is not running anymore
+FINISHED_STATES = ["F", "X"]
+
+
+def parse_walltime(walltime):
+    """
+    :param walltime: 'HH:MM:SS', 'MM:SS' or seconds
+    :return: seconds
+    """
+    if isinstance(walltime, str) and ":" in walltime:
+        seconds = 0
+        for part in walltime.split(":"):
+            seconds = 60 * seconds + float(part)
+        return seconds
+    return float(walltime)
+
+
+class SampleQueue:
+    """
+    Queue of samples shared by the main process and the PBS jobs through files of a directory
+    on the shared file system. The queue and the claims are append only files, every change is done
+    under a POSIX lock, so any number of workers of any number of jobs can take samples.
+    A claim of a sample not finished by its job (walltime, node failure) is released
+    and the sample is computed by another job.
+    """
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        self.queue_file = os.path.join(queue_dir, QUEUE_FILE)
+        self.claims_file = os.path.join(queue_dir, CLAIMS_FILE)
+        self.lock_file = os.path.join(queue_dir, LOCK_FILE)
+        self.results_dir = os.path.join(queue_dir, RESULTS_DIR)
+        os.makedirs(self.results_dir, mode=0o775, exist_ok=True)
+        self.journal = CompletionJournal(os.path.join(queue_dir, JOURNAL_FILE))
+
+    def put(self, tasks):
+        """
+        :param tasks: list of (level_id, sample_id, seed)
+        """
+        if not tasks:
+            return
+        with file_lock(self.lock_file):
+            with open(self.queue_file, "a") as f:
+                f.write("".join("{} {} {}\n".format(*task) for task in tasks))
+
+    def _read(self):
+        """
+        :return: list of tasks, dict sample_id -> job_name of the last claim
+        """
+        tasks = []
+        if os.path.isfile(self.queue_file):
+            with open(self.queue_file, "r") as f:
+                for line in f:
+                    level_id, sample_id, seed = line.split()
+                    tasks.append((int(level_id), sample_id, int(seed)))
+        claims = {}
+        if os.path.isfile(self.claims_file):
+            with open(self.claims_file, "r") as f:
+                for line in f:
+                    sample_id, job_name = line.split()
+                    claims[sample_id] = job_name
+        return tasks, claims
+
+    def _append_claims(self, claims):
+        with open(self.claims_file, "a") as f:
+            f.write("".join("{} {}\n".format(sample_id, job_name) for sample_id, job_name in claims))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def result_file(self, sample_id):
+        return os.path.join(self.results_dir, sample_id + ".pkl")
+
+    def has_result(self, sample_id):
+        return os.path.isfile(self.result_file(sample_id))
+
+    def _free(self, tasks, claims):
+        return [task for task in tasks
+                if claims.get(task[1], RELEASED) == RELEASED and not self.has_result(task[1])]
+
+    def claim(self, job_name):
+        """
+        Take the first free sample.
+        :return: (level_id, sample_id, seed), None if there is no free sample
+        """
+        with file_lock(self.lock_file):
+            free = self._free(*self._read())
+            if free:
+                self._append_claims([(free[0][1], job_name)])
+                return free[0]
+        return None
+
+    def release(self, job_name):
+        """
+        Return the unfinished samples claimed by the job into the queue.
+        :return: list of released sample ids
+        """
+        with file_lock(self.lock_file):
+            tasks, claims = self._read()
+            released = [sample_id for sample_id, job in claims.items()
+                        if job == job_name and not self.has_result(sample_id)]
+            self._append_claims([(sample_id, RELEASED) for sample_id in released])
+        return released
+
+    def free_tasks(self):
+        """
+        :return: samples nobody works on
+        """
+        with file_lock(self.lock_file):
+            tasks, claims = self._read()
+        return self._free(tasks, claims)
+
+    def save_result(self, sample_id, level_id, result, err_msg, running_time):
+        """
+        Store the result of a sample, the file appears complete (rename), then the sample is announced in the journal.
+        """
+        fname = self.result_file(sample_id)
+        tmp_file = fname + ".tmp{}".format(os.getpid())
+        with open(tmp_file, "wb") as f:
+            pickle.dump((level_id, result, err_msg, running_time), f)
+        os.replace(tmp_file, fname)
+        self.journal.append([sample_id])
+
+    def load_result(self, sample_id):
+        with open(self.result_file(sample_id), "rb") as f:
+            return pickle.load(f)
+
+    def finished_ids(self):
+        """
+        :return: ids of the samples finished since the last call, read from the journal
+        """
+        return self.journal.read_new()
+
+
+class SamplingPoolPackedPBS(SamplingPool):
+    """
+    PBS sampling pool with packed jobs. Scheduled samples go into the shared SampleQueue,
+    PBS jobs run a pool of workers (run_job) which take samples from the queue
+    until the walltime budget of the job is spent or the queue stays empty.
+    Jobs are submitted when the predicted cost (task_size) of the free samples needs them.
+    Results are stored per sample as soon as they are computed, so a killed job loses only its running samples,
+    they are returned into the queue when the job is seen finished.
+    """
+
+    def __init__(self, work_dir, pbs_config, packed_config, debug=False):
+        """
+        :param work_dir: work directory
+        :param pbs_config: PBS settings (config_PBS.yaml): n_nodes, n_cores, mem, queue, walltime,
+                           optional: select_flags, optional_pbs_requests, env_setting, python, pbs_name
+        :param packed_config: 'packed_pbs' section of config.yaml
+        :param debug: keep sample directories
+        """
+        super().__init__(work_dir=work_dir, debug=debug)
+        self._packed_dir = self._create_dir(PACKED_DIR)
+        self._jobs_dir = os.path.join(self._packed_dir, JOBS_DIR)
+        os.makedirs(self._jobs_dir, mode=0o775, exist_ok=True)
+        self._queue = SampleQueue(self._packed_dir)
+        self._pbs_config = pbs_config
+        self._packed_config = packed_config
+        self._qsub = packed_config.get("qsub", None) or ["qsub"]
+        self._qstat = packed_config.get("qstat", None) or ["qstat", "-x"]
+        # qstat is called at most once per job_check_interval [s]
+        self._job_check_interval = packed_config.get("job_check_interval", 60)
+        self._last_job_check = None
+
+        # scheduled samples not put into the queue yet
+        self._pending = []
+        # sample_id -> level_id of the samples not collected yet
+        self._scheduled = {}
+        # task_size of the levels
+        self._task_sizes = {}
+        # job name -> PBS id of the submitted jobs not seen finished
+        self._jobs = {}
+        self._job_count = len(glob.glob(os.path.join(self._jobs_dir, "*_job.sh")))
+
+    def schedule_sample(self, sample_id, level_sim):
+        level_id = level_sim._level_id
+        file_path = os.path.join(self._packed_dir, LEVEL_SIM_CONFIG.format(level_id))
+        if not os.path.exists(file_path):
+            with open(file_path, "wb") as f:
+                pickle.dump(level_sim, f)
+        self._task_sizes[level_id] = level_sim.task_size
+        self._pending.append((level_id, sample_id, self.compute_seed(sample_id)))
+        self._scheduled[sample_id] = level_id
+
+    def have_permanent_samples(self, sample_ids):
+        """
+        Samples scheduled before a restart of the main process, collected when their results appear.
+        """
+        for sample_id in sample_ids:
+            self._scheduled[sample_id] = int(re.findall(r'L0?(\d*)', sample_id)[0])
+
+    def get_finished(self):
+        """
+        Put the new samples into the queue, check the jobs, submit new ones and collect the results.
+        :return: successful, failed, n_running, times (see SamplingPool.get_finished)
+        """
+        new_samples = len(self._pending) > 0
+        self._queue.put(self._pending)
+        self._pending = []
+        now = time.monotonic()
+        if new_samples or self._last_job_check is None or now - self._last_job_check > self._job_check_interval:
+            self._last_job_check = now
+            self._check_jobs()
+            self._submit_jobs()
+
+        successful = {}
+        failed = {}
+        times = {}
+        for sample_id in self._queue.finished_ids():
+            if sample_id not in self._scheduled:
+                continue
+            level_id, result, err_msg, running_time = self._queue.load_result(sample_id)
+            # running times of the failed samples count as well, as in OneProcessPool
+            level_times = times.setdefault(level_id, [0.0, 0])
+            level_times[0] += running_time
+            level_times[1] += 1
+            if err_msg:
+                failed.setdefault(level_id, []).append((sample_id, err_msg))
+            else:
+                successful.setdefault(level_id, []).append((sample_id, (result[0], result[1])))
+            del self._scheduled[sample_id]
+        return successful, failed, len(self._scheduled), list(times.items())
+
+    def wait_finished(self, timeout):
+        """
+        Wait until a sample is announced in the journal or timeout.
+        :return: True if some sample finished
+        """
+        return self._queue.journal.wait(timeout, poll_interval=self._packed_config.get("poll_interval", 0.5))
+
+    def _check_jobs(self):
+        """
+        Remove finished jobs, their unfinished samples are released into the queue.
+        """
+        if not self._jobs:
+            return
+        states = self.qstat(list(self._jobs.values()))
+        for job_name, pbs_id in list(self._jobs.items()):
+            done_file = os.path.join(self._jobs_dir, job_name + ".done")
+            if states.get(pbs_id, "F") in FINISHED_STATES or os.path.isfile(done_file):
+                released = self._queue.release(job_name)
+                if released:
+                    print("Job {} finished, {} unfinished samples returned to the queue".format(job_name, len(released)))
+                del self._jobs[job_name]
+
+    def qstat(self, pbs_ids):
+        """
+        :return: dict pbs_id -> state, jobs unknown to PBS are missing
+        """
+        process = subprocess.run(self._qstat + pbs_ids, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.stdout.decode("ascii", errors="replace")
+        if process.returncode != 0 and not re.search(r"Unknown Job Id", process.stderr.decode("ascii", errors="replace")):
+            print("qstat failed: ", process.stderr.decode("ascii", errors="replace"))
+            # states unknown, jobs are considered running
+            return {pbs_id: "R" for pbs_id in pbs_ids}
+        states = {}
+        for line in output.splitlines():
+            tokens = line.split()
+            if len(tokens) < 2:
+                continue
+            pbs_id = tokens[0].split(".")[0]
+            if pbs_id in pbs_ids:
+                states[pbs_id] = tokens[-2]
+        return states
+
+    def _submit_jobs(self):
+        """
+        Submit jobs for the free samples, a job gets about its share of the predicted cost (sum of task_size),
+        at most 'max_jobs' jobs are active.
+        """
+        free = self._queue.free_tasks()
+        if not free:
+            return
+        cost = sum(self._task_sizes.get(level_id, 1.0) for level_id, sample_id, seed in free)
+        n_jobs = min(self._packed_config.get("max_jobs", 10), max(int(np.ceil(cost)), 1))
+        for i in range(n_jobs - len(self._jobs)):
+            self.submit_job()
+
+    def job_script(self, job_name):
+        """
+        :return: lines of the PBS script of a packed job
+        """
+        config = self._pbs_config
+        select_flags = "".join(":{}={}".format(*item) for item in (config.get("select_flags", None) or {}).items())
+        n_workers = self._packed_config.get("n_workers", None) or config["n_cores"]
+        budget = parse_walltime(config["walltime"]) - self._packed_config.get("walltime_margin", 300)
+        script = os.path.abspath(__file__)
+        lines = ["#!/bin/bash",
+                 "#PBS -S /bin/bash",
+                 "#PBS -l select={}:ncpus={}:mem={}{}".format(config["n_nodes"], config["n_cores"], config["mem"],
+                                                              select_flags),
+                 "#PBS -l walltime={}".format(config["walltime"]),
+                 "#PBS -q {}".format(config["queue"]),
+                 "#PBS -N {}".format(config.get("pbs_name", "packed")),
+                 "#PBS -j oe",
+                 "#PBS -o {}".format(os.path.join(self._jobs_dir, job_name + ".OU"))]
+        lines.extend(config.get("optional_pbs_requests", None) or [])
+        lines.extend(config.get("env_setting", None) or [])
+        lines.append("cd {}".format(os.path.dirname(script)))
+        lines.append("{} {} {} {} --n_workers {} --budget {} --idle_timeout {} > {} 2>&1".format(
+            config.get("python", "python3"), script, self._packed_dir, job_name, n_workers, budget,
+            self._packed_config.get("idle_timeout", 120), os.path.join(self._jobs_dir, job_name + "_STDOUT")))
+        return lines
+
+    def submit_job(self):
+        job_name = "{:04d}".format(self._job_count)
+        job_file = os.path.join(self._jobs_dir, job_name + "_job.sh")
+        with open(job_file, "w") as f:
+            f.write("\n".join(self.job_script(job_name)) + "\n")
+        os.chmod(job_file, 0o774)
+        process = subprocess.run(self._qsub + [job_file], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise Exception("qsub failed: " + process.stderr.decode("ascii", errors="replace"))
+        pbs_id = process.stdout.decode("ascii").strip().split(".")[0]
+        with open(os.path.join(self._jobs_dir, "{}_{}".format(job_name, pbs_id)), "w"):
+            pass
+        self._jobs[job_name] = pbs_id
+        self._job_count += 1
+        print("Packed job {} submitted, PBS id {}".format(job_name, pbs_id))
+
+
+def _worker(packed_dir, job_name, deadline, idle_timeout, poll_interval):
+    """
+    Take samples from the queue and compute them until the deadline or until the queue stays empty.
+    A sample is started only if the longest sample computed by the worker still fits before the deadline.
+    :return: None
+    """
+    # killed directly by the SIGTERM of the batch system or by the job process
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    queue = SampleQueue(packed_dir)
+    output_dir = os.path.dirname(packed_dir)
+    level_sims = {}
+    longest = 0
+    idle_start = time.monotonic()
+    while time.monotonic() + longest < deadline:
+        task = queue.claim(job_name)
+        if task is None:
+            if time.monotonic() - idle_start > idle_timeout:
+                break
+            time.sleep(poll_interval)
+            continue
+        level_id, sample_id, seed = task
+        if level_id not in level_sims:
+            with open(os.path.join(packed_dir, LEVEL_SIM_CONFIG.format(level_id)), "rb") as f:
+                level_sims[level_id] = pickle.load(f)
+        level_sim = level_sims[level_id]
+
+        start = time.monotonic()
+        sample_id, result, err_msg, running_time = SamplingPool.calculate_sample(sample_id, level_sim,
+                                                                                 work_dir=output_dir, seed=seed)
+        queue.save_result(sample_id, level_id, result, err_msg, running_time)
+        if err_msg:
+            SamplingPool.move_failed_rm(sample_id, level_sim, output_dir=output_dir, dest_dir=SamplingPool.FAILED_DIR)
+        elif not level_sim.config_dict.get("debug", False):
+            SamplingPool.move_successful_rm(sample_id, level_sim, output_dir=output_dir,
+                                            dest_dir=os.path.join(output_dir, SamplingPool.SEVERAL_SUCCESSFUL_DIR))
+        os.chdir(packed_dir)
+        longest = max(longest, time.monotonic() - start)
+        idle_start = time.monotonic()
+
+
+def run_job(packed_dir, job_name, n_workers, budget, idle_timeout=120, poll_interval=5):
+    """
+    Body of a packed PBS job, 'n_workers' processes compute samples from the queue.
+    On exit (also on SIGTERM at the walltime) the unfinished samples of the job are released.
+    :param budget: time the job may spend computing [s]
+    :return: None
+    """
+    deadline = time.monotonic() + budget
+    queue = SampleQueue(packed_dir)
+    workers = [multiprocessing.Process(target=_worker, args=(packed_dir, job_name, deadline, idle_timeout, poll_interval))
+               for i in range(n_workers)]
+
+    def terminate(signum, frame):
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+        raise SystemExit(1)
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    finally:
+        released = queue.release(job_name)
+        with open(os.path.join(packed_dir, JOBS_DIR, job_name + ".done"), "w") as f:
+            f.write("released: {}\n".format(len(released)))
+        print("Job {} finished, {} samples released".format(job_name, len(released)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("packed_dir", help="Directory of the sample queue")
+    parser.add_argument("job_name", help="Name of the job")
+    parser.add_argument("--n_workers", type=int, default=1, help="Number of concurrent samples")
+    parser.add_argument("--budget", type=float, required=True, help="Time for computation [s]")
+    parser.add_argument("--idle_timeout", type=float, default=120, help="Time to wait for new samples [s]")
+    args = parser.parse_args(sys.argv[1:])
+    run_job(args.packed_dir, args.job_name, args.n_workers, args.budget, args.idle_timeout)
@@ -0,0 +1,95 @@
+import os
+import multiprocessing
+import numpy as np
+
+import mlmc_levels
+
+
+def pyplot():
+    """
+    Import pyplot with the non-interactive Agg backend, only where plotting is actually done.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def observe_pressure_figure(times, values, point_names, fname):
+    """
+    Plot pressure evolution in the observe points.
+    :param times: array (n_times,)
+    :param values: array (n_points, n_times)
+    :param point_names: list of names of observe points
+    :param fname: output file
+    :return: None
+    """
+    plt = pyplot()
+    fig, ax1 = plt.subplots()
+    temp_color = ['red', 'green', 'violet', 'blue']
+    ax1.set_xlabel('time [d]')
+    ax1.set_ylabel('pressure [m]')
+    for i in range(0, len(point_names)):
+        ax1.plot(times, values[i, 0:], color=temp_color[i % len(temp_color)], label=point_names[i])
+
+    ax1.tick_params(axis='y')
+    ax1.legend()
+
+    fig.tight_layout()  # otherwise the right y-label is slightly clipped
+    fig.savefig(fname)
+    plt.close(fig)
+
+
+def _plot_chunk(args):
+    times, point_names, chunk = args
+    for fname, values in chunk:
+        observe_pressure_figure(times, values, point_names, fname)
+    return len(chunk)
+
+
+def plot_collected(sample_storage, q_specs, plot_dir, quantity="pressure", n_samples=None, n_processes=None, seed=None):
+    """
+    Plot collected time series of all (or randomly chosen 'n_samples') samples of every level,
+    figures are rendered in a process pool.
+    :param sample_storage: SampleStorageHDF
+    :param q_specs: simulation result format (endorse_2Dtest.quantity_specs), see mlmc_levels.quantity_slice
+    :param plot_dir: output directory, files L<level>_<sample index>_<quantity>.pdf
+    :param quantity: name of the collected quantity
+    :param n_samples: number of plotted samples per level, None - all
+    :param n_processes: number of processes, default number of cores
+    :param seed: seed of the sample selection
+    :return: number of created figures
+    """
+    os.makedirs(plot_dir, mode=0o775, exist_ok=True)
+    offset = 0
+    for q_spec in q_specs:
+        size = int(np.prod(q_spec.shape)) * len(q_spec.times) * len(q_spec.locations)
+        if q_spec.name == quantity:
+            break
+        offset += size
+    else:
+        raise Exception("Unknown quantity: {}".format(quantity))
+
+    rng = np.random.RandomState(seed)
+    figures = []
+    for level_id, level_pairs in enumerate(mlmc_levels.collected_pairs(sample_storage)):
+        if len(level_pairs) == 0:
+            continue
+        # (M, N, 2) -> fine values (N, n_times, n_locations, n_comp)
+        fine = level_pairs[offset:offset + size, :, 0].T
+        fine = fine.reshape(-1, len(q_spec.times), len(q_spec.locations), int(np.prod(q_spec.shape)))
+        indices = np.arange(len(fine))
+        if n_samples is not None and n_samples < len(fine):
+            indices = np.sort(rng.choice(indices, n_samples, replace=False))
+        for i in indices:
+            fname = os.path.join(plot_dir, "L{:02d}_{:07d}_{}.pdf".format(level_id, i, quantity))
+            figures.append((fname, fine[i, :, :, 0].T))
+
+    if n_processes is None:
+        n_processes = os.cpu_count()
+    chunk_size = max(1, int(np.ceil(len(figures) / n_processes)))
+    tasks = [(q_spec.times, q_spec.locations, figures[i:i + chunk_size])
+             for i in range(0, len(figures), chunk_size)]
+    with multiprocessing.Pool(n_processes) as pool:
+        n_figures = sum(pool.map(_plot_chunk, tasks))
+    return n_figures
@@ -1,14 +1,26 @@
 import gmsh
 import os
+import re
 import sys
 import shutil
 import ruamel.yaml as yaml
 
 from flow_mc_new import endorse_2Dtest
+import mesh_pregen
+import plots
+import aux_storage
+import cpu_slots
+import mlmc_levels
+import cost_model
+import completion
+import packed_pool
+import virtual_sensors
+import online_stats
+import analysis
 
 from mlmc.sampler import Sampler
 from mlmc.sample_storage_hdf import SampleStorageHDF
-from mlmc.sampling_pool import OneProcessPool, ProcessPool, ThreadPool
+from mlmc.sampling_pool import OneProcessPool, ThreadPool
 from mlmc.sampling_pool_pbs import SamplingPoolPBS
 from mlmc.sim.simulation import QuantitySpec
 from mlmc.tool import process_base
@@ -20,18 +32,136 @@ import matplotlib.pyplot as plt
 
 class WGC2020_Process(process_base.ProcessBase):
 
+    # post-processing commands, not known to ProcessBase
+    extra_commands = ["plot", "report", "resume", "sensors", "analyze"]
+
     def __init__(self):
         #TODO: separate constructor and run call
         #TODO: should there be different config for Process and Simulation ?
         with open(os.path.join(os.getcwd(), "config.yaml"), "r") as f:
             self.config_dict = yaml.safe_load(f)
         self.config_dict["config_pbs"] = os.path.join(os.getcwd(), "config_PBS.yaml")
-        super(WGC2020_Process, self).__init__()
+        if len(sys.argv) > 1 and sys.argv[1] in WGC2020_Process.extra_commands:
+            self.run_extra_command(sys.argv[1:])
+        else:
+            super(WGC2020_Process, self).__init__()
+
+    def run_extra_command(self, arguments):
+        """
+        Parse arguments of the post-processing commands and run the command.
+        :param arguments: command line arguments
+        :return: None
+        """
+        import argparse
+        parser = argparse.ArgumentParser()
+        parser.add_argument('command', choices=WGC2020_Process.extra_commands,
+                            help='plot - plot collected samples, report - stage times of the samples, '
+                                 'resume - continue the campaign, reuse finished samples and schedule the missing ones, '
+                                 'sensors - evaluate virtual sensors in the VTK output of the samples, '
+                                 'analyze - moments of the collected samples for all quantities and times')
+        parser.add_argument('work_dir', help='Work directory')
+        parser.add_argument("-n", "--n_samples", type=int, default=None,
+                            help="Number of randomly chosen samples per level, default all")
+        parser.add_argument("-p", "--n_processes", type=int, default=None,
+                            help="Number of processes, default number of cores")
+        parser.add_argument("-d", "--debug", default=False, action='store_true',
+                            help="Keep sample directories")
+        args = parser.parse_args(arguments)
+
+        self.work_dir = os.path.abspath(args.work_dir)
+        self.clean = False
+        self.debug = args.debug
+        if args.command == 'plot':
+            self.plot(n_samples=args.n_samples, n_processes=args.n_processes)
+        elif args.command == 'report':
+            self.report()
+        elif args.command == 'resume':
+            self.run(resume=True)
+        elif args.command == 'sensors':
+            self.sensors(n_processes=args.n_processes)
+        elif args.command == 'analyze':
+            self.analyze()
+
+    def hdf_file(self):
+        return os.path.join(self.work_dir, "wgc2020_mlmc.hdf5")
 
-    def run(self, renew=False):
+    def open_sample_storage(self):
+        hdf_file = self.hdf_file()
+        if not os.path.exists(hdf_file):
+            raise Exception("Sample storage '{}' does not exist.".format(hdf_file))
+        return SampleStorageHDF(file_path=hdf_file)
+
+    def plot(self, n_samples=None, n_processes=None):
+        """
+        Plot collected pressure of the samples in the observe points, figures go to <work_dir>/plots.
+        :param n_samples: number of randomly chosen samples per level, None - all samples
+        :param n_processes: size of the process pool
+        :return: None
+        """
+        sample_storage = self.open_sample_storage()
+        plot_dir = os.path.join(self.work_dir, "plots")
+        n_figures = plots.plot_collected(sample_storage, endorse_2Dtest.quantity_specs(self.config_dict), plot_dir,
+                                         quantity="pressure",
+                                         n_samples=n_samples, n_processes=n_processes)
+        print("{} figures saved to {}".format(n_figures, plot_dir))
+
+    def sensors(self, n_processes=None):
+        """
+        Evaluate the virtual sensors ('virtual_sensors' in config.yaml) in the VTK output of the kept sample
+        directories and of the archived audit samples, values go to <work_dir>/virtual_sensors.hdf5.
+        :param n_processes: size of the process pool
+        :return: None
+        """
+        times = endorse_2Dtest.output_times(self.config_dict)
+        n_samples = virtual_sensors.collect_sensors(self.config_dict, self.work_dir, times, n_processes=n_processes)
+        print("Virtual sensors of {} samples stored in {}".format(
+            n_samples, os.path.join(self.work_dir, virtual_sensors.SENSORS_FILE)))
+
+    def analyze(self):
+        """
+        MLMC estimates of the moments ('analysis' in config.yaml) of the collected samples
+        for all locations and times at once, results go to <work_dir>/analysis.npz.
+        :return: dict of result arrays, see analysis.analyze
+        """
+        sample_storage = self.open_sample_storage()
+        analysis_config = self.config_dict.get("analysis", None) or {}
+        result = analysis.analyze(sample_storage, endorse_2Dtest.quantity_specs(self.config_dict),
+                                  quantities=analysis_config.get("quantities", None),
+                                  n_moments=analysis_config.get("n_moments", 5),
+                                  moments_name=analysis_config.get("moments", "legendre"),
+                                  quantile=analysis_config.get("quantile", 0.01),
+                                  n_bootstrap=analysis_config.get("n_bootstrap", 100),
+                                  confidence=analysis_config.get("confidence", 0.95))
+        result_file = os.path.join(self.work_dir, "analysis.npz")
+        np.savez(result_file, **result)
+        for i_q, label in enumerate(result["labels"]):
+            print("{}: mean at the last time {}, RMSE {}".format(
+                label, result["mean"][i_q, :, -1], np.sqrt(result["mean_variance"][i_q, :, -1])))
+        print("Moments of {} samples per level saved to {}".format(list(result["n_samples"]), result_file))
+        return result
+
+    def collect_aux(self):
+        """
+        Store auxiliary records of the samples (stage times, Flow123d run and solver statistics) into the HDF file.
+        :return: None
+        """
+        n_samples = aux_storage.collect_aux(self.work_dir, self.hdf_file())
+        print("Auxiliary records of {} samples stored.".format(n_samples))
+
+    def report(self):
+        """
+        Print percentiles of the stage times and memory across the samples.
+        :return: None
+        """
+        self.open_sample_storage()
+        self.collect_aux()
+        print("\n".join(aux_storage.stage_report(self.hdf_file())))
+
+    def run(self, renew=False, resume=False):
         """
         Run MLMC
         :param renew: If True then rerun failed samples with same sample id
+        :param resume: If True then continue the campaign in the work dir, see resume_samples
         :return: None
         """
 
@@ -40,13 +170,24 @@ class WGC2020_Process(process_base.ProcessBase):
         self.config_dict["work_dir"] = self.work_dir
         self.config_dict["script_dir"] = os.getcwd()
 
+        # Build meshes in advance, samples then only take them from the mesh repository
+        if self.config_dict.get("mesh_pregeneration", {}).get("enabled", False):
+            self.pregenerate_meshes()
+            if self.config_dict["mesh_only"]:
+                return
+
         # Create sampler (mlmc.Sampler instance) - crucial class which actually schedule samples
-        sampler = self.setup_config(n_levels=1, clean=True)
+        level_parameters = mlmc_levels.level_parameters(self.config_dict)
+        sampler = self.setup_config(n_levels=len(level_parameters), clean=not resume, resume=resume)
         # Schedule samples
-        n_samples = self.config_dict["n_samples"]
+        n_samples = mlmc_levels.initial_n_samples(self.config_dict, sampler.n_levels)
         self.generate_jobs(sampler, n_samples=n_samples, renew=renew)
+        if not renew and (self.config_dict.get("mlmc", None) or {}).get("target_rmse", None):
+            self.adaptive_sampling(sampler)
 
         self.all_collect([sampler])  # Check if all samples are finished
+        self.collect_aux()
+        self.update_cost_model(sampler)
         # if n_samples > 1:
         #     self.calculate_moments(sampler)  # Simple moment check
 
@@ -56,7 +197,17 @@ class WGC2020_Process(process_base.ProcessBase):
         # self.get_some_results(sampler.sample_storage)
 
 
-    def setup_config(self, n_levels, clean):
+    def pregenerate_meshes(self):
+        """
+        Mesh all geometry variants on the local cores before sampling
+        and let the samples draw from the resulting mesh repository.
+        :return: None
+        """
+        repo_dir, index_file = mesh_pregen.pregenerate_meshes(self.config_dict)
+        self.config_dict["mesh_repository"] = repo_dir
+        self.config_dict["mesh_repository_index"] = index_file
+
+    def setup_config(self, n_levels, clean, resume=False):
         """
         # TODO: specify, what should be done here.
         - creation of Simulation
@@ -68,31 +219,94 @@ class WGC2020_Process(process_base.ProcessBase):
         Simulation dependent configuration
         :param step_range: Simulation's step range, length of them is number of levels
         :param clean: bool, If True remove existing files
+        :param resume: bool, If True keep the sample storage and reuse the samples of the previous run
         :return: mlmc.sampler instance
         """
         self.set_environment_variables()
 
-        sampling_pool = self.create_sampling_pool()
-
         # Create simulation factory
         simulation_factory = endorse_2Dtest(config=self.config_dict, clean=clean)
+        level_parameters = mlmc_levels.level_parameters(self.config_dict)
+        assert len(level_parameters) == n_levels
 
         # Create HDF sample storage, possibly remove old one
-        hdf_file = os.path.join(self.work_dir, "wgc2020_mlmc.hdf5")
-        if self.clean:
+        hdf_file = self.hdf_file()
+        if self.clean and not resume:
             # Remove HFD5 file
             if os.path.exists(hdf_file):
                 os.remove(hdf_file)
-        sample_storage = SampleStorageHDF(
-            file_path=hdf_file)
+            # auxiliary records and the cost model of the previous campaign must not get into report and cost model
+            aux_dir = os.path.join(self.work_dir, aux_storage.AUX_DIR)
+            if os.path.isdir(aux_dir):
+                shutil.rmtree(aux_dir)
+            model_file = os.path.join(self.work_dir, cost_model.COST_MODEL_FILE)
+            if os.path.exists(model_file):
+                os.remove(model_file)
+        stats_config = self.config_dict.get("online_stats", None) or {}
+        if stats_config.get("enabled", False):
+            # statistics updated by each batch of collected samples, see online_stats
+            sample_storage = online_stats.OnlineStatsStorage(hdf_file, self.value_ranges,
+                                                             n_bins=stats_config.get("n_bins", 100))
+        else:
+            sample_storage = SampleStorageHDF(
+                file_path=hdf_file)
+
+        # samples of the previous run are collected before the sampling pool cleans the output dir
+        missing = []
+        if resume:
+            missing = self.resume_samples(simulation_factory, level_parameters, sample_storage)
+
+        sampling_pool = self.create_sampling_pool()
+        self.sampling_pool = sampling_pool
 
         # Create sampler, it manages sample scheduling and so on
         # the length of level_parameters must correspond to number of MLMC levels, at least 1 !!!
         sampler = Sampler(sample_storage=sample_storage, sampling_pool=sampling_pool, sim_factory=simulation_factory,
-                          level_parameters=[1])
+                          level_parameters=level_parameters)
 
+        # unfinished samples of the previous run are computed again with the same sample id (seed)
+        for level_id, sample_id in missing:
+            sampling_pool.schedule_sample(sample_id, sampler._level_sim_objects[level_id])
         return sampler
 
+    def resume_samples(self, simulation_factory, level_parameters, sample_storage):
+        """
+        Collect the samples scheduled but not collected in the previous run.
+        A sample with complete outputs in its sample directory (or with a result of a packed PBS job)
+        is only extracted and stored, collected samples are not touched.
+        :return: list of (level_id, sample_id) of the samples to compute again
+        """
+        unfinished = sample_storage.unfinished_ids()
+        print("Resume: {} unfinished samples of the previous run".format(len(unfinished)))
+        if not unfinished:
+            return []
+        output_dir = os.path.join(self.work_dir, "output")
+        packed_queue = packed_pool.SampleQueue(os.path.join(output_dir, packed_pool.PACKED_DIR))
+        level_configs = [simulation_factory.level_instance(params, level_parameters[l - 1] if l > 0 else [0]).config_dict
+                         for l, params in enumerate(level_parameters)]
+
+        successful = {}
+        failed = {}
+        missing = []
+        for sample_id in unfinished:
+            level_id = int(re.findall(r'L0?(\d*)', sample_id)[0])
+            if packed_queue.has_result(sample_id):
+                level, result, err_msg, running_time = packed_queue.load_result(sample_id)
+                if err_msg:
+                    failed.setdefault(level_id, []).append((sample_id, err_msg))
+                else:
+                    successful.setdefault(level_id, []).append((sample_id, (result[0], result[1])))
+                continue
+            result = endorse_2Dtest.collect_finished(level_configs[level_id], os.path.join(output_dir, sample_id))
+            if result is None:
+                missing.append((level_id, sample_id))
+            else:
+                successful.setdefault(level_id, []).append((sample_id, (result[0], result[1])))
+        sample_storage.save_samples(successful, failed)
+        print("Resume: {} samples extracted, {} failed, {} to compute".format(
+            sum(len(s) for s in successful.values()), sum(len(f) for f in failed.values()), len(missing)))
+        return missing
+
     def set_environment_variables(self):
         run_on_metacentrum = self.config_dict["run_on_metacentrum"]
 
@@ -109,8 +323,15 @@ class WGC2020_Process(process_base.ProcessBase):
             self.sample_sleep = 1
             self.init_sample_timeout = 60
             self.sample_timeout = 60
-            self.config_dict["_aux_flow_path"] = self.config_dict["local"]["flow_executable"].copy()
-            self.config_dict["_aux_gmsh_path"] = self.config_dict["local"]["gmsh_executable"].copy()
+            local = self.config_dict["local"]
+            self.config_dict["_aux_flow_path"] = local["flow_executable"].copy()
+            self.config_dict["_aux_gmsh_path"] = local["gmsh_executable"].copy()
+            flow_np = local.get("flow_np", 1)
+            if flow_np > 1:
+                mpiexec = local.get("mpiexec", None) or ["mpiexec"]
+                self.config_dict["_aux_flow_path"] = [*mpiexec, "-np", str(flow_np), *self.config_dict["_aux_flow_path"]]
+            # CPUs of the main process, samples are pinned to their disjoint subsets
+            self.config_dict["_local_cpus"] = cpu_slots.available_cpus()
 
     def create_sampling_pool(self):
         debug = self.config_dict["debug"]
@@ -119,9 +340,12 @@ class WGC2020_Process(process_base.ProcessBase):
                 #return OneProcessPool(work_dir=self.work_dir)
             #else:
             return self.create_pbs_sampling_pool(debug)
-        elif self.config_dict["local"]["np"] > 1:
+        n_processes = cpu_slots.local_concurrency(self.config_dict["local"], self.config_dict["_local_cpus"])
+        if n_processes > 1:
             # Simulations run in different processes
-            ProcessPool(n_processes=self.config_dict["local"]["np"], work_dir=self.work_dir)
+            print("Local run: {} concurrent samples, {} MPI processes each".format(
+                n_processes, self.config_dict["local"].get("flow_np", 1)))
+            return completion.NotifyingProcessPool(n_processes=n_processes, work_dir=self.work_dir, debug=debug)
         else:
             return OneProcessPool(work_dir=self.work_dir, debug=debug)
 
@@ -130,12 +354,18 @@ class WGC2020_Process(process_base.ProcessBase):
         Initialize object for PBS execution
         :return: None
         """
-        # Create PBS sampling pool
-        sampling_pool = SamplingPoolPBS(job_weight=1, work_dir=self.work_dir, clean=self.clean, debug=debug)
-
         with open(self.config_dict["config_pbs"], "r") as f:
             pbs_config = yaml.safe_load(f)
 
+        # jobs with an in-job worker pool taking samples from a shared queue
+        packed_config = self.config_dict.get("packed_pbs", None) or {}
+        if packed_config.get("enabled", False):
+            return packed_pool.SamplingPoolPackedPBS(work_dir=self.work_dir, pbs_config=pbs_config,
+                                                     packed_config=packed_config, debug=debug)
+
+        # Create PBS sampling pool
+        sampling_pool = SamplingPoolPBS(job_weight=1, work_dir=self.work_dir, clean=self.clean, debug=debug)
+
         sampling_pool.pbs_common_setting(flow_3=True, **pbs_config)
 
         return sampling_pool
@@ -152,12 +382,138 @@ class WGC2020_Process(process_base.ProcessBase):
         if renew:
             sampler.ask_sampling_pool_for_samples()
             sampler.renew_failed_samples()
-            sampler.ask_sampling_pool_for_samples(sleep=self.sample_sleep, timeout=self.sample_timeout)
+            self.wait_for_samples(sampler, timeout=self.sample_timeout)
         else:
             if n_samples is not None:
                 sampler.set_initial_n_samples(n_samples)
             sampler.schedule_samples()
-            sampler.ask_sampling_pool_for_samples(sleep=self.sample_sleep, timeout=self.sample_timeout)
+            self.wait_for_samples(sampler, timeout=self.sample_timeout)
+
+    def wait_for_samples(self, sampler, timeout=None):
+        """
+        Collect finished samples as soon as the sampling pool announces them, see completion.wait_for_samples.
+        :param timeout: maximal waiting time [s], None or 0 - until all samples are finished
+        :return: number of running samples
+        """
+        stop = None
+        if (self.config_dict.get("online_stats", None) or {}).get("target_rmse", None):
+            stop = lambda: self.online_converged(sampler)
+        return completion.wait_for_samples(sampler, self.sampling_pool, timeout=timeout, max_wait=self.sample_sleep,
+                                           stop=stop)
+
+    def value_ranges(self, q_specs):
+        """
+        Ranges of the online histograms of the values of the flat sample result given by
+        'online_stats: histogram_ranges' or by the valid ranges of the quantities ('extract', 'field_qois').
+        :param q_specs: stored result format, used only for the quantity names; the HDF storage keeps
+                        the locations of the first quantity for all quantities, the sizes are given
+                        by the simulation result format
+        :return: lower, upper; arrays (n_values,)
+        """
+        names = [q.name for q in q_specs]
+        q_specs = [q for q in endorse_2Dtest.quantity_specs(self.config_dict) if q.name in names]
+        valid_ranges = dict(self.config_dict["extract"], **(self.config_dict.get("field_qois", None) or {}))
+        histogram_ranges = (self.config_dict.get("online_stats", None) or {}).get("histogram_ranges", None) or {}
+        lower = []
+        upper = []
+        for q_spec in q_specs:
+            q_range = histogram_ranges.get(q_spec.name, None) or [valid_ranges.get(q_spec.name + "_min", None),
+                                                                   valid_ranges.get(q_spec.name + "_max", None)]
+            if None in q_range:
+                raise Exception("No histogram range of quantity '{}', set 'online_stats: histogram_ranges'."
+                                .format(q_spec.name))
+            size = int(np.prod(q_spec.shape)) * len(q_spec.times) * len(q_spec.locations)
+            lower.append(np.full(size, float(q_range[0])))
+            upper.append(np.full(size, float(q_range[1])))
+        return np.concatenate(lower), np.concatenate(upper)
+
+    def online_converged(self, sampler):
+        """
+        Check the online MLMC estimate of the mean of the quantity ('online_stats' in config.yaml),
+        the progress is printed whenever new samples are collected.
+        :return: True if the RMSE of all values is below target_rmse and each level has min_samples
+        """
+        storage = sampler.sample_storage
+        if not isinstance(storage, online_stats.OnlineStatsStorage) or len(storage.levels) < sampler.n_levels:
+            return False
+        stats_config = self.config_dict["online_stats"]
+        n_collected = [int(level.diff.n.max()) for level in storage.levels]
+        q_slice = mlmc_levels.quantity_slice(endorse_2Dtest.quantity_specs(self.config_dict),
+                                             stats_config.get("quantity", "pressure"))
+        mean, rmse = storage.estimate(q_slice)
+        max_rmse = np.nanmax(rmse) if np.any(np.isfinite(rmse)) else np.inf
+        if n_collected != getattr(self, "_online_n_collected", None):
+            self._online_n_collected = n_collected
+            print("Online estimate: collected {}, max RMSE of the mean {:.3g}, target {:.3g}".format(
+                n_collected, max_rmse, stats_config["target_rmse"]))
+        converged = min(n_collected) >= stats_config.get("min_samples", 10) and max_rmse <= stats_config["target_rmse"]
+        if converged:
+            print("Online estimate converged, remaining samples are not waited for.")
+        return converged
+
+    def all_collect(self, sampler_list):
+        """
+        Overrides ProcessBase.all_collect, wait until all samples are finished.
+        :return: None
+        """
+        for sampler in sampler_list:
+            self.wait_for_samples(sampler, timeout=None)
+        print("N running: ", 0)
+
+    def update_cost_model(self, sampler):
+        """
+        Fit the cost model to the finished samples, save it into the work dir
+        and set the predicted task_size of the levels for the samples scheduled next.
+        :return: None
+        """
+        cost_config = self.config_dict.get("cost_model", None) or {}
+        if not cost_config.get("enabled", False):
+            return
+        model = cost_model.CostModel.fit(self.work_dir, exponent=cost_config.get("exponent", 1.0))
+        if model is None:
+            return
+        model.save(os.path.join(self.work_dir, cost_model.COST_MODEL_FILE))
+        print("Cost model: {:.3g} * n_elements ** {:.3g} + {:.3g} s ({} runs)".format(
+            model.a, model.b, model.overhead, model.n_runs))
+        for level_sim in sampler._level_sim_objects:
+            level_sim.task_size = endorse_2Dtest.task_size(level_sim.config_dict)
+            print("Level {} task size: {:.3g}".format(level_sim._level_id, level_sim.task_size))
+
+    def adaptive_sampling(self, sampler):
+        """
+        Add samples until the estimated RMSE of the moments of the quantity is below the target,
+        see 'mlmc' in config.yaml. The number of samples per level minimizes the total cost given by
+        the measured level variances and sample times (see mlmc_levels.optimal_n_samples).
+        :return: None
+        """
+        mlmc_config = self.config_dict["mlmc"]
+        for i in range(mlmc_config.get("max_iterations", 10)):
+            # wait for all scheduled samples
+            self.wait_for_samples(sampler, timeout=None)
+            n_finished = np.array(sampler.n_finished_samples)
+            # finished samples include the failed ones
+            n_collected = np.array(mlmc_levels.n_collected(sampler.sample_storage))
+            short = np.flatnonzero((n_collected < 2) & (n_finished >= 2))
+            if len(short) > 0:
+                raise Exception("Adaptive sampling stopped: levels {} have collected {} of {} finished samples, "
+                                "at least two are needed for the level variance, see the failed samples."
+                                .format(list(short), list(n_collected[short]), list(n_finished[short])))
+            n_estimated = mlmc_levels.optimal_n_samples(sampler.sample_storage,
+                                                        endorse_2Dtest.quantity_specs(self.config_dict),
+                                                        mlmc_config["target_rmse"],
+                                                        mlmc_config.get("quantity", "pressure"),
+                                                        mlmc_config.get("n_moments", 5),
+                                                        mlmc_config.get("max_n_samples", None))
+            print("Adaptive sampling {}: finished {}, collected {}, estimated {}"
+                  .format(i, list(n_finished), list(n_collected), list(n_estimated)))
+            if np.all(n_estimated <= n_collected):
+                return
+            self.update_cost_model(sampler)
+            # the targets count the scheduled samples, replace the failed ones
+            sampler.set_level_target_n_samples(n_estimated + n_finished - n_collected)
+            sampler.schedule_samples()
+        self.wait_for_samples(sampler, timeout=None)
+        print("Adaptive sampling: target RMSE not reached in {} iterations.".format(i + 1))
 
     # def calculate_moments(self, storage: SampleStorageHDF, qspec: QuantitySpec):
     #     """
@@ -0,0 +1,110 @@
+import os
+import fnmatch
+import tarfile
+import numpy as np
+
+# per sample archives, <work_dir>/archive/<sample dir name>.tar.<compression>
+ARCHIVE_DIR = "archive"
+# stream of the random generator deciding the audit samples, independent of the sample inputs
+AUDIT_STREAM = 19
+
+default_keep = ["flow_run_stats.yaml", "stage_times.yaml", "solver_stats.npz",
+                "output_*/flow_observe.yaml", "output_*/mechanics_observe.yaml"]
+default_archive = ["*.yaml", "*_stdout", "*_stderr", "output_*/*.log", "*.npz"]
+
+
+def is_audit_sample(seed, audit_fraction):
+    """
+    Audit samples keep the full outputs. The choice is given by the sample seed,
+    so it is reproducible and the same for all consumers (retention, output profiles).
+    :param seed: sample seed (see mlmc.sampling_pool.SamplingPool.compute_seed)
+    :param audit_fraction: expected fraction of the audit samples
+    :return: bool
+    """
+    if not audit_fraction:
+        return False
+    return np.random.default_rng([AUDIT_STREAM, seed]).random() < audit_fraction
+
+
+def _matches(rel_path, patterns):
+    # patterns apply both to the sample dir and to its subdirectories (coarse simulation)
+    return any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(rel_path, "*/" + p) for p in patterns)
+
+
+def _sample_files(sample_dir):
+    files = []
+    for root, dirs, fnames in os.walk(sample_dir):
+        for fname in fnames:
+            files.append(os.path.relpath(os.path.join(root, fname), sample_dir))
+    return sorted(files)
+
+
+def _remove_empty_dirs(sample_dir):
+    for root, dirs, fnames in os.walk(sample_dir, topdown=False):
+        if root != sample_dir and not os.listdir(root):
+            os.rmdir(root)
+
+
+def compact_sample(config_dict, seed, sample_dir="."):
+    """
+    Apply the retention policy ('retention' in config.yaml) to the directory of a finished sample:
+    files matching 'archive' are packed into a single compressed archive in <work_dir>/archive,
+    files matching 'keep' stay in place, everything else is removed.
+    Audit samples (see is_audit_sample, 'audit_fraction' in config.yaml) pack the whole directory.
+    :param config_dict: sample configuration
+    :param seed: sample seed
+    :param sample_dir: sample directory
+    :return: dict with the numbers of archived and removed files and the removed bytes
+    """
+    retention = config_dict.get("retention", None) or {}
+    keep = retention.get("keep", None) or default_keep
+    archive = retention.get("archive", None) or default_archive
+    compression = retention.get("compression", "gz")
+    audit = is_audit_sample(seed, config_dict.get("audit_fraction", 0))
+
+    sample_dir = os.path.abspath(sample_dir)
+    files = _sample_files(sample_dir)
+    to_archive = files if audit else [f for f in files if _matches(f, archive)]
+
+    archive_dir = os.path.join(config_dict["work_dir"], ARCHIVE_DIR)
+    os.makedirs(archive_dir, mode=0o775, exist_ok=True)
+    archive_file = os.path.join(archive_dir, "{}.tar.{}".format(os.path.basename(sample_dir), compression))
+    if to_archive:
+        with tarfile.open(archive_file + ".tmp", "w:" + compression) as tar:
+            for fname in to_archive:
+                tar.add(os.path.join(sample_dir, fname), arcname=fname)
+        os.replace(archive_file + ".tmp", archive_file)
+
+    n_removed = 0
+    removed_bytes = 0
+    for fname in files:
+        if _matches(fname, keep):
+            continue
+        path = os.path.join(sample_dir, fname)
+        removed_bytes += os.lstat(path).st_size
+        os.remove(path)
+        n_removed += 1
+    _remove_empty_dirs(sample_dir)
+
+    print("Retention: {} files archived{}, {} files ({:.1f} MB) removed".format(
+        len(to_archive), " (audit sample)" if audit else "", n_removed, removed_bytes / 2 ** 20))
+    return dict(n_archived=len(to_archive), n_removed=n_removed, removed_bytes=removed_bytes, audit=audit)
+
+
+def extract_sample(work_dir, sample_name, dest_dir, members=None):
+    """
+    Unpack the archive of a sample.
+    :param work_dir: work directory
+    :param sample_name: sample directory name, e.g. L00_S0000012
+    :param dest_dir: destination directory
+    :param members: list of file names, None - all files
+    :return: list of the extracted file names
+    """
+    archive_dir = os.path.join(work_dir, ARCHIVE_DIR)
+    names = [f for f in os.listdir(archive_dir) if f.startswith(sample_name + ".tar.") and not f.endswith(".tmp")]
+    if not names:
+        raise Exception("No archive of sample '{}' in {}".format(sample_name, archive_dir))
+    with tarfile.open(os.path.join(archive_dir, names[0]), "r:*") as tar:
+        selected = [m for m in tar.getmembers() if members is None or m.name in members]
+        tar.extractall(dest_dir, members=selected)
+    return [m.name for m in selected]
@@ -0,0 +1,92 @@
+import os
+import shutil
+import fnmatch
+import tempfile
+import contextlib
+
+from stage_timer import stage
+
+# candidates of the scratch root, the first existing writable directory is used
+default_roots = ["$SCRATCHDIR", "$TMPDIR", "/tmp"]
+# files synchronized back to the sample directory
+default_sync_back = ["*.yaml", "*.npz", "*_stdout", "*_stderr", "output_*/*.log", "output_*/*.yaml"]
+
+
+def scratch_root(roots):
+    """
+    First usable scratch root, environment variables are expanded, unset variables are skipped.
+    :param roots: list of candidate directories, e.g. ['$SCRATCHDIR', '/dev/shm', '/scratch/user']
+    :return: directory path
+    """
+    for root in roots:
+        path = os.path.expandvars(os.path.expanduser(str(root)))
+        if "$" in path or not path:
+            continue
+        if os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+            return path
+    raise Exception("No usable scratch directory in: {}".format(roots))
+
+
+def _matching_files(src_dir, patterns):
+    files = []
+    for root, dirs, fnames in os.walk(src_dir):
+        for fname in fnames:
+            rel_path = os.path.relpath(os.path.join(root, fname), src_dir)
+            # patterns apply both to the top dir and to its subdirectories (coarse simulation)
+            if any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(rel_path, "*/" + p) for p in patterns):
+                files.append(rel_path)
+    return sorted(files)
+
+
+def _copy_files(src_dir, dst_dir, files):
+    for rel_path in files:
+        dst = os.path.join(dst_dir, rel_path)
+        os.makedirs(os.path.dirname(dst), mode=0o775, exist_ok=True)
+        shutil.copy2(os.path.join(src_dir, rel_path), dst)
+
+
+@contextlib.contextmanager
+def sample_scratch(config_dict, sample_dir=None):
+    """
+    Run the sample in node local scratch according to 'scratch' in config.yaml.
+    Stage in: content of the sample directory (outputs of a previous run) and the 'stage_in' common files,
+    the meshes are fetched into the scratch by the mesh cache / repository during the sample.
+    On exit the files matching 'sync_back' are copied to the sample directory and the scratch is removed,
+    with 'keep_failed' the scratch of a failed sample is left for debugging.
+    Without 'scratch: enabled' the sample runs in the sample directory.
+    :param config_dict: sample configuration
+    :param sample_dir: sample directory, default the current directory
+    :return: yields the directory the sample runs in
+    """
+    scratch_config = config_dict.get("scratch", None) or {}
+    if sample_dir is None:
+        sample_dir = os.getcwd()
+    if not scratch_config.get("enabled", False):
+        yield sample_dir
+        return
+
+    root = scratch_root(scratch_config.get("dirs", None) or default_roots)
+    # the sample dir name is kept, it names the retention archive
+    run_dir = os.path.join(tempfile.mkdtemp(prefix="endorse_", dir=root), os.path.basename(sample_dir))
+    with stage("stage_in"):
+        shutil.copytree(sample_dir, run_dir, symlinks=True)
+        for fname in scratch_config.get("stage_in", None) or []:
+            shutil.copy2(os.path.join(config_dict["common_files_dir"], fname), os.path.join(run_dir, fname))
+    print("Running in scratch: ", run_dir)
+
+    failed = True
+    os.chdir(run_dir)
+    try:
+        yield run_dir
+        failed = False
+    finally:
+        os.chdir(sample_dir)
+        with stage("sync_back"):
+            _copy_files(run_dir, sample_dir, _matching_files(run_dir, scratch_config.get("sync_back", None)
+                                                            or default_sync_back))
+        if failed and scratch_config.get("keep_failed", False):
+            print("Scratch of the failed sample kept: ", run_dir)
+            with open(os.path.join(sample_dir, "scratch_dir.txt"), "w") as f:
+                f.write(run_dir + "\n")
+        else:
+            shutil.rmtree(os.path.dirname(run_dir), ignore_errors=True)
@@ -0,0 +1,182 @@
+import os
+import re
+import mmap
+import numpy as np
+
+# floating point number including nan and inf, without trailing punctuation
+number_pattern = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|[-+]?(?i:nan|inf)"
+
+# Default patterns of Flow123d log records, the first group of each pattern is its value.
+# They can be redefined by 'solver_log: patterns' in config.yaml.
+default_patterns = {
+    # start of a time step, value: simulation time
+    "step": r"TIME STEP\s+\d+[^\n]*?time:\s*([-+0-9.eE]+)",
+    # end of a linear solve (PETSc KSP): convergence reason, number of iterations
+    "linear": r"convergence reason (-?\d+),\s*number of iterations is (\d+)",
+    # HM coupling iteration: iteration number, abs. difference
+    "hm": r"HM Iteration (\d+) abs\. difference:\s*(" + number_pattern + ")",
+    # assembly and solve times: phase name, time [s]
+    "timing": r"\b(assembly|solve) time:\s*([-+0-9.eE]+)",
+}
+
+# PETSc -ksp_monitor output (standard output of Flow123d): iteration, residual norm
+ksp_monitor_pattern = r"^\s*(\d+) KSP Residual norm (" + number_pattern + ")"
+
+timing_phases = ["assembly", "solve"]
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def _map_file(fname):
+    """
+    Read-only memory map of the file, None for a missing or empty file.
+    """
+    if not os.path.isfile(fname) or os.path.getsize(fname) == 0:
+        return None
+    with open(fname, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _combined_regex(patterns):
+    """
+    Single alternation of all patterns, the matched pattern is given by the name of its outer group.
+    """
+    return re.compile(b"|".join(b"(?P<%s>%s)" % (name.encode(), p.encode()) for name, p in patterns.items()),
+                      re.MULTILINE)
+
+
+def parse_log(log_file, patterns=None):
+    """
+    Single regex pass over the memory mapped Flow123d log.
+    :param log_file: flow123.0.log
+    :param patterns: dict of patterns overriding default_patterns
+    :return: dict of per record arrays, records are assigned to time steps
+        step_time (n_steps,) - simulation time of the steps
+        linear_reason, linear_iterations, linear_step (n_solves,) - linear solves
+        hm_iteration, hm_difference, hm_step (n_hm,) - HM coupling iterations
+        timing_phase (index to timing_phases), timing_value, timing_step (n_timings,)
+        log_found - False for a missing or empty log
+    """
+    all_patterns = dict(default_patterns)
+    all_patterns.update(patterns or {})
+    single = {name: re.compile(p.encode()) for name, p in all_patterns.items()}
+    records = {name: [] for name in all_patterns}
+    positions = {name: [] for name in all_patterns}
+
+    data = _map_file(log_file)
+    log_found = data is not None
+    if data is not None:
+        with data:
+            for match in _combined_regex(all_patterns).finditer(data):
+                name = match.lastgroup
+                records[name].append(single[name].match(match.group(name)).groups())
+                positions[name].append(match.start())
+
+    # records before the first time step belong to step 0
+    step_pos = np.array(positions["step"], dtype=np.int64)
+
+    def step_index(name):
+        return np.maximum(np.searchsorted(step_pos, np.array(positions[name], dtype=np.int64), side="right") - 1, 0)
+
+    linear = np.array(records["linear"], dtype=np.int64).reshape(-1, 2)
+    hm = records["hm"]
+    phases = [timing_phases.index(rec[0].decode()) if rec[0].decode() in timing_phases else -1
+              for rec in records["timing"]]
+    return dict(
+        step_time=np.array([_to_float(rec[0]) for rec in records["step"]]),
+        linear_reason=linear[:, 0].astype(np.int32),
+        linear_iterations=linear[:, 1].astype(np.int32),
+        linear_step=step_index("linear").astype(np.int32),
+        hm_iteration=np.array([int(rec[0]) for rec in hm], dtype=np.int32),
+        hm_difference=np.array([_to_float(rec[1]) for rec in hm]),
+        hm_step=step_index("hm").astype(np.int32),
+        timing_phase=np.array(phases, dtype=np.int8),
+        timing_value=np.array([_to_float(rec[1]) for rec in records["timing"]]),
+        timing_step=step_index("timing").astype(np.int32),
+        log_found=np.array(log_found),
+    )
+
+
+def parse_ksp_monitor(stdout_file):
+    """
+    Residual history of PETSc -ksp_monitor, a solve starts by iteration 0.
+    :return: dict(ksp_iterations (n_solves,), ksp_initial_residual (n_solves,), ksp_final_residual (n_solves,))
+    """
+    iterations = []
+    initial = []
+    final = []
+    data = _map_file(stdout_file)
+    if data is not None:
+        with data:
+            for match in re.finditer(ksp_monitor_pattern.encode(), data, re.MULTILINE):
+                it = int(match.group(1))
+                res = _to_float(match.group(2))
+                if it == 0 or not iterations:
+                    iterations.append(it)
+                    initial.append(res)
+                    final.append(res)
+                else:
+                    iterations[-1] = it
+                    final[-1] = res
+    return dict(ksp_iterations=np.array(iterations, dtype=np.int32),
+                ksp_initial_residual=np.array(initial),
+                ksp_final_residual=np.array(final))
+
+
+def step_summary(stats):
+    """
+    Per time step sums of the log records.
+    :param stats: result of parse_log
+    :return: dict of arrays (n_steps,): linear_solves, linear_iterations_sum, min_reason (0 for no solve), hm_iterations,
+             assembly_time, solve_time
+    """
+    n_steps = max(len(stats["step_time"]), 1)
+    n_solves = np.bincount(stats["linear_step"], minlength=n_steps)
+    min_reason = np.full(n_steps, np.iinfo(np.int32).max, dtype=np.int32)
+    np.minimum.at(min_reason, stats["linear_step"], stats["linear_reason"])
+    min_reason[n_solves == 0] = 0
+    hm_iterations = np.zeros(n_steps, dtype=np.int32)
+    np.maximum.at(hm_iterations, stats["hm_step"], stats["hm_iteration"])
+    summary = dict(
+        linear_solves=n_solves,
+        linear_iterations_sum=np.bincount(stats["linear_step"], weights=stats["linear_iterations"],
+                                          minlength=n_steps).astype(np.int64),
+        min_reason=min_reason,
+        hm_iterations=hm_iterations)
+    for i, phase in enumerate(timing_phases):
+        sel = stats["timing_phase"] == i
+        summary[phase + "_time"] = np.bincount(stats["timing_step"][sel], weights=stats["timing_value"][sel],
+                                               minlength=n_steps)
+    return summary
+
+
+def analyze(log_file, stdout_file=None, patterns=None):
+    """
+    Parse the log (and the -ksp_monitor output) and add per step sums.
+    :return: dict of arrays, see parse_log, parse_ksp_monitor, step_summary
+    """
+    stats = parse_log(log_file, patterns)
+    if stdout_file is not None:
+        stats.update(parse_ksp_monitor(stdout_file))
+    stats.update({"step_" + name: arr for name, arr in step_summary(stats).items()})
+    return stats
+
+
+def converged(stats):
+    """
+    All linear solves converged (PETSc convergence reason is not negative),
+    a missing or empty log counts as not converged.
+    """
+    if not stats["log_found"]:
+        print("Missing or empty Flow123d log.")
+        return False
+    return not np.any(stats["linear_reason"] < 0)
+
+
+def save_stats(stats, fname):
+    np.savez_compressed(fname, **stats)
@@ -0,0 +1,83 @@
+import time
+import resource
+import contextlib
+import ruamel.yaml as yaml
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak RSS (VmHWM) of the process, Linux only.
+    :return: True if the peak RSS was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """
+    Peak RSS of the process [kB], since the last reset if possible.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StageTimer:
+    """
+    Wall time, CPU time and peak RSS of named stages of a sample calculation.
+    CPU time includes the child processes (e.g. Flow123d, gmsh) finished during the stage.
+    The peak RSS of the children is the maximum over all children finished so far.
+    """
+
+    # timer of the running sample, see stage()
+    current = None
+
+    def __init__(self):
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        reset = _reset_peak_rss()
+        wall = time.monotonic()
+        self_start = resource.getrusage(resource.RUSAGE_SELF)
+        children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield
+        finally:
+            self_end = resource.getrusage(resource.RUSAGE_SELF)
+            children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = (self_end.ru_utime + self_end.ru_stime - self_start.ru_utime - self_start.ru_stime)
+            children_cpu = (children_end.ru_utime + children_end.ru_stime
+                            - children_start.ru_utime - children_start.ru_stime)
+            self.records.append(dict(stage=name,
+                                     wall=time.monotonic() - wall,
+                                     cpu=cpu + children_cpu,
+                                     max_rss=_peak_rss() if reset else self_end.ru_maxrss,
+                                     children_max_rss=children_end.ru_maxrss))
+
+    def save(self, fname):
+        with open(fname, "w") as f:
+            yaml.safe_dump(self.records, f)
+
+    @staticmethod
+    def load(fname):
+        with open(fname, "r") as f:
+            return yaml.safe_load(f) or []
+
+
+def stage(name):
+    """
+    Time the stage by the current timer, no timing if there is none.
+    """
+    if StageTimer.current is None:
+        return contextlib.nullcontext()
+    return StageTimer.current.stage(name)
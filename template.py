@@ -0,0 +1,61 @@
+import re
+
+# placeholders of format '<name>'
+PLACEHOLDER_RE = re.compile(r"<([A-Za-z_][A-Za-z0-9_]*)>")
+
+
+def compile_template(text):
+    """
+    Split the template text into literal segments and placeholder slots in a single regex pass.
+    Plain dict, so it can be shipped in LevelSimulation.config_dict.
+    Placeholders in YAML comments are optional, they are kept as they are if there is no value.
+    :param text: template text
+    :return: dict(segments=[str, ...], slots=[name, ...], commented=[bool, ...]),
+             len(segments) == len(slots) + 1
+    """
+    segments = []
+    slots = []
+    commented = []
+    pos = 0
+    for match in PLACEHOLDER_RE.finditer(text):
+        segments.append(text[pos:match.start()])
+        slots.append(match.group(1))
+        line_start = text.rfind("\n", 0, match.start()) + 1
+        commented.append("#" in text[line_start:match.start()])
+        pos = match.end()
+    segments.append(text[pos:])
+    return dict(segments=segments, slots=slots, commented=commented)
+
+
+def compile_template_file(file_in):
+    with open(file_in, 'r') as src:
+        return compile_template(src.read())
+
+
+def check_template(template, params, ignore=()):
+    """
+    Compare template placeholders with the parameters.
+    :param template: compiled template
+    :param params: { 'name': value, ...}
+    :param ignore: parameters not meant for the template
+    :return: (sorted list of placeholders without value, sorted list of unused parameters)
+    """
+    slots = set(template["slots"])
+    required = {name for name, commented in zip(template["slots"], template["commented"]) if not commented}
+    missing = sorted(required - set(params.keys()))
+    unused = sorted(set(params.keys()) - slots - set(ignore))
+    return missing, unused
+
+
+def render_template(template, params):
+    """
+    Substitute parameter values into the compiled template in one pass.
+    :param template: compiled template
+    :param params: { 'name': value, ...}
+    :return: text
+    """
+    parts = [None] * (2 * len(template["slots"]) + 1)
+    parts[0::2] = template["segments"]
+    parts[1::2] = [str(params[name]) if name in params else "<{}>".format(name)
+                   for name in template["slots"]]
+    return "".join(parts)
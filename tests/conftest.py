@@ -0,0 +1,7 @@
+import os
+import sys
+
+# modules of the repository are flat top-level modules, the Flow123d stand-in lives in benchmarks
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
@@ -0,0 +1,106 @@
+import numpy as np
+import h5py
+
+import online_stats
+from mlmc.sim.simulation import QuantitySpec
+
+
+def reference_moments(values):
+    mean = np.nanmean(values, axis=0)
+    dev = values - mean
+    m2, m3, m4 = [np.nansum(dev ** k, axis=0) for k in (2, 3, 4)]
+    n = np.sum(~np.isnan(values), axis=0)
+    return n, mean, m2 / (n - 1), np.sqrt(n) * m3 / m2 ** 1.5, n * m4 / m2 ** 2 - 3
+
+
+def test_running_moments_merge():
+    rng = np.random.default_rng(0)
+    values = rng.gamma(2.0, size=(1000, 4)) * [1, 10, 1e3, 1e-3] + [0, -5, 1e4, 0]
+    values[rng.random(values.shape) < 0.05] = np.nan
+    stats = online_stats.RunningMoments(values.shape[1])
+    # uneven batches, including a single sample and an empty batch
+    for batch in np.split(values, [1, 1, 50, 333, 700]):
+        stats.update(batch)
+    n, mean, variance, skewness, kurtosis = reference_moments(values)
+    assert np.array_equal(stats.n, n)
+    assert np.allclose(stats.mean, mean)
+    assert np.allclose(stats.variance, variance)
+    assert np.allclose(stats.skewness, skewness)
+    assert np.allclose(stats.kurtosis, kurtosis)
+
+    # partial states of two workers
+    a = online_stats.RunningMoments.from_batch(values[:400])
+    b = online_stats.RunningMoments.from_state(online_stats.RunningMoments.from_batch(values[400:]).state())
+    a.merge(b)
+    assert np.allclose(a.variance, variance)
+    assert np.allclose(a.kurtosis, kurtosis)
+
+
+def test_histogram_quantiles():
+    rng = np.random.default_rng(1)
+    values = rng.normal(size=(20000, 2)) * [1, 2]
+    sketch = online_stats.HistogramSketch([-5, -10], [5, 10], n_bins=200)
+    sketch.update(values[:5000])
+    other = online_stats.HistogramSketch([-5, -10], [5, 10], n_bins=200)
+    other.update(values[5000:])
+    sketch.merge(other)
+    assert sketch.counts.sum() == values.size
+    q = [0.05, 0.5, 0.95]
+    # bin width 0.05 and 0.1
+    assert np.allclose(sketch.quantiles(q), np.quantile(values, q, axis=0), atol=[0.05, 0.1])
+
+
+def test_histogram_outer_bins():
+    sketch = online_stats.HistogramSketch([0], [1], n_bins=10)
+    sketch.update(np.array([[-1.0], [0.5], [2.0], [np.nan]]))
+    assert sketch.counts[0, 0] == 1 and sketch.counts[0, -1] == 1 and sketch.counts.sum() == 3
+    assert np.allclose(sketch.quantiles([0.0, 1.0])[:, 0], [0, 1])
+
+
+def value_ranges(q_specs):
+    return np.full(6, -10.0), np.full(6, 10.0)
+
+
+def make_storage(fname):
+    storage = online_stats.OnlineStatsStorage(fname, value_ranges, n_bins=20)
+    q_specs = [QuantitySpec("pressure", "m", [1, 1], [0.0, 1.0, 2.0], ["a", "b"])]
+    storage.save_global_data([[1.0], [0.5]], q_specs)
+    storage.save_scheduled_samples(0, ["L00_S{:07d}".format(i) for i in range(20)])
+    storage.save_scheduled_samples(1, ["L01_S{:07d}".format(i) for i in range(5)])
+    return storage
+
+
+def level_samples(rng, level_id, n):
+    coarse = rng.normal(size=(n, 6))
+    fine = coarse + 0.1 * rng.normal(size=(n, 6)) if level_id else coarse
+    coarse = coarse if level_id else np.zeros_like(coarse)
+    return [("L{:02d}_S{:07d}".format(level_id, i), (fine[i], coarse[i])) for i in range(n)], fine, coarse
+
+
+def test_storage_resume(tmp_path):
+    fname = str(tmp_path / "mlmc.hdf5")
+    make_storage(fname)
+    # interrupted before the first collection
+    storage = online_stats.OnlineStatsStorage(fname, value_ranges, n_bins=20)
+    assert storage.levels == []
+
+    rng = np.random.default_rng(2)
+    samples_0, fine_0, coarse_0 = level_samples(rng, 0, 20)
+    storage.save_samples({0: samples_0[:12]}, {})
+    storage.save_samples({0: samples_0[12:]}, {})
+    assert len(storage.levels) == 2 and storage.levels[1].fine.n.max() == 0
+    assert np.allclose(storage.levels[0].fine.mean, fine_0.mean(axis=0))
+
+    # state lost, level 1 without collected samples
+    with h5py.File(fname, "a") as f:
+        del f[online_stats.STATS_GROUP]
+    storage = online_stats.OnlineStatsStorage(fname, value_ranges, n_bins=20)
+    assert np.allclose(storage.levels[0].fine.variance, fine_0.var(axis=0, ddof=1))
+    assert storage.levels[1].diff.n.max() == 0
+
+    samples_1, fine_1, coarse_1 = level_samples(rng, 1, 5)
+    storage.save_samples({1: samples_1}, {})
+    storage = online_stats.OnlineStatsStorage(fname, value_ranges, n_bins=20)
+    mean, rmse = storage.estimate()
+    assert np.allclose(mean, fine_0.mean(axis=0) + (fine_1 - coarse_1).mean(axis=0))
+    assert np.allclose(rmse ** 2, fine_0.var(axis=0, ddof=1) / 20 + (fine_1 - coarse_1).var(axis=0, ddof=1) / 5)
@@ -0,0 +1,99 @@
+import os
+import tarfile
+import numpy as np
+import pytest
+from mlmc.sampling_pool import SamplingPool
+
+import retention
+import virtual_sensors
+from fake_flow123d import square_mesh, write_vtu, write_vtk
+
+
+def write_sample(sim_dir, rng):
+    write_vtk(os.path.join(sim_dir, "output_test"), "flow", [0, 1], {"pressure_p0": 1}, rng, variant="binary_zlib")
+
+
+def test_sample_sources(tmp_path):
+    rng = np.random.default_rng(0)
+    output = tmp_path / "output"
+    write_sample(str(output / "L00_S0000003"), rng)
+    write_sample(str(output / "several_successful" / "L00_S0000001"), rng)
+    write_sample(str(output / "several_successful" / "L01_S0000002"), rng)
+    write_sample(str(output / "several_successful" / "L01_S0000002" / "coarse"), rng)
+    write_sample(str(output / "failed" / "L00_S0000004"), rng)
+    # compacted samples without VTK output, only the archives of the audit samples have it
+    os.makedirs(str(output / "several_successful" / "L00_S0000005"))
+    os.makedirs(str(tmp_path / "archive"))
+    audit = ["L00_S0000007", "L01_S0000005"]
+    for sample in ["L00_S0000001", "L00_S0000005"] + audit:
+        assert retention.is_audit_sample(SamplingPool.compute_seed(sample), 0.5) == (sample in audit)
+        (tmp_path / "archive" / (sample + ".tar.gz")).write_bytes(b"")
+
+    sources = virtual_sensors.sample_sources(str(tmp_path), "output_test", audit_fraction=0.5)
+    assert [name for name, sim_dir, archive in sources] == [
+        "L00_S0000003", "L00_S0000001", "L01_S0000002", "L01_S0000002/coarse", "L00_S0000004",
+        "L00_S0000007", "L01_S0000005", "L01_S0000005/coarse"]
+    assert sources[-3:] == [("L00_S0000007", ".", "L00_S0000007"), ("L01_S0000005", ".", "L01_S0000005"),
+                            ("L01_S0000005/coarse", "coarse", "L01_S0000005")]
+    assert virtual_sensors.sample_sources(str(tmp_path), "output_test")[-1][0] == "L00_S0000004"
+
+
+def test_archived_coarse(tmp_path):
+    rng = np.random.default_rng(2)
+    sample_dir = tmp_path / "L01_S0000005"
+    write_sample(str(sample_dir), rng)
+    write_sample(str(sample_dir / "coarse"), rng)
+    os.makedirs(str(tmp_path / "archive"))
+    with tarfile.open(str(tmp_path / "archive" / "L01_S0000005.tar.gz"), "w:gz") as tar:
+        tar.add(str(sample_dir), arcname=".")
+
+    results = {}
+    for source in [("L01_S0000005", str(sample_dir / "coarse"), None),
+                   ("L01_S0000005/coarse", "coarse", "L01_S0000005")]:
+        args = (str(tmp_path), source, "output_test", {"pressure_p0": "flow.pvd"}, np.array([[0.5, 0.5]]),
+                np.array([0.0, 1.0]), 1)
+        name, results[source[2]] = virtual_sensors._evaluate_source(args)
+        assert name == source[0]
+    assert np.array_equal(results[None]["pressure_p0"], results["L01_S0000005"]["pressure_p0"])
+
+
+def test_evaluate_sensors(tmp_path):
+    rng = np.random.default_rng(1)
+    points, quads, triangles = square_mesh(6)
+    cell_values = rng.normal(size=len(triangles))
+    # linear point field is interpolated exactly
+    point_values = np.stack([2 * points[:, 0] - points[:, 1], points[:, 1]], axis=1)
+    write_vtu(str(tmp_path / "flow-0.vtu"), points, triangles, 5,
+              cell_data={"pressure_p0": cell_values}, point_data={"displacement": point_values}, variant="binary_zlib")
+    (tmp_path / "flow.pvd").write_text('<VTKFile type="Collection"><Collection>\n'
+                                       '<DataSet timestep="0" group="" part="0" file="flow-0.vtu"/>\n'
+                                       '</Collection></VTKFile>\n')
+    sensors = np.concatenate([rng.uniform(0, 6, size=(50, 2)), [[7.0, 3.0]]])
+    result = virtual_sensors.evaluate_sensors(str(tmp_path), {"pressure_p0": "flow.pvd", "displacement": "flow.pvd"},
+                                              sensors, cache_dir=str(tmp_path / "cache"))
+
+    times, pressure = result["pressure_p0"]
+    assert np.array_equal(times, [0])
+    # containing triangle by brute force: all barycentric coordinates non-negative
+    a, b, c = [points[triangles[:, k], :2] for k in range(3)]
+    for i, p in enumerate(sensors[:-1]):
+        def cross(u, v, w):
+            return (v[:, 0] - u[:, 0]) * (w[:, 1] - u[:, 1]) - (w[:, 0] - u[:, 0]) * (v[:, 1] - u[:, 1])
+        p = np.broadcast_to(p, a.shape)
+        signs = np.stack([cross(a, b, p), cross(b, c, p), cross(c, a, p)], axis=1)
+        inside = np.all(signs >= -1e-12, axis=1) | np.all(signs <= 1e-12, axis=1)
+        assert pressure[i, 0, 0] in cell_values[inside]
+    assert np.isnan(pressure[-1]).all()
+
+    times, displacement = result["displacement"]
+    expected = np.stack([2 * sensors[:-1, 0] - sensors[:-1, 1], sensors[:-1, 1]], axis=1)
+    assert np.allclose(displacement[:-1, 0, :], expected)
+    assert np.isnan(displacement[-1]).all()
+    assert len(os.listdir(str(tmp_path / "cache"))) == 1
+
+
+def test_quad_mesh(tmp_path):
+    points, quads, triangles = square_mesh(6)
+    write_vtu(str(tmp_path / "quads.vtu"), points, quads, 9, variant="binary")
+    with pytest.raises(Exception, match="triangle mesh"):
+        virtual_sensors.locate_sensors(str(tmp_path / "quads.vtu"), np.zeros((1, 2)))
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+import vtk_fields
+from fake_flow123d import square_mesh, write_vtu
+
+meshio = pytest.importorskip("meshio")
+
+
+def write_variant(fname, points, cells, cell_data, point_data, variant):
+    """
+    Inline variants by meshio, appended (Flow123d) variants by the Flow123d stand-in.
+    """
+    if variant.startswith("meshio_"):
+        compression = {"meshio_ascii": None, "meshio_base64": None, "meshio_base64_zlib": "zlib"}[variant]
+        mesh = meshio.Mesh(points, [("triangle", cells)], point_data=point_data,
+                           cell_data={name: [values] for name, values in cell_data.items()})
+        meshio.write(fname, mesh, file_format="vtu", binary=variant != "meshio_ascii", compression=compression)
+    else:
+        write_vtu(fname, points, cells, 5, cell_data=cell_data, point_data=point_data, variant=variant)
+
+
+@pytest.mark.parametrize("variant", ["meshio_ascii", "meshio_base64", "meshio_base64_zlib",
+                                     "ascii", "binary", "binary_zlib"])
+def test_variants(tmp_path, variant):
+    rng = np.random.default_rng(1)
+    points, quads, cells = square_mesh(4)
+    cell_data = {"pressure_p0": rng.normal(size=len(cells)), "stress": rng.normal(size=(len(cells), 9))}
+    point_data = {"displacement": rng.normal(size=(len(points), 3))}
+    fname = str(tmp_path / "mesh.vtu")
+    write_variant(fname, points, cells, cell_data, point_data, variant)
+
+    # ascii variants keep 10 (stand-in) or 16 (meshio) significant digits, binary variants are exact
+    rtol = 1e-9 if variant.endswith("ascii") else 0
+    with vtk_fields.VtuFile(fname) as vtu:
+        assert (vtu.n_points, vtu.n_cells) == (len(points), len(cells))
+        assert np.array_equal(vtu.read("Points", vtu.array_names("Points")[0]).reshape(-1, 3), points)
+        assert np.array_equal(vtu.read("Cells", "connectivity"), cells.ravel())
+        assert np.allclose(vtu.read_field("pressure_p0"), cell_data["pressure_p0"], rtol=rtol, atol=0)
+        assert np.allclose(vtu.read_field("stress"), cell_data["stress"], rtol=rtol, atol=0)
+        assert np.allclose(vtu.read_field("displacement"), point_data["displacement"], rtol=rtol, atol=0)
+        assert not vtu.has_array("CellData", "displacement")
+
+
+def test_appended_matches_meshio(tmp_path):
+    rng = np.random.default_rng(2)
+    points, quads, cells = square_mesh(4)
+    values = rng.normal(size=(len(cells), 3))
+    fname = str(tmp_path / "mesh.vtu")
+    write_vtu(fname, points, cells, 5, cell_data={"displacement": values}, variant="binary_zlib")
+    mesh = meshio.read(fname)
+    assert np.array_equal(mesh.cell_data["displacement"][0], values)
+    assert np.array_equal(mesh.cells[0].data, cells)
+
+
+def test_geometry(tmp_path):
+    points, quads, cells = square_mesh(2)
+    fname = str(tmp_path / "mesh.vtu")
+    write_vtu(fname, points, cells, 5, variant="binary")
+    centers, areas = vtk_fields.read_geometry(fname)
+    assert np.allclose(areas, 0.5)
+    assert np.allclose(centers, points[cells].mean(axis=1))
+
+
+def test_load_series(tmp_path):
+    rng = np.random.default_rng(3)
+    points, quads, cells = square_mesh(4)
+    times = [10.0, 0.0, 5.0]
+    values = [rng.normal(size=len(cells)) for _ in times]
+    records = []
+    for i, (t, v) in enumerate(zip(times, values)):
+        write_vtu(str(tmp_path / "flow-{}.vtu".format(i)), points, cells, 5, cell_data={"pressure_p0": v},
+                  variant="binary_zlib")
+        records.append('<DataSet timestep="{}" group="" part="0" file="flow-{}.vtu"/>'.format(t, i))
+    pvd = tmp_path / "flow.pvd"
+    pvd.write_text('<?xml version="1.0"?>\n<VTKFile type="Collection" version="0.1">\n<Collection>\n{}\n'
+                   '</Collection>\n</VTKFile>\n'.format("\n".join(records)))
+
+    series_times, series = vtk_fields.load_series(str(pvd), ["pressure_p0"])
+    order = np.argsort(times)
+    assert np.array_equal(series_times, np.array(times)[order])
+    assert series["pressure_p0"].shape == (3, len(cells), 1)
+    assert np.array_equal(series["pressure_p0"][:, :, 0], np.array(values)[order])
+
+
+def test_ring_weights():
+    centers = np.array([[0.5, 0, 0], [1.2, 0, 0], [0, 2.4, 0], [0, 1.4, 0], [5, 5, 0]])
+    areas = np.array([1.0, 1.0, 3.0, 1.0, 1.0])
+    # elliptic distances 0.25, 0.6, 1.2, 0.7, > 2
+    weights = vtk_fields.ring_weights(centers, areas, [0, 0], [2, 2], [0.5, 1.0, 2.0])
+    assert np.allclose(weights, [[0, 0.5, 0, 0.5, 0], [0, 0, 1, 0, 0]])
+
+
+def test_von_mises():
+    rng = np.random.default_rng(4)
+    uniaxial = np.zeros(9)
+    uniaxial[0] = -3.0
+    assert np.isclose(vtk_fields.von_mises(uniaxial), 3.0)
+    s = rng.normal(size=(5, 3, 3))
+    s = s + s.transpose(0, 2, 1)
+    reference = np.sqrt(0.5 * ((s[:, 0, 0] - s[:, 1, 1]) ** 2 + (s[:, 1, 1] - s[:, 2, 2]) ** 2
+                               + (s[:, 2, 2] - s[:, 0, 0]) ** 2)
+                        + 3 * (s[:, 0, 1] ** 2 + s[:, 1, 2] ** 2 + s[:, 0, 2] ** 2))
+    assert np.allclose(vtk_fields.von_mises(s.reshape(5, 9)), reference)
@@ -0,0 +1,290 @@
+import os
+import hashlib
+import tempfile
+import multiprocessing
+import numpy as np
+import h5py
+from mlmc.sampling_pool import SamplingPool
+
+import vtk_fields
+import retention
+from observe import align_times
+
+# located sensors of the meshes, <work_dir>/sensor_cache/<mesh and layout hash>.npz
+CACHE_DIR = "sensor_cache"
+SENSORS_FILE = "virtual_sensors.hdf5"
+
+
+def sensor_layout(sensors_config):
+    """
+    Virtual sensors given by 'virtual_sensors' in config.yaml:
+        points - list of {name, point}
+        grids - list of {name, origin, step, shape}, sensor names <name>_<i>_<j>
+    :return: names, array (n_sensors, 2)
+    """
+    names = []
+    points = []
+    for rec in sensors_config.get("points", None) or []:
+        names.append(rec["name"])
+        points.append(rec["point"][:2])
+    for grid in sensors_config.get("grids", None) or []:
+        nx, ny = grid["shape"]
+        for i in range(nx):
+            for j in range(ny):
+                names.append("{}_{}_{}".format(grid["name"], i, j))
+                points.append([grid["origin"][0] + i * grid["step"][0], grid["origin"][1] + j * grid["step"][1]])
+    return names, np.array(points, dtype=float).reshape(-1, 2)
+
+
+class BucketGrid:
+    """
+    Uniform grid of buckets over the mesh, each bucket lists the triangles whose bounding box overlaps it.
+    Points are located by testing only the triangles of their bucket.
+    """
+
+    def __init__(self, points, triangles, elements_per_bucket=4):
+        """
+        :param points: array (n_points, 2)
+        :param triangles: array (n_triangles, 3) of point indices
+        """
+        self.points = points
+        self.triangles = triangles
+        vertices = points[triangles]
+        el_min = vertices.min(axis=1)
+        el_max = vertices.max(axis=1)
+        self.origin = el_min.min(axis=0)
+        extent = np.maximum(el_max.max(axis=0) - self.origin, np.finfo(float).tiny)
+        n_buckets = max(len(triangles) // elements_per_bucket, 1)
+        self.step = np.full(2, np.sqrt(np.prod(extent) / n_buckets))
+        self.shape = np.maximum(np.ceil(extent / self.step).astype(int), 1)
+
+        # element - bucket pairs of all buckets overlapped by the element bounding boxes
+        i_min = self._bucket_index(el_min)
+        i_max = self._bucket_index(el_max)
+        counts = np.prod(i_max - i_min + 1, axis=1)
+        elements = np.repeat(np.arange(len(triangles)), counts)
+        # position within the bounding box of buckets of the element
+        local = np.arange(len(elements)) - np.repeat(np.cumsum(counts) - counts, counts)
+        width = (i_max - i_min + 1)[elements, 1]
+        ix = i_min[elements, 0] + local // width
+        iy = i_min[elements, 1] + local % width
+        buckets = ix * self.shape[1] + iy
+        order = np.argsort(buckets, kind="stable")
+        self.bucket_elements = elements[order]
+        self.bucket_start = np.searchsorted(buckets[order], np.arange(np.prod(self.shape) + 1))
+
+    def _bucket_index(self, xy):
+        return np.clip(((xy - self.origin) / self.step).astype(int), 0, self.shape - 1)
+
+    def locate(self, xy, tol=1e-10):
+        """
+        :param xy: array (n, 2) of points
+        :return: element indices (n,), -1 out of the mesh; barycentric coordinates (n, 3)
+        """
+        idx = self._bucket_index(xy)
+        buckets = idx[:, 0] * self.shape[1] + idx[:, 1]
+        counts = self.bucket_start[buckets + 1] - self.bucket_start[buckets]
+        # point - candidate element pairs
+        point_idx = np.repeat(np.arange(len(xy)), counts)
+        local = np.arange(len(point_idx)) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = self.bucket_elements[self.bucket_start[buckets[point_idx]] + local]
+
+        a, b, c = [self.points[self.triangles[candidates, k]] for k in range(3)]
+        p = xy[point_idx]
+        det = (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (c[:, 0] - a[:, 0]) * (b[:, 1] - a[:, 1])
+        det = np.where(det == 0, np.finfo(float).tiny, det)
+        l1 = ((p[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (c[:, 0] - a[:, 0]) * (p[:, 1] - a[:, 1])) / det
+        l2 = ((b[:, 0] - a[:, 0]) * (p[:, 1] - a[:, 1]) - (p[:, 0] - a[:, 0]) * (b[:, 1] - a[:, 1])) / det
+        bary = np.stack([1 - l1 - l2, l1, l2], axis=1)
+        inside = np.all(bary >= -tol, axis=1)
+
+        elements = np.full(len(xy), -1)
+        weights = np.zeros((len(xy), 3))
+        # reversed assignment keeps the first containing candidate of each point
+        hits = np.nonzero(inside)[0][::-1]
+        elements[point_idx[hits]] = candidates[hits]
+        weights[point_idx[hits]] = bary[hits]
+        return elements, weights
+
+
+def locate_sensors(vtu_file, sensor_points, cache_dir=None):
+    """
+    Containing elements of the sensors in the mesh of the VTK file, cached by the hash of the mesh and the sensors,
+    so samples sharing a mesh (mesh cache, mesh repository) locate the sensors once.
+    :return: cell indices (n_sensors,), -1 out of the mesh; point indices of the cell vertices (n_sensors, 3);
+             barycentric coordinates (n_sensors, 3)
+    """
+    with vtk_fields.VtuFile(vtu_file) as vtu:
+        points = vtu.read("Points", vtu.array_names("Points")[0]).reshape(-1, 3)
+        connectivity = vtu.read("Cells", "connectivity").astype(np.int64)
+        offsets = vtu.read("Cells", "offsets").astype(np.int64)
+    key = hashlib.sha1()
+    for array in [points, connectivity, offsets, sensor_points]:
+        key.update(np.ascontiguousarray(array).tobytes())
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, key.hexdigest() + ".npz")
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as cache:
+                return cache["cells"], cache["vertices"], cache["weights"]
+
+    starts = np.concatenate([[0], offsets[:-1]])
+    # only triangles, lower dimensional cells do not cover area
+    cells = np.nonzero(offsets - starts == 3)[0]
+    if len(cells) == 0:
+        raise Exception("No triangles in '{}', virtual sensors need a triangle mesh.".format(vtu_file))
+    triangles = connectivity[starts[cells][:, None] + np.arange(3)]
+    elements, weights = BucketGrid(points[:, :2], triangles).locate(sensor_points)
+    found = elements >= 0
+    sensor_cells = np.where(found, cells[elements], -1)
+    vertices = np.where(found[:, None], triangles[elements], 0)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, mode=0o775, exist_ok=True)
+        tmp_file = cache_file + ".tmp.npz"
+        np.savez(tmp_file, cells=sensor_cells, vertices=vertices, weights=weights)
+        os.replace(tmp_file, cache_file)
+    return sensor_cells, vertices, weights
+
+
+def evaluate_sensors(output_dir, fields, sensor_points, cache_dir=None):
+    """
+    Values of the fields in the sensors for all times of the VTK output,
+    P0 (cell data) fields take the value of the containing element, point data fields are interpolated.
+    :param output_dir: Flow123d output directory
+    :param fields: dict field name -> .pvd file, e.g. {'pressure_p0': 'flow.pvd'}
+    :return: dict field name -> (times (n_times,), values (n_sensors, n_times, n_comp)), NaN out of the mesh
+    """
+    result = {}
+    for pvd in sorted(set(fields.values())):
+        names = [name for name, f in fields.items() if f == pvd]
+        times, files = vtk_fields.read_pvd(os.path.join(output_dir, pvd))
+        cells, vertices, weights = locate_sensors(files[0], sensor_points, cache_dir)
+        found = cells >= 0
+        values = {}
+        for i, fname in enumerate(files):
+            with vtk_fields.VtuFile(fname) as vtu:
+                for name in names:
+                    if vtu.has_array("CellData", name):
+                        data = vtu.read("CellData", name)
+                        data = data.reshape(len(data), -1)[np.maximum(cells, 0)]
+                    else:
+                        data = vtu.read("PointData", name)
+                        data = np.einsum("sk,skc->sc", weights, data.reshape(len(data), -1)[vertices])
+                    data = np.where(found[:, None], data, np.nan)
+                    if name not in values:
+                        values[name] = np.empty((len(sensor_points), len(files), data.shape[1]))
+                    values[name][:, i, :] = data
+        for name in names:
+            result[name] = (times, values[name])
+    return result
+
+
+def sample_sources(work_dir, output_dir_name, audit_fraction=0):
+    """
+    Simulations with VTK output: sample directories (fine and coarse) kept in <work_dir>/output
+    and in its subdirectories where mlmc moves the finished samples (several_successful, failed),
+    archived audit samples (see retention) not present in the output, other archives have no VTK output.
+    :param audit_fraction: 'audit_fraction' in config.yaml
+    :return: list of (name, simulation directory, archive sample name or None),
+             the directory of an archived simulation is relative to the unpacked archive
+    """
+    sources = []
+    output = os.path.join(work_dir, "output")
+    known = set()
+    for parent in [output, os.path.join(output, SamplingPool.SEVERAL_SUCCESSFUL_DIR),
+                   os.path.join(output, SamplingPool.FAILED_DIR)]:
+        if not os.path.isdir(parent):
+            continue
+        for sample in sorted(e.name for e in os.scandir(parent) if e.is_dir()):
+            if sample in known:
+                continue
+            for name, sim_dir in [(sample, os.path.join(parent, sample)),
+                                  (sample + "/coarse", os.path.join(parent, sample, "coarse"))]:
+                if os.path.isdir(os.path.join(sim_dir, output_dir_name)):
+                    sources.append((name, sim_dir, None))
+                    known.add(sample)
+    archive_dir = os.path.join(work_dir, retention.ARCHIVE_DIR)
+    if os.path.isdir(archive_dir):
+        for fname in sorted(os.listdir(archive_dir)):
+            sample = fname.split(".tar.")[0]
+            if ".tar." not in fname or fname.endswith(".tmp") or sample in known:
+                continue
+            if not retention.is_audit_sample(SamplingPool.compute_seed(sample), audit_fraction):
+                continue
+            sources.append((sample, ".", sample))
+            # samples of the levels above the first one have the coarse simulation, L01_S0000012
+            if int(sample.split("_")[0][1:]) > 0:
+                sources.append((sample + "/coarse", "coarse", sample))
+    return sources
+
+
+def _evaluate_source(args):
+    work_dir, source, output_dir_name, fields, sensor_points, times, time_scale = args
+    name, sim_dir, archive_sample = source
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if archive_sample is not None:
+                retention.extract_sample(work_dir, archive_sample, tmp_dir)
+                sim_dir = os.path.join(tmp_dir, sim_dir)
+            values = evaluate_sensors(os.path.join(sim_dir, output_dir_name), fields, sensor_points,
+                                      os.path.join(work_dir, CACHE_DIR))
+        result = {}
+        for field, (field_times, field_values) in values.items():
+            result[field] = align_times(field_times / time_scale, field_values, times).transpose(1, 0, 2)
+        return name, result
+    except Exception as e:
+        print("Sensors of '{}' not evaluated: {}".format(name, e))
+        return name, None
+
+
+def collect_sensors(config_dict, work_dir, times, n_processes=None):
+    """
+    Evaluate the virtual sensors in all samples with VTK output and store them into <work_dir>/virtual_sensors.hdf5:
+        samples - names of the simulations (<sample dir>, <sample dir>/coarse)
+        <field> - (n_samples, n_times, n_sensors, n_comp)
+        attributes sensor_names, sensor_points, times
+    Samples already in the file are skipped, the file is created again when the sensor layout changes.
+    :param times: output times of the results [d]
+    :param n_processes: number of processes, default number of cores
+    :return: number of samples in the file
+    """
+    sensors_config = config_dict["virtual_sensors"]
+    fields = sensors_config["fields"]
+    names, sensor_points = sensor_layout(sensors_config)
+    times = np.asarray(times, dtype=float)
+    time_scale = config_dict["extract"].get("time_scale", 1)
+    output_dir_name = "output_" + config_dict["hm_params"]["in_file"]
+    layout = hashlib.sha1(np.ascontiguousarray(sensor_points).tobytes() + times.tobytes()
+                          + repr(sorted(fields.items())).encode()).hexdigest()
+
+    hdf_file = os.path.join(work_dir, SENSORS_FILE)
+    with h5py.File(hdf_file, "a") as f:
+        if f.attrs.get("layout", "") != layout:
+            for key in list(f.keys()):
+                del f[key]
+            f.attrs["layout"] = layout
+            f.attrs["sensor_names"] = np.array(names, dtype="S")
+            f.attrs["sensor_points"] = sensor_points
+            f.attrs["times"] = times
+            f.create_dataset("samples", shape=(0,), maxshape=(None,), dtype="S64")
+        known = set(s.decode() for s in f["samples"][()])
+
+    sources = [s for s in sample_sources(work_dir, output_dir_name, config_dict.get("audit_fraction", 0))
+               if s[0] not in known]
+    print("Evaluating {} sensors in {} samples...".format(len(names), len(sources)))
+    tasks = [(work_dir, source, output_dir_name, fields, sensor_points, times, time_scale) for source in sources]
+    with multiprocessing.Pool(n_processes) as pool, h5py.File(hdf_file, "a") as f:
+        for name, result in pool.imap_unordered(_evaluate_source, tasks):
+            if result is None:
+                continue
+            n = len(f["samples"])
+            for field, values in result.items():
+                if field not in f:
+                    f.create_dataset(field, shape=(0, *values.shape), maxshape=(None, *values.shape),
+                                     chunks=(1, *values.shape), dtype="f4")
+                f[field].resize(n + 1, axis=0)
+                f[field][n] = values
+            f["samples"].resize(n + 1, axis=0)
+            f["samples"][n] = name.encode()
+        return len(f["samples"])
@@ -0,0 +1,257 @@
+import os
+import re
+import mmap
+import zlib
+import base64
+import numpy as np
+
+# Flow123d VTK output (flow.pvd, mechanics.pvd) is read without an XML DOM: the tags of the data arrays
+# are found by regular expressions in the header, the data are taken by bulk NumPy reads from the memory
+# mapped file (raw appended data of the binary variants) or parsed by np.fromstring (ascii variant).
+
+_vtk_types = {"Int8": "i1", "UInt8": "u1", "Int16": "i2", "UInt16": "u2", "Int32": "i4", "UInt32": "u4",
+              "Int64": "i8", "UInt64": "u8", "Float32": "f4", "Float64": "f8"}
+
+_attr_re = re.compile(rb'(\w+)="([^"]*)"')
+_dataset_re = re.compile(rb'<DataSet\s[^>]*>')
+_array_re = re.compile(rb'<DataArray\s([^>]*?)(/?)>')
+_section_re = re.compile(rb'<(Points|Cells|PointData|CellData)[\s>]')
+_piece_re = re.compile(rb'<Piece\s([^>]*)>')
+_vtkfile_re = re.compile(rb'<VTKFile\s([^>]*)>')
+
+
+def _attributes(tag_content):
+    return {k.decode(): v.decode() for k, v in _attr_re.findall(tag_content)}
+
+
+def read_pvd(pvd_file):
+    """
+    Time series of a .pvd file.
+    :return: times array (n_times,), list of .vtu file paths
+    """
+    with open(pvd_file, "rb") as f:
+        content = f.read()
+    times = []
+    files = []
+    for tag in _dataset_re.findall(content):
+        attrs = _attributes(tag)
+        times.append(float(attrs["timestep"]))
+        files.append(os.path.join(os.path.dirname(pvd_file), attrs["file"]))
+    order = np.argsort(times, kind="stable")
+    return np.array(times)[order], [files[i] for i in order]
+
+
+class VtuFile:
+    """
+    Data arrays of a single .vtu file (UnstructuredGrid), variants ascii, binary (appended raw or inline base64)
+    and zlib compressed. Arrays are read on demand, the file is memory mapped while open.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        appended = self._mm.find(b"<AppendedData")
+        self._header_end = len(self._mm) if appended < 0 else appended
+        if appended >= 0:
+            # raw data start after the '_' following the AppendedData tag
+            self._appended_start = self._mm.find(b"_", self._mm.find(b">", appended)) + 1
+        header = self._mm[:self._header_end]
+
+        file_attrs = _attributes(_vtkfile_re.search(header).group(1))
+        byte_order = "<" if file_attrs.get("byte_order", "LittleEndian") == "LittleEndian" else ">"
+        self._header_dtype = np.dtype(byte_order + _vtk_types[file_attrs.get("header_type", "UInt32")])
+        self._compressed = "compressor" in file_attrs
+        self._byte_order = byte_order
+
+        piece = _attributes(_piece_re.search(header).group(1))
+        self.n_points = int(piece["NumberOfPoints"])
+        self.n_cells = int(piece["NumberOfCells"])
+
+        sections = [(m.start(), m.group(1).decode()) for m in _section_re.finditer(header)]
+        # (section, name) -> (attributes, start of the inline content)
+        self._arrays = {}
+        for m in _array_re.finditer(header):
+            section = None
+            for pos, name in sections:
+                if pos < m.start():
+                    section = name
+            attrs = _attributes(m.group(1))
+            self._arrays[(section, attrs.get("Name", ""))] = (attrs, m.end())
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def array_names(self, section):
+        return [name for s, name in self._arrays if s == section]
+
+    def _decode_blocks(self, data, offset, dtype):
+        """
+        Data at 'offset' of the binary buffer 'data': header and raw or zlib compressed blocks.
+        :return: 1D array
+        """
+        h_size = self._header_dtype.itemsize
+        if not self._compressed:
+            n_bytes = int(np.frombuffer(data, self._header_dtype, 1, offset)[0])
+            return np.frombuffer(data, dtype, n_bytes // dtype.itemsize, offset + h_size).copy()
+        n_blocks = int(np.frombuffer(data, self._header_dtype, 1, offset)[0])
+        block_sizes = np.frombuffer(data, self._header_dtype, n_blocks, offset + 3 * h_size)
+        start = offset + (3 + n_blocks) * h_size
+        chunks = []
+        for size in block_sizes:
+            chunks.append(zlib.decompress(data[start:start + int(size)]))
+            start += int(size)
+        return np.frombuffer(b"".join(chunks), dtype)
+
+    def read(self, section, name):
+        """
+        :param section: 'Points', 'Cells', 'PointData' or 'CellData'
+        :param name: array name, e.g. 'connectivity', 'pressure_p0'
+        :return: array (n_entities, n_components), 1D for single component arrays
+        """
+        if (section, name) not in self._arrays:
+            raise Exception("No array '{}' in {} of '{}'.".format(name, section, self.fname))
+        attrs, content_start = self._arrays[(section, name)]
+        dtype = np.dtype(self._byte_order + _vtk_types[attrs["type"]])
+        data_format = attrs.get("format", "ascii")
+        if data_format == "appended":
+            values = self._decode_blocks(self._mm, self._appended_start + int(attrs["offset"]), dtype)
+        else:
+            content_end = self._mm.find(b"</DataArray>", content_start)
+            content = self._mm[content_start:content_end]
+            if data_format == "ascii":
+                values = np.fromstring(content.decode(), dtype=dtype, sep=" ")
+            elif data_format == "binary":
+                values = self._read_base64(content.strip(), dtype)
+            else:
+                raise Exception("Unsupported format '{}' of array '{}' in '{}'.".format(data_format, name, self.fname))
+        n_comp = int(attrs.get("NumberOfComponents", 1))
+        return values.reshape(-1, n_comp) if n_comp > 1 else values
+
+    def has_array(self, section, name):
+        return (section, name) in self._arrays
+
+    def read_field(self, name):
+        """
+        Field values, cell data are preferred to point data (P1 interpolation of the output).
+        """
+        section = "CellData" if self.has_array("CellData", name) else "PointData"
+        return self.read(section, name)
+
+    def _read_base64(self, content, dtype):
+        h_size = self._header_dtype.itemsize
+        if not self._compressed:
+            return self._decode_blocks(base64.b64decode(content), 0, dtype)
+        # the header is encoded separately from the compressed blocks
+        first = base64.b64decode(content[:(h_size + 2) // 3 * 4])
+        n_blocks = int(np.frombuffer(first, self._header_dtype, 1)[0])
+        header_len = (h_size * (3 + n_blocks) + 2) // 3 * 4
+        data = base64.b64decode(content[:header_len]) + base64.b64decode(content[header_len:])
+        return self._decode_blocks(data, 0, dtype)
+
+
+def read_geometry(vtu_file):
+    """
+    Cell centers and areas of a 2D mesh (x, y plane), lower dimensional cells get zero area.
+    :return: centers (n_cells, 3), areas (n_cells,)
+    """
+    with VtuFile(vtu_file) as vtu:
+        points = vtu.read("Points", vtu.array_names("Points")[0]).reshape(-1, 3)
+        connectivity = vtu.read("Cells", "connectivity").astype(np.int64)
+        offsets = vtu.read("Cells", "offsets").astype(np.int64)
+    starts = np.concatenate([[0], offsets[:-1]])
+    n_vertices = offsets - starts
+    vertices = points[connectivity]
+    centers = np.add.reduceat(vertices, starts, axis=0) / n_vertices[:, None]
+    # shoelace formula, the next vertex is cyclic within each cell
+    next_idx = np.arange(1, len(connectivity) + 1)
+    next_idx[offsets - 1] = starts
+    x, y = vertices[:, 0], vertices[:, 1]
+    cross = x * y[next_idx] - x[next_idx] * y
+    areas = 0.5 * np.abs(np.add.reduceat(cross, starts))
+    areas[n_vertices < 3] = 0
+    return centers, areas
+
+
+def load_series(pvd_file, fields):
+    """
+    Fields of all times of a .pvd series stacked into arrays.
+    :param fields: list of field names (cell or point data)
+    :return: times (n_times,), dict name -> array (n_times, n_entities, n_components)
+    """
+    times, files = read_pvd(pvd_file)
+    result = {}
+    for i, fname in enumerate(files):
+        with VtuFile(fname) as vtu:
+            for name in fields:
+                values = vtu.read_field(name)
+                values = values.reshape(len(values), -1)
+                if name not in result:
+                    result[name] = np.empty((len(files), *values.shape), dtype=values.dtype)
+                result[name][i] = values
+    return times, result
+
+
+def ring_weights(centers, areas, center, semi_axes, radii):
+    """
+    Area weights of the cells in annuli around the elliptic tunnel.
+    The elliptic distance from the tunnel center is 1 on the tunnel wall, ring i is [radii[i], radii[i + 1]).
+    :return: array (n_rings, n_cells), rows sum to 1 (zero rows for empty rings)
+    """
+    rel = (centers[:, :2] - np.asarray(center, dtype=float)[:2]) / np.asarray(semi_axes, dtype=float)
+    distance = np.sqrt(np.sum(rel ** 2, axis=1))
+    ring = np.searchsorted(np.asarray(radii, dtype=float), distance, side="right") - 1
+    n_rings = len(radii) - 1
+    weights = np.zeros((n_rings, len(centers)))
+    inside = (ring >= 0) & (ring < n_rings)
+    weights[ring[inside], np.nonzero(inside)[0]] = areas[inside]
+    total = weights.sum(axis=1, keepdims=True)
+    return weights / np.where(total > 0, total, 1)
+
+
+def von_mises(stress):
+    """
+    :param stress: array (..., 9), full 3x3 tensors row by row
+    :return: array (...)
+    """
+    s = stress.reshape(*stress.shape[:-1], 3, 3)
+    deviator = s - np.trace(s, axis1=-2, axis2=-1)[..., None, None] / 3 * np.eye(3)
+    return np.sqrt(1.5 * np.sum(deviator ** 2, axis=(-2, -1)))
+
+
+def tunnel_qois(output_dir, geometry, radii):
+    """
+    Full field QoIs of the HM model for all output times:
+        pressure_drawdown - decrease of the mean pressure in the rings from the first output time
+        ring_stress - mean von Mises stress in the rings (the first ring is the excavation damaged zone)
+        max_displacement - maximal displacement magnitude over the domain
+    :param output_dir: Flow123d output directory with flow.pvd and mechanics.pvd
+    :param geometry: 'geometry' of config.yaml (tunnel_center, tunnel_dimX, tunnel_dimY)
+    :param radii: ring boundaries in elliptic distance, 1 - the tunnel wall
+    :return: dict name -> (times (n_times,), values (n_times, n_values))
+    """
+    center = geometry["tunnel_center"]
+    semi_axes = [geometry["tunnel_dimX"] / 2, geometry["tunnel_dimY"] / 2]
+
+    flow_pvd = os.path.join(output_dir, "flow.pvd")
+    flow_times, flow = load_series(flow_pvd, ["pressure_p0"])
+    weights = ring_weights(*read_geometry(read_pvd(flow_pvd)[1][0]), center, semi_axes, radii)
+    ring_pressure = np.einsum("rc,tc->tr", weights, flow["pressure_p0"][:, :, 0])
+
+    mech_pvd = os.path.join(output_dir, "mechanics.pvd")
+    mech_times, mech = load_series(mech_pvd, ["stress", "displacement"])
+    if mech["stress"].shape[1] != weights.shape[1]:
+        # mechanics output on a different mesh
+        weights = ring_weights(*read_geometry(read_pvd(mech_pvd)[1][0]), center, semi_axes, radii)
+    ring_stress = np.einsum("rc,tc->tr", weights, von_mises(mech["stress"]))
+    max_displacement = np.max(np.linalg.norm(mech["displacement"], axis=2), axis=1)
+
+    return dict(pressure_drawdown=(flow_times, ring_pressure[0] - ring_pressure),
+                ring_stress=(mech_times, ring_stress),
+                max_displacement=(mech_times, max_displacement[:, None]))